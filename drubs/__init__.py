@@ -32,8 +32,13 @@ def main():
         update   Update the project on the specified node (data safe*).
         disable  Put specified node into Drupal's 'maintenance mode'.
         enable   Turns off Drupal's maintenance mode (if on).
-        backup   Create a new backup of the site on the specified node.
+        backup   Create a new backup of the site on the specified node(s).  Also
+                   accepts several node names, or the keyword 'all'.
+        sync     Replace the database and files of the second specified node
+                   with those of the first, streamed directly between them.
         destroy  Completely deletes the project from the specified node.
+        lock     Resolve the specified node's make file into a lockfile of
+                   exact project versions, download urls, and checksums.
 
       Example commands:
 
@@ -44,6 +49,23 @@ def main():
         drubs install staging
           - perform the install action on the node named 'staging'
 
+        drubs --plan update prod
+          - print the steps and commands that the update action would run on
+            the node named 'prod', with estimated durations, without running
+            them
+
+        drubs backup --parallel 3 --stagger 60 all
+          - back up every node, three at a time, starting a backup at most
+            once a minute
+
+        drubs backup --replicate prod
+          - back up the node named 'prod', then copy its new backups to the
+            node's replica store
+
+        drubs sync prod staging
+          - replace the database and sites/default/files of the node named
+            'staging' with those of the node named 'prod'
+
         drubs status all
           - perform the status action on all nodes found in project.yml
 
@@ -55,15 +77,26 @@ def main():
         '''),
     epilog='http://drubs.org'
   )
-  parser.add_argument('action', choices=['init', 'install', 'update', 'destroy', 'enable', 'disable', 'backup', 'var_dump', 'status'], help='The action to perform on the specified node. (see descriptions above)', metavar='action')
-  parser.add_argument('nodes', nargs='+', help='The node name to perform the specified action on.  Note that \'init\' action accepts multiple node names.')
+  parser.add_argument('action', choices=['init', 'install', 'update', 'destroy', 'enable', 'disable', 'backup', 'sync', 'lock', 'var_dump', 'status'], help='The action to perform on the specified node. (see descriptions above)', metavar='action')
+  parser.add_argument('nodes', nargs='+', help='The node name to perform the specified action on.  Note that \'init\' and \'backup\' actions accept multiple node names, and \'sync\' takes two: the node to sync from, then the node to sync to.')
   parser.add_argument('-f', '--file', default='project.yml', help='path to project.yml file (not necessary if pwd contains the project.yml file)')
   parser.add_argument('-y', '--yes', action='store_const', const=True, default=False, help='automatically respond to any confirmations in the affirmative')
   parser.add_argument('-r', '--no-restore', action='store_const', const=True, default=False, help='do not automatically restore the latest site backup on failure of install or update actions')
   parser.add_argument('-b', '--no-backup', action='store_const', const=True, default=False, help='do not create site backup before install, update, or destroy actions. this option logically includes the \'--no-restore\' option')
+  parser.add_argument('--parallel', type=int, default=1, metavar='N', help='with backup of several nodes: back up at most N nodes at a time (default: 1)')
+  parser.add_argument('--stagger', type=int, default=0, metavar='SECONDS', help='with backup of several nodes: start each backup at least SECONDS after the previous one (default: 0)')
+  parser.add_argument('--verify', action='store_const', const=True, default=False, help='with backup: also check every backup of the node for damage (checksum and decompression), recording the results')
+  parser.add_argument('--replicate', action='store_const', const=True, default=False, help='with backup: also copy new backups off the node, to the node\'s replicate_to store, in resumable checksummed chunks')
   parser.add_argument('-v', '--verbose', action='store_const', const=True, default=False, help='print verbose output from drush commands, if available')
   parser.add_argument('-d', '--debug', action='store_const', const=True, default=False, help='print debug output from drush commands, if available')
   parser.add_argument('-c', '--cache', action='store_const', const=True, default=False, help='use drush cache of projects when building sites, where available')
+  parser.add_argument('--full-make', action='store_const', const=True, default=False, help='with update: rebuild every project in sites/all, rather than only the projects which changed in the make file since the last build')
+  parser.add_argument('-o', '--offline', action='store_const', const=True, default=False, help='build projects only from the node\'s package cache (package_cache_dir), failing if any is not cached or not pinned to a release (libraries are still downloaded)')
+  parser.add_argument('-p', '--plan', action='store_const', const=True, default=False, help='print the steps and commands the action would run, with durations estimated from past runs, without changing anything')
+  parser.add_argument('--progress-interval', type=int, default=15, metavar='SECONDS', help='print a progress line with an ETA every SECONDS seconds during an action (default: 15, 0 disables)')
+  parser.add_argument('-a', '--agent', action='store_const', const=True, default=False, help='ship the project config to the node and run the whole action there with a drubs agent, instead of issuing each command over ssh (requires drubs on the node)')
+  parser.add_argument('--local', action='store_const', const=True, default=False, help='treat the node as the machine drubs is running on (used by agents)')
+  parser.add_argument('--events', action='store_const', const=True, default=False, help='print structured events for each step (used by agents)')
   parser.add_argument('-D', '--fab-debug', action='store_const', const=True, default=False, help='print fabric debug messages')
   parser.add_argument('--version', action='version', version='%(prog)s 0.3.3')
 
@@ -0,0 +1,117 @@
+from re import compile, escape
+from datetime import datetime, timedelta
+
+
+# Timestamps in backup names.
+BACKUP_STAMP = '%Y-%m-%d_%H-%M-%S'
+
+# Suffixes of the two kinds of binlog backup: a full dump of the database
+# ('base'), and the binary log since the previous backup ('increment').
+BASE = 'base'
+INCREMENT = 'incr'
+
+# The binary log coordinates recorded by 'mysqldump --master-data=2' (or
+# --source-data=2, in MySQL 8.0.26 and later).
+LOG_FILE_PATTERN = r"(?:MASTER|SOURCE)_LOG_FILE='([^']+)'"
+LOG_POS_PATTERN = r'(?:MASTER|SOURCE)_LOG_POS=(\d+)'
+
+
+class Backup(object):
+  '''
+  One backup directory in a node's backup_directory.
+  '''
+
+  def __init__(self, name, kind, time):
+    self.name = name
+    self.kind = kind
+    self.time = time
+
+
+  def __repr__(self):
+    return '<Backup %s>' % (self.name)
+
+
+def backup_name(prefix, kind, when):
+  '''
+  Returns the name of a binlog backup taken at 'when' (a datetime), for
+  example 'project_node_2016-01-31_12-00-00.incr'.
+  '''
+  return '%s_%s.%s' % (prefix, when.strftime(BACKUP_STAMP), kind)
+
+
+def parse_backups(names, prefix):
+  '''
+  Returns the Backups among a list of file names, oldest first.
+  '''
+  pattern = compile(r'^%s_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\.(%s|%s)$' % (escape(prefix), BASE, INCREMENT))
+  backups = list()
+  for name in names:
+    match = pattern.match(name.strip())
+    if match:
+      backups.append(Backup(match.group(0), match.group(2), datetime.strptime(match.group(1), BACKUP_STAMP)))
+  backups.sort(key=lambda backup: (backup.time, backup.kind != BASE))
+  return backups
+
+
+def chains(backups):
+  '''
+  Groups Backups (oldest first) into chains: a base followed by the increments
+  taken after it.  Increments without a base before them are left out, since
+  they cannot be restored.
+  '''
+  grouped = list()
+  for backup in backups:
+    if backup.kind == BASE:
+      grouped.append([backup])
+    elif grouped:
+      grouped[-1].append(backup)
+  return grouped
+
+
+def restore_chain(backups, name=None):
+  '''
+  Returns the Backups to restore, in order, to get back to the backup named
+  'name' (the latest backup by default): its base and the increments up to and
+  including it.  Returns an empty list if it cannot be restored.
+  '''
+  for chain in reversed(chains(backups)):
+    for index, backup in enumerate(chain):
+      if (name is None and index == len(chain) - 1) or backup.name == name:
+        return chain[:index + 1]
+  return list()
+
+
+def removable_backups(backups, minimum_count, lifetime_days, now=None):
+  '''
+  Returns the Backups which can be removed under a node's backup settings.
+
+  As for archive backups, the newest 'minimum_count' restore points are kept,
+  and any other backup younger than 'lifetime_days'.  A chain is only removed as
+  a whole, once none of its backups need keeping, since each increment needs
+  every backup before it in its chain.
+  '''
+  now = now or datetime.now()
+  keep = set(backup.name for backup in backups[len(backups) - int(minimum_count):]) if int(minimum_count) else set()
+  cutoff = now - timedelta(days=int(lifetime_days))
+  removable = list()
+  grouped = chains(backups)
+  chained = set(backup.name for chain in grouped for backup in chain)
+  for chain in grouped[:-1]:
+    if all(backup.name not in keep and backup.time < cutoff for backup in chain):
+      removable.extend(chain)
+  # Increments orphaned before the first base are of no use.
+  removable.extend(backup for backup in backups if backup.name not in chained)
+  return removable
+
+
+def log_range(logs, start_file, end_file):
+  '''
+  Returns the binary log files from 'start_file' to 'end_file' (inclusive), out
+  of the output of 'SHOW BINARY LOGS'.  Returns None if 'start_file' is no
+  longer on the server (it has been purged), since the range is then
+  incomplete.
+  '''
+  names = [line.split()[0] for line in logs.splitlines() if line.strip()]
+  if start_file not in names or end_file not in names:
+    return None
+  return names[names.index(start_file):names.index(end_file) + 1]
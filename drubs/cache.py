@@ -0,0 +1,193 @@
+import makefile
+from collections import OrderedDict
+from fabric.state import env
+from fabric.api import hide
+from fabric.colors import red, cyan
+
+
+class PackageCache(object):
+  '''
+  A content-addressed cache of drupal.org project tarballs on a node's server.
+
+  Every project and node on a server that sets the same 'package_cache_dir'
+  shares the cache, so each release is only ever downloaded once per server.
+  The cache directory is laid out as:
+
+    blobs/<sha256>.tar.gz       release tarballs, named by their checksum
+    index/<project>/<version>   '<sha256> <type>' for each cached release
+
+  Blobs are touched whenever they are used, and the least recently used blobs
+  are evicted once the cache grows beyond 'package_cache_size_mb'.
+  '''
+
+  def __init__(self, node, directory, size_mb, offline=False):
+    self.node = node
+    self.directory = directory.rstrip('/')
+    self.size_mb = int(size_mb)
+    self.offline = offline
+
+
+  def apply(self, info):
+    '''
+    Rewrites make file info so that pinned and locked projects are built from
+    the cache.
+
+    Any pinned project which is not yet cached is downloaded into the cache
+    first.  Projects which are not pinned to an exact release (dev versions,
+    git checkouts, etc.) are left for drush make to download as usual.  If the
+    cache is offline (mirror mode), drubs exits instead of letting anything be
+    downloaded.
+    '''
+    core = info.get('core', '')
+    projects = makefile.get_projects(info)
+    wanted = OrderedDict()
+    for name, spec in projects.items():
+      if makefile.is_locked(spec):
+        wanted[name] = spec['version']
+      elif makefile.is_pinned(name, spec):
+        wanted[name] = makefile.full_version(name, core, spec['version'])
+
+    cached = self.lookup(wanted)
+    missing = [name for name in wanted if name not in cached]
+    print(cyan('Package cache: %d of %d pinned project(s) already cached...' % (
+      len(wanted) - len(missing),
+      len(wanted),
+    )))
+
+    if missing and self.offline:
+      print(red("Offline mode: the following projects are not in the package cache '%s': %s. Exiting..." % (
+        self.directory,
+        ', '.join('%s-%s' % (name, wanted[name]) for name in missing),
+      )))
+      exit(1)
+    unpinned = [name for name in projects if name not in wanted]
+    if unpinned and self.offline:
+      print(red("Offline mode: the following projects are not pinned to a release and cannot be served from the package cache: %s.  Pin them, or run 'drubs lock'. Exiting..." % (
+        ', '.join(unpinned),
+      )))
+      exit(1)
+
+    releases = list()
+    for name in missing:
+      spec = projects[name]
+      if makefile.is_locked(spec):
+        # Locked projects carry everything needed to download them.
+        releases.append((name, wanted[name], spec['type'], spec['download']['url'], spec['download']['md5']))
+        continue
+      try:
+        history = makefile.release_history(name, core)
+      except IOError as e:
+        print(red('%s. Exiting...' % (e)))
+        exit(1)
+      release = makefile.find_release(history, wanted[name])
+      if release is None:
+        print(red("Release '%s' of project '%s' does not exist. Exiting..." % (wanted[name], name)))
+        exit(1)
+      releases.append((name, wanted[name], history['type'], release['download_link'], release['mdhash']))
+    cached.update(self.fetch(releases))
+
+    for name in wanted:
+      if name not in cached:
+        # Only possible when planning (--plan), as nothing is downloaded.
+        continue
+      sha, project_type = cached[name]
+      spec = OrderedDict((k, v) for k, v in projects[name].items() if k not in ('version', 'download', 'type'))
+      spec['type'] = project_type
+      spec['download'] = OrderedDict([
+        ('type', 'file'),
+        ('url', self.blob_path(sha)),
+      ])
+      projects[name] = spec
+    return makefile.set_projects(info, projects)
+
+
+  def blob_path(self, sha):
+    return '%s/blobs/%s.tar.gz' % (self.directory, sha)
+
+
+  def lookup(self, wanted):
+    '''
+    Returns a dict of project name => (sha256, type) for cached releases.
+
+    Each cached blob found is touched, marking it as recently used.
+    '''
+    if not wanted:
+      return dict()
+    keys = ' '.join('%s/%s' % (name, version) for name, version in wanted.items())
+    cmd = (
+      'cd %s/index 2>/dev/null || exit 0; '
+      'for key in %s; do '
+        'if [ -f "$key" ]; then '
+          'set -- $(cat "$key"); '
+          'if [ -f "../blobs/$1.tar.gz" ]; then touch "../blobs/$1.tar.gz"; echo "$key $1 $2"; fi; '
+        'fi; '
+      'done'
+    ) % (self.directory, keys)
+    with hide('running', 'stdout'):
+      result = self.node.drubs_run(cmd, capture=True, query=True)
+    cached = dict()
+    for line in result.splitlines():
+      parts = line.split()
+      if len(parts) == 3:
+        cached[parts[0].split('/')[0]] = (parts[1], parts[2])
+    return cached
+
+
+  def fetch(self, releases):
+    '''
+    Downloads releases into the cache, verifying their drupal.org md5 hashes.
+
+    Accepts a list of (name, version, type, download url, md5) tuples, and
+    returns a dict of project name => (sha256, type).
+    '''
+    if not releases:
+      return dict()
+    print(cyan('Downloading %d project(s) into package cache...' % (len(releases))))
+    cmd = 'umask 0002; mkdir -p %s/blobs %s/index %s/tmp && cd %s' % (
+      self.directory,
+      self.directory,
+      self.directory,
+      self.directory,
+    )
+    for name, version, project_type, url, mdhash in releases:
+      cmd += (
+        '; tmp=tmp/$$.%(name)s.tar.gz; '
+        'curl -fsSL -o "$tmp" "%(url)s" && '
+        '[ "$(md5sum < "$tmp" | cut -c1-32)" = "%(mdhash)s" ] && '
+        'sha=$(sha256sum < "$tmp" | cut -c1-64) && '
+        'mv "$tmp" "blobs/$sha.tar.gz" && '
+        'mkdir -p index/%(name)s && '
+        'echo "$sha %(type)s" > "index/%(name)s/%(version)s.tmp" && '
+        'mv "index/%(name)s/%(version)s.tmp" "index/%(name)s/%(version)s" && '
+        'echo "%(name)s/%(version)s $sha %(type)s" || '
+        '{ rm -f "$tmp"; echo "Download or checksum verification failed for %(url)s" >&2; exit 1; }'
+      ) % dict(name=name, version=version, type=project_type, url=url, mdhash=mdhash)
+    with hide('running', 'stdout'):
+      result = self.node.drubs_run(cmd, capture=True)
+    fetched = dict()
+    for line in result.splitlines():
+      parts = line.split()
+      if len(parts) == 3 and '/' in parts[0]:
+        fetched[parts[0].split('/')[0]] = (parts[1], parts[2])
+    return fetched
+
+
+  def evict(self):
+    '''
+    Removes least recently used blobs until the cache fits 'size_mb'.
+    '''
+    cmd = (
+      'cd %s/blobs 2>/dev/null || exit 0; '
+      'limit=%d; '
+      'total=$(du -sb . | cut -f1); '
+      'for f in $(ls -tr); do '
+        '[ "$total" -le "$limit" ] && break; '
+        'size=$(stat -c %%s "$f"); rm -f "$f"; total=$((total - size)); '
+      'done; '
+      'cd ../index && for f in */*; do '
+        '[ -f "$f" ] || continue; '
+        '[ -f "../blobs/$(cut -d" " -f1 "$f").tar.gz" ] || rm -f "$f"; '
+      'done; true'
+    ) % (self.directory, self.size_mb * 1024 * 1024)
+    with hide('running', 'stdout'):
+      self.node.drubs_run(cmd)
@@ -0,0 +1,246 @@
+import os
+import sys
+import time
+import threading
+import subprocess
+from re import compile
+from collections import deque
+from os.path import join, isdir, getmtime
+from fabric.state import env, output, connections
+from fabric.operations import _AttributeString, _prefix_env_vars, _shell_wrap
+from fabric.utils import error
+from paramiko import SSHException
+from paramiko.agent import AgentRequestHandler
+
+
+# Bytes of the most recent output of a command kept in memory.  All output is
+# written to the run's log file.
+CAPTURE_LIMIT = 1024 * 1024
+
+# Number of run logs kept per project.
+LOG_KEEP = 50
+
+
+def logs_dir(config_dir):
+  '''
+  Returns the directory holding a project's run logs.
+  '''
+  return join(config_dir, '.drubs', 'logs')
+
+
+def open_log(config_dir, node_name, action, started):
+  '''
+  Opens the log file for the run of an action on a node started at 'started'
+  (a timestamp).  The file is appended to and line buffered, so that processes
+  forked during the run can open or share it.
+  '''
+  directory = logs_dir(config_dir)
+  if not isdir(directory):
+    os.makedirs(directory)
+  path = join(directory, '%s_%s_%s.log' % (node_name, action, time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(started))))
+  return open(path, 'a', 1)
+
+
+def remove_old_logs(config_dir, keep=LOG_KEEP):
+  '''
+  Removes all but the 'keep' most recent run logs of a project.
+  '''
+  directory = logs_dir(config_dir)
+  if not isdir(directory):
+    return
+  paths = [join(directory, name) for name in os.listdir(directory)]
+  paths.sort(key=getmtime, reverse=True)
+  for path in paths[keep:]:
+    os.remove(path)
+
+
+class OutputCapture(object):
+  '''
+  Collects the output of a command as it streams.
+
+  Every line is written to the log (if any), but only the most recent 'limit'
+  bytes are kept in memory, along with the first match of each of the
+  requested 'fields' (a dict of name => regular expression; the first group of
+  the expression is kept, or the whole match if it has none).  With no
+  'limit', all of the output is kept.
+  '''
+
+  def __init__(self, log=None, fields=None, limit=CAPTURE_LIMIT, echo=None):
+    self.log = log
+    self.patterns = dict((name, compile(pattern)) for name, pattern in (fields or dict()).items())
+    self.fields = dict()
+    self.limit = limit
+    self.echo = echo
+    self.lines = deque()
+    self.size = 0
+    self.truncated = False
+
+
+  def add(self, line):
+    if self.log is not None:
+      self.log.write(line)
+    if self.echo is not None:
+      self.echo(line)
+    for name, pattern in self.patterns.items():
+      if name not in self.fields:
+        match = pattern.search(line)
+        if match:
+          self.fields[name] = match.group(1) if match.groups() else match.group(0)
+    self.lines.append(line)
+    self.size += len(line)
+    while self.limit is not None and self.size > self.limit:
+      self.size -= len(self.lines.popleft())
+      self.truncated = True
+
+
+  def value(self):
+    return ''.join(self.lines)
+
+
+def echo_to(stream, prefix=''):
+  def echo(line):
+    stream.write(prefix + line)
+    stream.flush()
+  return echo
+
+
+def prefix_command(command, cwd, prefixes=()):
+  '''
+  Prefixes a command like fabric's _prefix_commands(), but changing to 'cwd'
+  and issuing 'prefixes' first rather than reading fabric's env.cwd,
+  env.lcwd and env.command_prefixes.
+  '''
+  prefixes = list(prefixes)
+  if cwd:
+    prefixes.insert(0, 'cd %s' % (cwd))
+  return ''.join(prefix + ' && ' for prefix in prefixes) + command
+
+
+def stream_local(command, log=None, capture=False, fields=None, cwd='', prefixes=(), warn_only=False, limit=CAPTURE_LIMIT):
+  '''
+  Runs a command locally, like fabric's local(), streaming its output.
+  '''
+  wrapped_command = prefix_command(_prefix_env_vars(command, local=True), cwd, prefixes)
+  if output.debug:
+    print('[localhost] local: %s' % (wrapped_command))
+  elif output.running:
+    print('[localhost] local: %s' % (command))
+  stdout = OutputCapture(log, fields, limit, echo=echo_to(sys.stdout) if output.stdout and not capture else None)
+  stderr = OutputCapture(log, limit=limit, echo=echo_to(sys.stderr) if output.stderr and not capture else None)
+  process = subprocess.Popen(
+    [wrapped_command],
+    shell=True,
+    # As on remote nodes (see fabric's env.shell), for 'set -o pipefail'.
+    executable='/bin/bash',
+    stdout=subprocess.PIPE,
+    stderr=subprocess.PIPE,
+    close_fds=True,
+  )
+  reader = threading.Thread(target=read_lines, args=(process.stderr, stderr))
+  reader.daemon = True
+  reader.start()
+  read_lines(process.stdout, stdout)
+  reader.join()
+  return result(command, wrapped_command, 'local', process.wait(), stdout, stderr, warn_only)
+
+
+def stream_remote(command, host_string, log=None, capture=False, fields=None, cwd='', prefixes=(), warn_only=False, limit=CAPTURE_LIMIT):
+  '''
+  Runs a command on 'host_string', like fabric's run(), streaming its output
+  (stdout and stderr combined) through the existing SSH connection.
+
+  As with run(), the command gets a pseudo-terminal (unless
+  env.always_use_pty is unset): if the connection closes before the command
+  ends, it is hung up rather than left running.
+  '''
+  wrapped_command = _shell_wrap(prefix_command(_prefix_env_vars(command), cwd, prefixes), shell_escape=True)
+  if output.debug:
+    print('[%s] run: %s' % (host_string, wrapped_command))
+  elif output.running:
+    print('[%s] run: %s' % (host_string, command))
+  prefix = '[%s] out: ' % (host_string) if env.output_prefix else ''
+  stdout = OutputCapture(log, fields, limit, echo=echo_to(sys.stdout, prefix) if output.stdout and not capture else None)
+  channel = connections[host_string].get_transport().open_session()
+  forward = AgentRequestHandler(channel) if env.forward_agent else None
+  try:
+    channel.set_combine_stderr(True)
+    if env.always_use_pty:
+      channel.get_pty()
+    channel.exec_command(wrapped_command)
+    read_lines(channel.makefile('rb'), stdout, crlf=env.always_use_pty)
+    status = channel.recv_exit_status()
+  finally:
+    if forward is not None:
+      forward.close()
+    channel.close()
+  return result(command, wrapped_command, 'run', status, stdout, OutputCapture(), warn_only)
+
+
+def put_file(host_string, source, remote_path):
+  '''
+  Uploads a local file (a path, or a file-like object) to 'remote_path' on
+  'host_string', like fabric's put(), over the existing SSH connection.
+  '''
+  if output.running:
+    print('[%s] put: %s -> %s' % (host_string, source if isinstance(source, basestring) else '<file obj>', remote_path))
+  try:
+    sftp = connections[host_string].open_sftp()
+    try:
+      if isinstance(source, basestring):
+        sftp.put(source, remote_path)
+      else:
+        sftp.putfo(source, remote_path)
+    finally:
+      sftp.close()
+  except (IOError, OSError, SSHException) as exception:
+    # Abort as fabric's put() does, so that failed uploads take the same path
+    # as failed commands (see result()).
+    error("put() encountered an exception while uploading to '%s'" % (remote_path), exception=exception)
+
+
+def get_file(host_string, remote_path, local_path):
+  '''
+  Downloads 'remote_path' on 'host_string' to a local file, like fabric's
+  get(), over the existing SSH connection.
+  '''
+  if output.running:
+    print('[%s] download: %s <- %s' % (host_string, local_path, remote_path))
+  try:
+    sftp = connections[host_string].open_sftp()
+    try:
+      sftp.get(remote_path, local_path)
+    finally:
+      sftp.close()
+  except (IOError, OSError, SSHException) as exception:
+    error("get() encountered an exception while downloading '%s'" % (remote_path), exception=exception)
+
+
+def read_lines(stream, capture, crlf=False):
+  '''
+  Adds each line read from a stream to an OutputCapture.  Lines ending with
+  CRLF (as output through a pseudo-terminal does) end with LF instead if
+  'crlf' is set.
+  '''
+  for line in iter(stream.readline, ''):
+    if crlf and line.endswith('\r\n'):
+      line = line[:-2] + '\n'
+    capture.add(line)
+
+
+def result(command, wrapped_command, which, status, stdout, stderr, warn_only=False):
+  '''
+  Returns the result of a command as fabric does, aborting (unless
+  'warn_only', or env.warn_only, is set) if it failed.
+  '''
+  out = _AttributeString(stdout.value().strip())
+  out.stderr = _AttributeString(stderr.value().strip())
+  out.fields = stdout.fields
+  out.truncated = stdout.truncated
+  out.command = command
+  out.real_command = wrapped_command
+  out.return_code = status
+  out.failed = status != 0
+  out.succeeded = not out.failed
+  if out.failed and not warn_only:
+    error('%s() encountered an error (return code %s) while executing \'%s\'' % (which, status, command), stdout=out, stderr=out.stderr)
+  return out
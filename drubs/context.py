@@ -0,0 +1,242 @@
+import imp
+import sys
+import time
+import threading
+import socket
+from contextlib import contextmanager
+from itertools import count
+from os.path import join, basename, exists as local_exists
+from fabric.state import env
+from fabric.api import hide
+from fabric.colors import red
+from capture import stream_remote
+
+
+# The NodeContexts active in each thread, innermost last.
+_local = threading.local()
+
+# Numbers the modules loaded from py_files, see load_config_script().
+_config_scripts = count(1)
+_config_scripts_lock = threading.Lock()
+
+# The names and addresses of this machine, see local_identity().
+_local_identity = None
+_local_identity_lock = threading.Lock()
+
+# Attributes of the active NodeContext set on fabric's env, which py_files (and
+# older drubs code) read from there, see activate().
+ENV_ATTRIBUTES = ('host_is_local', 'cd', 'prefix', 'exists', 'files_dir', 'node_name', 'node', 'start_time')
+
+
+class NodeContext(object):
+  '''
+  Everything particular to one node during an action: which node it is, the
+  host commands reach it on, the directory they run in and the commands they
+  are prefixed with.
+
+  Nodes used to keep this state on fabric's global env, so that only one node
+  could be driven per process.  Each Node now has its own context, passed to
+  the commands it runs.  For py_files, the context's attributes are still set
+  on env while it is active (see activate()): since env is shared by the whole
+  process, drubs drives nodes at the same time in separate processes (see
+  TaskGraph), never in threads of one process.
+  '''
+
+  def __init__(self, node_name, host_string, host_is_local, config=None, config_dir=None):
+    self.config = config or env.config
+    self.config_dir = config_dir or env.config_dir
+    self.node_name = node_name
+    self.node = self.config['nodes'][node_name]
+    self.host_string = host_string
+    self.host_is_local = host_is_local
+
+    # The absolute path to the project's files dir on the node.
+    if host_is_local:
+      self.files_dir = self.config_dir + '/files'
+    else:
+      self.files_dir = '/tmp/' + self.config['project_settings']['project_name'] + '/files'
+
+    # The directory commands run in, see cd().
+    self.cwd = ''
+
+    # The commands issued before each command, see prefix().
+    self.prefixes = list()
+
+    # Used later by Node.print_elapsed_time().
+    self.start_time = time.time()
+
+    # The Node driven in this context, set by Node.
+    self.instance = None
+
+
+  @classmethod
+  def from_env(cls):
+    '''
+    Returns the contexts for the requested nodes on the host fabric is
+    executing a task on (see find_nodes()).
+    '''
+    # Nodes on a host matching one of this machine's own names or addresses
+    # are run with local commands.
+    host_is_local = env.host in local_identity() or env.force_local
+    if not host_is_local:
+      env.forward_agent = True
+    return [cls(name, env.host_string, host_is_local) for name in find_nodes(env.user, env.host, env.port)]
+
+
+  @classmethod
+  def for_node(cls, node_name):
+    '''
+    Returns the context for a node by name, outside of a fabric task.
+    '''
+    node = env.config['nodes'][node_name]
+    host_is_local = node['server_host'].strip() in local_identity() or env.force_local
+    if not host_is_local:
+      env.forward_agent = True
+    return cls(node_name, '%s@%s:%s' % (
+      node['server_user'].strip(),
+      node['server_host'].strip(),
+      node['server_port'].strip(),
+    ), host_is_local)
+
+
+  @contextmanager
+  def activate(self):
+    '''
+    Makes this the current context of the calling thread (see
+    current_context()) for the duration of the block, and sets its attributes
+    (ENV_ATTRIBUTES) on fabric's env, restoring their previous values after.
+    '''
+    previous = dict((name, env[name]) for name in ENV_ATTRIBUTES if name in env)
+    for name in ENV_ATTRIBUTES:
+      env[name] = getattr(self, name)
+    stack = _local.__dict__.setdefault('stack', list())
+    stack.append(self)
+    try:
+      yield self
+    finally:
+      stack.pop()
+      for name in ENV_ATTRIBUTES:
+        if name in previous:
+          env[name] = previous[name]
+        else:
+          env.pop(name, None)
+
+
+  @contextmanager
+  def cd(self, path):
+    '''
+    Runs the commands of this context in a directory, like fabric's cd() and
+    lcd() (whichever applies), for the duration of the block.  Fabric's own
+    env.cwd and env.lcwd are left alone.
+    '''
+    previous = self.cwd
+    escaped = path.replace(' ', r'\ ')
+    if previous and not path.startswith('/') and not path.startswith('~'):
+      self.cwd = previous + '/' + escaped
+    else:
+      self.cwd = escaped
+    try:
+      yield
+    finally:
+      self.cwd = previous
+
+
+  @contextmanager
+  def prefix(self, command):
+    '''
+    Issues a command before each command of this context, like fabric's
+    prefix(), for the duration of the block.
+    '''
+    self.prefixes.append(command)
+    try:
+      yield
+    finally:
+      self.prefixes.pop()
+
+
+  def exists(self, path):
+    if self.host_is_local:
+      return local_exists(path)
+    with hide('running'):
+      return stream_remote('test -e "$(echo %s)"' % (path), self.host_string, capture=True, warn_only=True).succeeded
+
+
+def node_key(user, host, port):
+  return (str(user).strip(), str(host).strip(), str(port).strip())
+
+
+def build_node_index(nodes):
+  '''
+  Returns a dict of (server_user, server_host, server_port) => the names of the
+  nodes on that host, sorted by name.
+  '''
+  index = dict()
+  for name in sorted(nodes):
+    node = nodes[name]
+    key = node_key(node.get('server_user', ''), node.get('server_host', ''), node.get('server_port', ''))
+    index.setdefault(key, list()).append(name)
+  return index
+
+
+def find_nodes(user, host, port):
+  '''
+  Returns the names of the requested nodes (env.requested_nodes) at a fabric
+  host (see build_node_index()), in the order they were requested.
+
+  fabric runs a task once per host, so where several requested nodes share a
+  host, that task runs the action on each of them in turn.
+  '''
+  names = env.node_index.get(node_key(user, host, port), list())
+  requested = [name for name in env.get('requested_nodes', names) if name in names]
+  if not requested:
+    print(red("No node found for host '%s@%s:%s'. Exiting..." % (user, host, port)))
+    exit(1)
+  return requested
+
+
+def local_identity():
+  '''
+  Returns the set of names and addresses by which this machine knows itself,
+  resolved once per process.
+  '''
+  global _local_identity
+  with _local_identity_lock:
+    if _local_identity is None:
+      names = set(['localhost', '127.0.0.1', '::1'])
+      for name in (socket.gethostname(), socket.getfqdn()):
+        names.add(name)
+        try:
+          hostname, aliases, addresses = socket.gethostbyname_ex(name)
+        except socket.error:
+          continue
+        names.add(hostname)
+        names.update(aliases)
+        names.update(addresses)
+      _local_identity = frozenset(names)
+    return _local_identity
+
+
+def current_context():
+  '''
+  Returns the innermost active NodeContext of the calling thread.
+  '''
+  stack = _local.__dict__.get('stack')
+  if not stack:
+    raise RuntimeError('No node is active in this thread.')
+  return stack[-1]
+
+
+def load_config_script(context):
+  '''
+  Loads the py_file of a context's node as a module of its own, with the
+  context active: py_files which create a Node(env) when loaded get the Node
+  of the context (see Node.__new__()), even when several nodes are driven in
+  one process.
+  '''
+  path = join(context.config_dir, context.node['py_file'])
+  with _config_scripts_lock:
+    if context.config_dir not in sys.path:
+      sys.path.append(context.config_dir)
+    name = '%s_%d' % (basename(path).rsplit('.', 1)[0], next(_config_scripts))
+    with context.activate():
+      return imp.load_source(name, path)
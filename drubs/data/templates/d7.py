@@ -5,11 +5,14 @@ from fabric.api import lcd, cd, run
 from fabric.context_managers import settings
 from fabric.colors import red, yellow, green, cyan
 from drubs.node import Node
+from drubs.taskgraph import TaskGraph
 
 instance = Node(env)
 drush = instance.drush
 drush_sql = instance.drush_sql
+drush_sql_bulk = instance.drush_sql_bulk
 drubs_run = instance.drubs_run
+run_tasks = instance.run_tasks
 
 def pre(*args, **kwargs):
   with env.cd(env.node['site_root']):
@@ -32,7 +35,8 @@ def post(*args, **kwargs):
     Enter any post-install configuration tasks below (examples provided).
 
     Typically this is where you will enable and disable modules/themes/etc.
-    Generally you will be using drubs_run(), drush(), and drush_sql() functions.
+    Generally you will be using drubs_run(), drush(), drush_sql(), and
+    drush_sql_bulk() functions.
 
     Some examples:
 
@@ -42,6 +46,23 @@ def post(*args, **kwargs):
     drush('en [module1_name,module2_name,module3_name]')
     drush('dis [module]')
     drush_sql(<triple single quotes here>UPDATE some_table...<triple single quotes here>)
+    drush_sql_bulk([<sql statement>, <sql statement>, ...])
+    drush_sql_bulk('data_fixes.sql')
+
+    Steps which do not depend on each other can be run at the same time, by
+    declaring them as tasks:
+
+    graph = TaskGraph(workers=4)
+
+    @graph.task()
+    def sync_assets():
+      drubs_run('rsync ...')
+
+    @graph.task(after=['sync_assets'])
+    def build_theme():
+      drubs_run('...')
+
+    run_tasks(graph)
 
     See http://drush.ws/ for more examples of drush commands you may wish to
     use.
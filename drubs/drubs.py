@@ -1,5 +1,7 @@
 import yaml
 import tasks
+import makefile
+from context import build_node_index
 from os.path import isfile, isdir, dirname, abspath, join, basename, normpath, realpath
 from os import getcwd
 from fabric.state import env, output
@@ -22,6 +24,7 @@ def load_config_file(config_file):
     usage without the -f parameter, this will be 'project.yml'
   env.config_dir - the absolute path to the project config directory
   env.config - the actual contents of the config file
+  env.node_index - the names of the nodes on each (user, host, port)
 
   Accepts one parameter 'config_file': the relative or absolute path to a drubs
   project config file.
@@ -39,6 +42,8 @@ def load_config_file(config_file):
     if 'nodes' not in env.config:
       print(red("The project config file '%s' does not contain a 'nodes' section. Exiting..." % (config_file)))
       exit(1)
+    # Which node each fabric host string belongs to, see context.find_nodes().
+    env.node_index = build_node_index(env.config['nodes'])
     return env.config
   else:
     if config_file == 'project.yml':
@@ -110,7 +115,18 @@ def set_flags(args):
   env.verbose    = args.verbose
   env.debug      = args.debug
   env.cache      = args.cache
+  env.full_make  = args.full_make
+  env.offline    = args.offline
+  env.plan_only  = args.plan
+  env.progress_interval = args.progress_interval
+  env.agent      = args.agent
+  env.force_local = args.local
+  env.events     = args.events
   env.no_backup  = args.no_backup
+  env.replicate  = args.replicate
+  env.verify     = args.verify
+  env.parallel   = args.parallel
+  env.stagger    = args.stagger
   env.no_restore = args.no_restore
   env.yes        = args.yes
   # If --no-backup is set, also always set --no-restore.
@@ -133,8 +149,16 @@ def drubs(args):
   if args.action == 'init':
     drubs_init(args)
   else:
-    # Return error if more than one node is specified.
-    if len(args.nodes) > 1:
+    # Sync takes exactly two nodes: the one to sync from, and the one to sync
+    # to.
+    if args.action == 'sync':
+      if len(args.nodes) != 2 or args.nodes[0] == args.nodes[1]:
+        print(red("Sync requires exactly two different node names: the node to sync from, then the node to sync to. Exiting..."))
+        exit(1)
+
+    # Return error if more than one node is specified (other than for backups,
+    # see backup_nodes(), and sync).
+    elif len(args.nodes) > 1 and args.action != 'backup':
       if args.action == 'status':
         print(red("More than one node parameter specified.  Please specify exactly one node name (or the keyword 'all' to get the status of all nodes). Exiting..."))
       else:
@@ -142,8 +166,8 @@ def drubs(args):
       exit(1)
 
     # Return error if 'all' keyword is being attempted to be used on any action
-    # other than 'status'.
-    if args.action != 'status' and args.nodes[0] == 'all':
+    # other than 'status' and 'backup'.
+    if args.action not in ('status', 'backup') and args.nodes[0] == 'all':
       print(red("Cannot use the keyword 'all' with the action '%s' Exiting..." % (
         args.action,
         )
@@ -158,6 +182,22 @@ def drubs(args):
       args.nodes = env.config['nodes'].keys()
 
     check_config_requirements_per_node(args.nodes)
+    env.requested_nodes = args.nodes
+
+    # Locking only resolves the make file; no connection to the node is needed.
+    if args.action == 'lock':
+      drubs_lock(args.nodes[0])
+      exit(0)
+
+    # Backups of several nodes are scheduled by drubs itself.
+    if args.action == 'backup' and len(args.nodes) > 1:
+      tasks.backup_nodes(args.nodes)
+      exit(0)
+
+    # Syncs stream between two nodes through drubs itself.
+    if args.action == 'sync':
+      tasks.sync_nodes(args.nodes[0], args.nodes[1])
+      exit(0)
 
     # Build/set fabric host strings.
     hosts = get_fabric_hosts(args.nodes)
@@ -169,6 +209,37 @@ def drubs(args):
     execute(getattr(tasks, args.action), hosts=hosts)
 
 
+def drubs_lock(node):
+  '''
+  Resolves a node's make file into a fully pinned lockfile.
+
+  Every drupal.org project is resolved to an exact release, recording its
+  version, type, download url and checksum.  The lockfile is written next to
+  the make file (as '<make_file>.lock') and should be committed with it.  While
+  the lockfile exists and is current, Node.make() builds from it instead of the
+  make file, without any release metadata lookups.
+  '''
+  make_file = join(env.config_dir, env.config['nodes'][node]['make_file'])
+  lock_file = makefile.lock_file_name(make_file)
+  if not isfile(make_file):
+    print(red("Make file '%s' does not exist or could not be read. Exiting..." % (make_file)))
+    exit(1)
+
+  print(cyan("Resolving project versions in '%s'..." % (make_file)))
+  try:
+    info, unlocked = makefile.lock_make_info(makefile.parse_make_file(make_file))
+  except IOError as e:
+    print(red('%s. Exiting...' % (e)))
+    exit(1)
+  makefile.write_lock_file(make_file, lock_file, info)
+
+  if unlocked:
+    print(yellow('The following projects use their own download or a dev version, and could not be locked: %s' % (
+      ', '.join(unlocked),
+    )))
+  print(green("Lockfile '%s' written." % (lock_file)))
+
+
 def drubs_init(args):
   '''
   Stubs out project configuration files.
@@ -222,6 +293,16 @@ def drubs_init(args):
       backup_directory = "",
       backup_lifetime_days = "30",
       backup_minimum_count = "3",
+      backup_mode = 'archive',
+      backup_base_days = '7',
+      replicate_to = '',
+      replicate_concurrency = '4',
+      replicate_bandwidth_kbps = '0',
+      verify_concurrency = '4',
+      backup_nice = '10',
+      backup_ionice = '-c 2 -n 7',
+      backup_write_mbps = '0',
+      sync_sanitize_file = '',
       server_host = '',
       site_root = '',
       server_user = '',
@@ -233,6 +314,19 @@ def drubs_init(args):
       account_mail = '',
       make_file = '%s.make' % (node),
       py_file =  '%s.py' % (node),
+      drubs_command = 'drubs',
+      package_cache_dir = '',
+      package_cache_size_mb = '4096',
+      shared_build_dir = '',
+      site_url = '',
+      warmup_urls = '',
+      warmup_sitemap = '',
+      warmup_concurrency = '4',
+      warmup_address = '',
+      benchmark_urls = '',
+      benchmark_requests = '5',
+      benchmark_threshold = '1.5',
+      install_snapshot = 'off',
     )
   data = dict(
     nodes = node_output,
@@ -0,0 +1,473 @@
+import errno
+import fcntl
+import os
+import time
+import shutil
+import stat
+import subprocess
+from itertools import count
+from re import search
+from functools import wraps
+from fabric.api import hide
+from fabric.utils import abort
+from os.path import join, isdir, islink, lexists, basename
+
+
+# The Linux ioctl for cloning a file's extents (a reflink), see ioctl_ficlone(2).
+FICLONE = 0x40049409
+
+# Numbers the paths moved to the trash by this process, see trash_name().
+_trash_counter = count()
+
+
+def aborts_on_error(method):
+  '''
+  Makes a failed local file operation abort, as a failed shell command does.
+  '''
+  @wraps(method)
+  def wrapper(self, *args, **kwargs):
+    try:
+      return method(self, *args, **kwargs)
+    except (OSError, IOError) as e:
+      abort('%s failed: %s' % (method.__name__, e))
+  return wrapper
+
+
+class RemoteFiles(object):
+  '''
+  File operations on a remote node, performed with shell commands.
+  '''
+
+  def __init__(self, node):
+    self.node = node
+
+
+  def mkdir(self, path):
+    self.node.drubs_run('mkdir -p %s' % (path))
+
+
+  def copy_file(self, source, destination):
+    self.node.drubs_run('cp %s %s' % (source, destination))
+
+
+  def copy_tree(self, source, destination, hardlink=False, overwrite=True):
+    self.node.drubs_run('cp -R%s%s %s/. %s/' % ('lP' if hardlink else '', '' if overwrite else 'n', source, destination))
+
+
+  def link_tree(self, source, destination):
+    # Hardlinks fail across filesystems; fall back to copying.  -P keeps
+    # symlinks as symlinks, as cp -R does (cp -l alone follows them).
+    self.node.drubs_run('cp -RlP %s %s 2>/dev/null || { rm -rf %s; cp -R %s %s; }' % (
+      source,
+      destination,
+      destination,
+      source,
+      destination,
+    ))
+
+
+  def list(self, path):
+    with hide('running', 'stdout'):
+      result = self.node.drubs_run('ls -A %s 2>/dev/null || true' % (path), capture=True, query=True)
+    return result.split()
+
+
+  def move(self, source, destination):
+    self.node.drubs_run('mv %s %s' % (source, destination))
+
+
+  def touch(self, path):
+    self.node.drubs_run('touch %s' % (path))
+
+
+  def remove(self, path, force=False):
+    if force:
+      # Only directories are made writable: files may be hardlinks into a
+      # shared build, whose modes must not change.
+      self.node.drubs_run('find %s -type d -exec chmod u+w {} +' % (path))
+    self.node.drubs_run('rm -rf %s' % (path))
+
+
+  def remove_children(self, path, keep=()):
+    # Missing directories are ignored, as by LocalFiles.
+    grep = ''.join(' | grep -v "%s"' % (name) for name in keep)
+    self.node.drubs_run('if [ -d %s ]; then cd %s && ls -A%s | xargs rm -rf; fi' % (path, path, grep))
+
+
+  def discard(self, path, trash):
+    '''
+    Removes a directory tree by moving it to 'trash' and deleting it there in
+    the background, see purge_command().  Trees which cannot be moved (to
+    another filesystem, for example) are removed in place, as by remove().
+    Missing paths are ignored.
+    '''
+    self.node.drubs_run(
+      'if [ ! -e %s ]; then true; '
+      'elif %s && mv -T %s %s/%s 2>/dev/null; then %s; '
+      'else find %s -type d -exec chmod u+w {} + && rm -rf %s; fi' % (
+        path,
+        trash_usable_test(path, trash),
+        path,
+        trash,
+        trash_name(basename(path.rstrip('/'))),
+        background_command(purge_command(trash)),
+        path,
+        path,
+      )
+    )
+
+
+  def discard_children(self, path, trash, keep=()):
+    '''
+    Empties a directory (except for the names in 'keep') like remove_children(),
+    moving its contents to 'trash' to be deleted in the background.  Missing
+    directories are ignored.
+    '''
+    children = 'find %s -mindepth 1 -maxdepth 1%s' % (path, ''.join(" ! -name '%s'" % (name) for name in keep))
+    self.node.drubs_run(
+      'if [ ! -d %s ]; then true; '
+      'elif %s; then %s -exec sh -c \'for f; do mv -T "$f" "$0-${f##*/}" 2>/dev/null || rm -rf "$f"; done\' %s/%s {} + && %s; '
+      'else %s -exec rm -rf {} +; fi' % (
+        path,
+        trash_usable_test(path, trash),
+        children,
+        trash,
+        trash_name(''),
+        background_command(purge_command(trash)),
+        children,
+      )
+    )
+
+
+  def remove_matching(self, path, pattern, exclude):
+    self.node.drubs_run('cd %s && ls | grep %s | grep -v "%s" | xargs rm -rf' % (path, pattern, exclude))
+
+
+  def chmod(self, path, mode, recursive=False):
+    self.node.drubs_run('chmod %s%s %s' % ('-R ' if recursive else '', mode, path))
+
+
+  def make_read_only(self, path):
+    self.node.drubs_run('find %s -type f -exec chmod a-w {} +' % (path))
+
+
+class LocalFiles(object):
+  '''
+  File operations on the local machine, performed in-process.
+
+  Equivalent to RemoteFiles, but without forking a shell for every operation.
+  Trees are copied using hardlinks or reflinks where possible.
+  '''
+
+  def __init__(self, node):
+    self.node = node
+
+
+  def planned(self, description):
+    '''
+    Prints, rather than performs, an operation when planning (--plan).
+    '''
+    if self.node.env.plan_only:
+      self.node.print_planned_command(description, cwd=False)
+      return True
+    return False
+
+
+  @aborts_on_error
+  def mkdir(self, path):
+    if self.planned('mkdir -p %s' % (path)):
+      return
+    try:
+      os.makedirs(path)
+    except OSError as e:
+      if e.errno != errno.EEXIST or not isdir(path):
+        raise
+
+
+  @aborts_on_error
+  def copy_file(self, source, destination):
+    if self.planned('cp %s %s' % (source, destination)):
+      return
+    shutil.copyfile(source, destination)
+
+
+  @aborts_on_error
+  def copy_tree(self, source, destination, hardlink=False, overwrite=True):
+    '''
+    Copies the contents of a directory tree into another directory.
+
+    Files are hardlinked if 'hardlink' is set, otherwise reflinked (on
+    filesystems which support it) and copied only as a last resort.  Symlinks
+    are copied as symlinks.  Existing files are kept unless 'overwrite' is set.
+    '''
+    if self.planned('cp -R%s%s %s/. %s/' % ('lP' if hardlink else '', '' if overwrite else 'n', source, destination)):
+      return
+    for path, dirs, names in os.walk(source):
+      target = join(destination, path[len(source):].lstrip('/'))
+      self.mkdir(target)
+      shutil.copymode(path, target)
+      for name in dirs:
+        if islink(join(path, name)):
+          self.copy_link(join(path, name), join(target, name))
+      for name in names:
+        if not overwrite and lexists(join(target, name)):
+          continue
+        if islink(join(path, name)):
+          self.copy_link(join(path, name), join(target, name))
+        else:
+          clone_file(join(path, name), join(target, name), hardlink)
+
+
+  def copy_link(self, source, destination):
+    if lexists(destination):
+      os.remove(destination)
+    os.symlink(os.readlink(source), destination)
+
+
+  @aborts_on_error
+  def link_tree(self, source, destination):
+    '''
+    Hardlinks a file or directory tree to a new path (copying where hardlinks
+    are not possible).
+    '''
+    if self.planned('cp -RlP %s %s' % (source, destination)):
+      return
+    if islink(source):
+      self.copy_link(source, destination)
+    elif isdir(source):
+      self.copy_tree(source, destination, hardlink=True)
+    else:
+      clone_file(source, destination, hardlink=True)
+
+
+  def list(self, path):
+    if not isdir(path):
+      return list()
+    return os.listdir(path)
+
+
+  @aborts_on_error
+  def move(self, source, destination):
+    if self.planned('mv %s %s' % (source, destination)):
+      return
+    os.rename(source, destination)
+
+
+  @aborts_on_error
+  def touch(self, path):
+    if self.planned('touch %s' % (path)):
+      return
+    if lexists(path):
+      os.utime(path, None)
+    else:
+      open(path, 'a').close()
+
+
+  @aborts_on_error
+  def remove(self, path, force=False):
+    if self.planned('rm -rf %s' % (path)):
+      return
+    remove_path(path)
+
+
+  @aborts_on_error
+  def remove_children(self, path, keep=()):
+    if self.planned('rm -rf %s/* (except %s)' % (path, ', '.join(keep))):
+      return
+    if not isdir(path):
+      return
+    for name in os.listdir(path):
+      if name not in keep:
+        remove_path(join(path, name))
+
+
+  @aborts_on_error
+  def discard(self, path, trash):
+    '''
+    Removes a directory tree by moving it to 'trash' and deleting it there in
+    the background, see purge_command().
+    '''
+    if self.planned('mv %s %s/ (deleted in the background)' % (path, trash)):
+      return
+    if move_to_trash(path, trash):
+      purge_trash(trash)
+
+
+  @aborts_on_error
+  def discard_children(self, path, trash, keep=()):
+    '''
+    Empties a directory (except for the names in 'keep') like remove_children(),
+    moving its contents to 'trash' to be deleted in the background.
+    '''
+    if self.planned('mv %s/* %s/ (except %s; deleted in the background)' % (path, trash, ', '.join(keep))):
+      return
+    if not isdir(path):
+      return
+    moved = False
+    for name in os.listdir(path):
+      if name not in keep:
+        moved = move_to_trash(join(path, name), trash) or moved
+    if moved:
+      purge_trash(trash)
+
+
+  @aborts_on_error
+  def remove_matching(self, path, pattern, exclude):
+    if self.planned('rm -rf %s/*%s* (except *%s*)' % (path, pattern, exclude)):
+      return
+    for name in os.listdir(path):
+      if name.startswith('.'):
+        continue
+      if search(pattern, name) and not search(exclude, name):
+        remove_path(join(path, name))
+
+
+  @aborts_on_error
+  def chmod(self, path, mode, recursive=False):
+    if self.planned('chmod %s%s %s' % ('-R ' if recursive else '', mode, path)):
+      return
+    paths = [path]
+    if recursive:
+      for root, dirs, names in os.walk(path):
+        paths.extend(join(root, name) for name in dirs + names if not islink(join(root, name)))
+    for target in paths:
+      if mode == 'u+w':
+        os.chmod(target, os.stat(target).st_mode | stat.S_IWUSR)
+      else:
+        os.chmod(target, int(mode, 8))
+
+
+  @aborts_on_error
+  def make_read_only(self, path):
+    '''
+    Removes write permission from every file (not directory) in a tree.
+    '''
+    if self.planned('find %s -type f -exec chmod a-w {} +' % (path)):
+      return
+    for root, dirs, names in os.walk(path):
+      for name in names:
+        if not islink(join(root, name)):
+          mode = os.stat(join(root, name)).st_mode
+          os.chmod(join(root, name), mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def clone_file(source, destination, hardlink=False):
+  '''
+  Copies a file as cheaply as the filesystem allows.
+
+  Tries a hardlink (if allowed), then a reflink, then falls back to a regular
+  copy.
+  '''
+  if lexists(destination):
+    os.remove(destination)
+  if hardlink:
+    try:
+      os.link(source, destination)
+      return
+    except OSError:
+      pass
+  try:
+    with open(source, 'rb') as src:
+      with open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, destination)
+    return
+  except (IOError, OSError):
+    pass
+  shutil.copy2(source, destination)
+
+
+def remove_path(path):
+  '''
+  Removes a file or directory tree, making directories writable as needed
+  (like 'chmod -R u+w' followed by 'rm -rf').  Missing paths are ignored.
+  '''
+  if islink(path) or (lexists(path) and not isdir(path)):
+    os.remove(path)
+  elif isdir(path):
+    try:
+      shutil.rmtree(path)
+    except OSError:
+      make_tree_writable(path)
+      shutil.rmtree(path)
+
+
+def make_tree_writable(path):
+  '''
+  Gives the owner full access to every directory in a tree.
+  '''
+  os.chmod(path, os.stat(path).st_mode | stat.S_IRWXU)
+  for root, dirs, names in os.walk(path):
+    for name in dirs:
+      if not islink(join(root, name)):
+        os.chmod(join(root, name), os.stat(join(root, name)).st_mode | stat.S_IRWXU)
+
+
+def trash_name(name):
+  '''
+  Returns a name, unique to this process, for a path moved to the trash.
+  '''
+  return '%s-%d-%d%s' % (time.strftime('%Y%m%d%H%M%S'), os.getpid(), next(_trash_counter), '-' + name if name else '')
+
+
+def trash_usable_test(path, trash):
+  '''
+  Returns a shell test for whether paths can be moved from 'path' to 'trash' by
+  renaming them: the trash exists (or can be created) on the same filesystem.
+  '''
+  return 'mkdir -p %s 2>/dev/null && [ "$(stat -c %%d %s)" = "$(stat -c %%d %s)" ]' % (trash, path, trash)
+
+
+def purge_command(trash):
+  '''
+  Returns a shell command deleting everything in a trash directory at the
+  lowest CPU and IO priority.
+
+  Every purge empties the whole trash, so anything left there by an earlier,
+  interrupted purge is deleted too.  Only directories are made writable: files
+  may be hardlinks into a shared build, whose modes must not change.
+  '''
+  return "nice -n 19 sh -c 'ionice -c 3 -p $$ 2>/dev/null; find %s -mindepth 1 -type d ! -perm -u+w -exec chmod u+w {} + 2>/dev/null; rm -rf %s/*'" % (trash, trash)
+
+
+def background_command(command):
+  '''
+  Returns a shell command starting 'command' detached from the session, so
+  that it keeps running once drubs (or its SSH connection) exits.
+  '''
+  return '(setsid nohup %s >/dev/null 2>&1 </dev/null &)' % (command)
+
+
+def move_to_trash(path, trash):
+  '''
+  Moves a local path to the trash (created as needed) by renaming it.  Paths
+  which cannot be renamed there are removed in place.  Missing paths are
+  ignored.  Returns whether the path was moved.
+  '''
+  if not lexists(path):
+    return False
+  try:
+    if not isdir(trash):
+      os.makedirs(trash)
+    os.rename(path, join(trash, trash_name(basename(path.rstrip('/')))))
+    return True
+  except OSError:
+    remove_path(path)
+    return False
+
+
+def purge_trash(trash):
+  '''
+  Starts deleting everything in a local trash directory, in a process which
+  outlives drubs.
+  '''
+  with open(os.devnull, 'r+') as devnull:
+    subprocess.Popen(
+      purge_command(trash),
+      shell=True,
+      stdin=devnull,
+      stdout=devnull,
+      stderr=devnull,
+      close_fds=True,
+      preexec_fn=os.setsid,
+    )
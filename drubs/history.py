@@ -0,0 +1,103 @@
+import sqlite3
+from os import makedirs, getpid
+from os.path import dirname, isdir, join
+
+
+def history_file(config_dir):
+  '''
+  Returns the path of the step history database for a project.
+  '''
+  return join(config_dir, '.drubs', 'history.sqlite')
+
+
+class History(object):
+  '''
+  Records the duration of each step run on each node, in a local SQLite
+  database, and estimates future step durations from them.
+  '''
+
+  # Number of most recent successful runs an estimate is based on.
+  SAMPLE_SIZE = 10
+
+  def __init__(self, path):
+    self.path = path
+    self.connection = None
+    self.pid = None
+
+
+  def connect(self):
+    # SQLite connections must not be shared with forked processes (see
+    # TaskGraph), which open their own.
+    if self.pid != getpid():
+      self.connection = None
+      self.pid = getpid()
+    if self.connection is None:
+      if not isdir(dirname(self.path)):
+        makedirs(dirname(self.path))
+      self.connection = sqlite3.connect(self.path)
+      self.connection.execute('''
+        CREATE TABLE IF NOT EXISTS step_runs (
+          node TEXT NOT NULL,
+          action TEXT NOT NULL,
+          step TEXT NOT NULL,
+          started REAL NOT NULL,
+          duration REAL NOT NULL,
+          success INTEGER NOT NULL
+        )
+      ''')
+      self.connection.execute('CREATE INDEX IF NOT EXISTS step_runs_node_step ON step_runs (node, step, started)')
+    return self.connection
+
+
+  def record(self, node, action, step, started, duration, success):
+    '''
+    Records one run of a step on a node.
+    '''
+    connection = self.connect()
+    with connection:
+      connection.execute(
+        'INSERT INTO step_runs (node, action, step, started, duration, success) VALUES (?, ?, ?, ?, ?, ?)',
+        (node, action, step, started, duration, int(bool(success))),
+      )
+
+
+  def runs_since(self, node, steps, started):
+    '''
+    Returns (step, duration, success) for the runs of the named steps on a node
+    started at or after 'started', oldest first.
+    '''
+    return self.connect().execute(
+      'SELECT step, duration, success FROM step_runs WHERE node = ? AND started >= ? AND step IN (%s) ORDER BY started' % (
+        ', '.join('?' for step in steps),
+      ),
+      [node, started] + list(steps),
+    ).fetchall()
+
+
+  def estimate(self, node, step):
+    '''
+    Returns the expected duration of a step on a node in seconds, or None if
+    the step has never completed successfully on the node.
+
+    The estimate is the median of the most recent successful runs.
+    '''
+    rows = self.connect().execute(
+      'SELECT duration FROM step_runs WHERE node = ? AND step = ? AND success = 1 ORDER BY started DESC LIMIT ?',
+      (node, step, self.SAMPLE_SIZE),
+    ).fetchall()
+    if not rows:
+      return None
+    durations = sorted(row[0] for row in rows)
+    middle = len(durations) // 2
+    if len(durations) % 2:
+      return durations[middle]
+    return (durations[middle - 1] + durations[middle]) / 2.0
+
+
+def format_duration(seconds):
+  '''
+  Formats a duration in seconds as used by Node.print_elapsed_time().
+  '''
+  m, s = divmod(seconds, 60)
+  h, m = divmod(m, 60)
+  return '%dh:%02dm:%02ds' % (h, m, s)
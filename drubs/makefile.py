@@ -0,0 +1,445 @@
+import urllib2
+from re import compile, split, search, VERBOSE, MULTILINE
+from os.path import basename
+from hashlib import sha256
+from collections import OrderedDict
+from xml.etree import ElementTree
+
+
+RELEASE_HISTORY_URL = 'https://updates.drupal.org/release-history/%s/%s'
+
+# Maps the project <type> reported by drupal.org release history to the
+# project 'type' understood by drush make.
+PROJECT_TYPES = {
+  'project_core': 'core',
+  'project_module': 'module',
+  'project_theme': 'theme',
+  'project_distribution': 'profile',
+  'project_theme_engine': 'theme_engine',
+  'project_translation': 'translation',
+}
+
+# A port of the info file parser used by drush make (drupal_parse_info_format).
+MAKE_LINE = compile(r'''
+  ^\s*
+  ((?:[^=;\[\]]|\[[^\[\]]*\])+?)
+  \s*=\s*
+  (?:
+    ("(?:[^"]|(?<=\\)")*")|
+    ('(?:[^']|(?<=\\)')*')|
+    ([^\r\n]*?)
+  )\s*$
+''', VERBOSE | MULTILINE)
+
+
+def parse_make_file(make_file):
+  '''
+  Parses a drush make file into a (nested) OrderedDict.
+  '''
+  with open(make_file, 'r') as stream:
+    return parse_make_string(stream.read())
+
+
+def parse_make_string(data):
+  '''
+  Parses the contents of a drush make file into a (nested) OrderedDict.
+  '''
+  info = OrderedDict()
+  for match in MAKE_LINE.finditer(data):
+    key, double, single, bare = match.groups()
+    if double:
+      value = double[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    elif single:
+      value = single[1:-1].replace("\\'", "'").replace('\\\\', '\\')
+    else:
+      value = bare or ''
+    keys = split(r'\]?\[', key.rstrip(']'))
+    last = keys.pop()
+    parent = info
+    for k in keys:
+      if k == '':
+        k = str(len(parent))
+      if not isinstance(parent.get(k), dict):
+        parent[k] = OrderedDict()
+      parent = parent[k]
+    if last == '':
+      last = str(len(parent))
+    parent[last] = value
+  return info
+
+
+def dump_make_string(info, prefix=None):
+  '''
+  Serializes a (nested) dict, as returned by parse_make_string(), back into
+  drush make file syntax.
+  '''
+  lines = list()
+  for key, value in info.items():
+    name = key if prefix is None else '%s[%s]' % (prefix, key)
+    if isinstance(value, dict):
+      lines.extend(dump_make_string(value, name).splitlines())
+    else:
+      lines.append('%s = "%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"')))
+  return '\n'.join(lines) + '\n'
+
+
+def get_projects(info):
+  '''
+  Returns an OrderedDict of project name => project spec (a dict).
+
+  Normalizes the shorthand forms allowed by drush make:
+
+    projects[] = views
+    projects[views] = 3.11
+    projects[views][version] = 3.11
+  '''
+  projects = OrderedDict()
+  for key, spec in info.get('projects', {}).items():
+    if isinstance(spec, dict):
+      projects[key] = OrderedDict(spec)
+    elif key.isdigit():
+      projects[spec] = OrderedDict()
+    else:
+      projects[key] = OrderedDict([('version', spec)])
+  return projects
+
+
+def set_projects(info, projects):
+  '''
+  Returns a copy of make file info with its projects replaced.
+  '''
+  info = OrderedDict(info)
+  info['projects'] = projects
+  return info
+
+
+def full_version(name, core, version):
+  '''
+  Returns a project version as drupal.org names it.
+
+  Contrib versions are prefixed with the core version, for example ('views',
+  '7.x', '3.11') returns '7.x-3.11'.  Drupal core versions are returned as-is.
+  '''
+  if name == 'drupal' or version.startswith(core + '-'):
+    return version
+  return '%s-%s' % (core, version)
+
+
+def is_pinned(name, spec):
+  '''
+  Determines whether a project spec refers to one exact drupal.org release.
+  '''
+  if 'download' in spec:
+    return False
+  version = spec.get('version', '')
+  if not version or version.endswith('.x') or version.endswith('-dev'):
+    return False
+  return True
+
+
+def release_history(name, core):
+  '''
+  Fetches and parses drupal.org release history for a project.
+
+  Returns a dict containing the project's drush make 'type', and 'releases': a
+  list of dicts (version, download_link, mdhash, status, version_major,
+  version_extra) ordered newest first, as published.
+  '''
+  url = RELEASE_HISTORY_URL % (name, core)
+  try:
+    tree = ElementTree.parse(urllib2.urlopen(url, timeout=60))
+  except (IOError, ElementTree.ParseError) as e:
+    raise IOError("Could not retrieve release history for '%s' from %s (%s)" % (name, url, e))
+  root = tree.getroot()
+  if root.find('releases') is None:
+    raise IOError("No release history available for '%s' from %s" % (name, url))
+  history = dict(
+    type = PROJECT_TYPES.get(root.findtext('type', ''), 'module'),
+    recommended_major = root.findtext('recommended_major', ''),
+    releases = list(),
+  )
+  for release in root.find('releases').findall('release'):
+    history['releases'].append(dict(
+      version = release.findtext('version', ''),
+      version_major = release.findtext('version_major', ''),
+      version_extra = release.findtext('version_extra', ''),
+      download_link = release.findtext('download_link', ''),
+      mdhash = release.findtext('mdhash', ''),
+      status = release.findtext('status', ''),
+    ))
+  return history
+
+
+def find_release(history, version):
+  '''
+  Returns the release matching an exact version from release history, or None.
+  '''
+  for release in history['releases']:
+    if release['version'] == version:
+      return release
+  return None
+
+
+def resolve_release(history, name, core, version):
+  '''
+  Resolves a make file version specification to a single published release.
+
+  Handles exact versions ('3.11', '7.x-3.11'), major versions ('3.x') and
+  unspecified versions (the recommended major version).  Stable releases are
+  preferred over alpha/beta/rc releases; dev releases are never chosen.
+  Returns None if no release matches.
+  '''
+  if version and not version.endswith('.x'):
+    return find_release(history, full_version(name, core, version))
+  if version:
+    major = version[:-2].split('-')[-1]
+  else:
+    major = history['recommended_major']
+  candidates = [
+    release for release in history['releases']
+    if release['version_major'] == major
+    and release['status'] == 'published'
+    and not release['version_extra'].startswith('dev')
+  ]
+  for release in candidates:
+    if not release['version_extra']:
+      return release
+  return candidates[0] if candidates else None
+
+
+def is_locked(spec):
+  '''
+  Determines whether a project spec is fully pinned by 'drubs lock'.
+  '''
+  download = spec.get('download', {})
+  return bool(
+    spec.get('version')
+    and spec.get('type')
+    and isinstance(download, dict)
+    and download.get('type') == 'file'
+    and download.get('url')
+    and download.get('md5')
+  )
+
+
+def lock_make_info(info):
+  '''
+  Resolves every drupal.org project in make file info to an exact release.
+
+  Returns a tuple of (locked info, list of project names left unlocked).  Each
+  locked project records its exact version, project type, download url and
+  md5 checksum, so it can be built without any release metadata lookups.
+  Projects with their own download (git, etc.) and dev versions are left as
+  they are.
+  '''
+  core = info.get('core', '')
+  projects = get_projects(info)
+  unlocked = list()
+  for name, spec in projects.items():
+    version = spec.get('version', '')
+    if 'download' in spec or version.endswith('-dev'):
+      unlocked.append(name)
+      continue
+    history = release_history(name, core)
+    release = resolve_release(history, name, core, version)
+    if release is None:
+      raise IOError("No release of '%s' matches version '%s'" % (name, version or 'recommended'))
+    locked = OrderedDict((k, v) for k, v in spec.items() if k not in ('version', 'type'))
+    locked['version'] = release['version']
+    locked['type'] = spec.get('type', history['type'])
+    locked['download'] = OrderedDict([
+      ('type', 'file'),
+      ('url', release['download_link']),
+      ('md5', release['mdhash']),
+    ])
+    projects[name] = locked
+  return set_projects(info, projects), unlocked
+
+
+def drush_make_info(info):
+  '''
+  Returns a copy of make file info, suitable for passing to drush make.
+
+  The informational 'version' of locked projects is removed, so that drush
+  make only uses the pinned download.
+  '''
+  projects = get_projects(info)
+  for name, spec in projects.items():
+    if is_locked(spec):
+      del spec['version']
+  return set_projects(info, projects)
+
+
+def is_fixed(name, spec):
+  '''
+  Determines whether a project or library spec always downloads the same code:
+  an exact release, or a download pinned to a checksum, revision or tag.
+  '''
+  if is_locked(spec) or is_pinned(name, spec):
+    return True
+  download = spec.get('download', {})
+  return isinstance(download, dict) and bool(
+    download.get('md5') or download.get('revision') or download.get('tag')
+  )
+
+
+def is_reproducible(info):
+  '''
+  Determines whether make file info always produces the same build.
+  '''
+  libraries = info.get('libraries', {})
+  for name, spec in get_projects(info).items() + libraries.items():
+    if not isinstance(spec, dict) or not is_fixed(name, spec):
+      return False
+  return True
+
+
+def build_fingerprint(info, options=''):
+  '''
+  Returns a short checksum identifying the build of make file info by drush
+  make with the given options.
+  '''
+  return sha256(dump_make_string(info) + options).hexdigest()[:16]
+
+
+def lock_file_name(make_file):
+  '''
+  Returns the name of the lockfile for a make file.
+  '''
+  return make_file + '.lock'
+
+
+def file_checksum(path):
+  '''
+  Returns the sha256 checksum of a file's contents.
+  '''
+  with open(path, 'rb') as stream:
+    return sha256(stream.read()).hexdigest()
+
+
+def write_lock_file(make_file, lock_file, info):
+  '''
+  Writes locked make file info, recording the checksum of its source make file.
+  '''
+  with open(lock_file, 'w') as stream:
+    stream.write("; Generated by 'drubs lock' from %s.  Do not edit.\n" % (basename(make_file)))
+    stream.write('; source-sha256: %s\n\n' % (file_checksum(make_file)))
+    stream.write(dump_make_string(info))
+
+
+def lock_file_source_checksum(lock_file):
+  '''
+  Returns the checksum of the make file a lockfile was generated from.
+  '''
+  with open(lock_file, 'r') as stream:
+    match = search(r'^; source-sha256: ([0-9a-f]{64})$', stream.read(), MULTILINE)
+  return match.group(1) if match else None
+
+
+def build_entries(info):
+  '''
+  Returns an OrderedDict of the projects (other than core) and libraries in
+  make file info, keyed 'projects/<name>' or 'libraries/<name>', each mapped to
+  (checksum of its spec, whether it always downloads the same code).
+  '''
+  entries = OrderedDict()
+  for name, spec in get_projects(info).items():
+    if name != 'drupal':
+      entries['projects/' + name] = (sha256(dump_make_string(spec)).hexdigest()[:16], is_fixed(name, spec))
+  for name, spec in info.get('libraries', {}).items():
+    spec = spec if isinstance(spec, dict) else OrderedDict()
+    entries['libraries/' + name] = (sha256(dump_make_string(spec)).hexdigest()[:16], is_fixed(name, spec))
+  return entries
+
+
+def base_fingerprint(info, options=''):
+  '''
+  Returns a short checksum of everything in make file info which affects every
+  project: core and its version, defaults, includes, and the drush make
+  options.
+  '''
+  base = OrderedDict((key, value) for key, value in info.items() if key not in ('projects', 'libraries'))
+  base['drupal'] = get_projects(info).get('drupal', OrderedDict())
+  return sha256(dump_make_string(base) + options).hexdigest()[:16]
+
+
+def build_manifest(info, options, paths):
+  '''
+  Returns the manifest of a build of make file info: its base fingerprint, and
+  the checksum and path (relative to sites/all, see project_paths()) of each
+  project and library.
+  '''
+  return OrderedDict([
+    ('base', base_fingerprint(info, options)),
+    ('entries', OrderedDict(
+      (key, OrderedDict([('checksum', checksum), ('path', paths.get(key))]))
+      for key, (checksum, fixed) in build_entries(info).items()
+    )),
+  ])
+
+
+def incremental_changes(manifest, info, options=''):
+  '''
+  Compares make file info with the manifest of the build on a node.
+
+  Returns a tuple of (keys of entries to build, keys of entries to remove), or
+  None if only a full build will do: there is no manifest, core, defaults or
+  options changed, the make file includes others (whose contents are not
+  tracked), or an entry to replace has no known path.  Entries which do not
+  always download the same code (dev versions, branches) are always rebuilt,
+  as a full build would.
+  '''
+  if not manifest or 'includes' in info or manifest.get('base') != base_fingerprint(info, options):
+    return None
+  built = manifest.get('entries', {})
+  entries = build_entries(info)
+  changed = [
+    key for key, (checksum, fixed) in entries.items()
+    if key not in built or built[key].get('checksum') != checksum or not fixed
+  ]
+  removed = [key for key in built if key not in entries]
+  for key in changed + removed:
+    if key in built and not built[key].get('path'):
+      return None
+  return changed, removed
+
+
+def subset_info(info, keys):
+  '''
+  Returns a copy of make file info without core, and with only the projects
+  and libraries whose keys (see build_entries()) are given.
+  '''
+  subset = OrderedDict((key, value) for key, value in info.items() if key not in ('projects', 'libraries'))
+  projects = get_projects(info)
+  subset['projects'] = OrderedDict((name, spec) for name, spec in projects.items() if 'projects/' + name in keys)
+  libraries = info.get('libraries', {})
+  subset['libraries'] = OrderedDict((name, spec) for name, spec in libraries.items() if 'libraries/' + name in keys)
+  return subset
+
+
+def project_paths(info, keys, info_files):
+  '''
+  Returns the paths (relative to sites/all) of built projects and libraries.
+
+  Libraries are built into their 'destination' (by default 'libraries'),
+  named after their 'directory_name' (by default the library name).  Projects
+  are found by their .info (or .info.yml) file, as listed by 'find' in
+  sites/all: the shallowest one named after the project.
+  '''
+  found = dict()
+  for path in sorted(info_files.split(), key=lambda path: (path.count('/'), path)):
+    path = path[2:] if path.startswith('./') else path
+    name = basename(path).split('.info')[0]
+    if '/' in path and name not in found:
+      found[name] = path.rsplit('/', 1)[0]
+  libraries = info.get('libraries', {})
+  paths = dict()
+  for key in keys:
+    kind, name = key.split('/', 1)
+    if kind == 'libraries':
+      spec = libraries.get(name)
+      spec = spec if isinstance(spec, dict) else dict()
+      paths[key] = '%s/%s' % (spec.get('destination', 'libraries'), spec.get('directory_name', name))
+    elif name in found:
+      paths[key] = found[name]
+  return paths
@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import fcntl
+import multiprocessing
+from collections import OrderedDict
+from os.path import join, isfile, isdir, dirname
+
+
+# The metrics of the latest run of each action on each node, in the Prometheus
+# text format (for node_exporter's textfile collector), and of every run, as
+# JSON lines.  Both are written next to the project config file.
+PROMETHEUS_FILE = 'drubs_metrics.prom'
+JSON_LINES_FILE = 'drubs_metrics.jsonl'
+
+# gzip records uncompressed sizes modulo 4 GiB, so compression ratios are only
+# known for backups smaller than this.
+GZIP_SIZE_LIMIT = 4 * 1024 * 1024 * 1024
+
+# Metrics written for the latest run of each action on each node: name, help
+# text, and the key of the run's record holding the value.
+ACTION_METRICS = (
+  ('drubs_action_success', 'Whether the latest run of the action succeeded (1) or failed (0).', 'success'),
+  ('drubs_action_duration_seconds', 'Duration of the latest run of the action.', 'duration'),
+  ('drubs_action_last_run_timestamp_seconds', 'When the latest run of the action started.', 'started'),
+  ('drubs_action_commands', 'Number of commands the latest run of the action issued.', 'commands'),
+  ('drubs_action_failed_commands', 'Number of commands which failed in the latest run of the action.', 'failed_commands'),
+  ('drubs_backup_bytes', 'Size of the backup created by the latest run of the action.', 'backup_bytes'),
+  ('drubs_backup_uncompressed_bytes', 'Uncompressed size of the backup created by the latest run of the action.', 'backup_uncompressed_bytes'),
+  ('drubs_backup_compression_ratio', 'Uncompressed size divided by size of the backup created by the latest run of the action.', 'backup_compression_ratio'),
+  ('drubs_restore_duration_seconds', 'Duration of the backup restore in the latest run of the action.', 'restore_duration'),
+)
+
+
+class Metrics(object):
+  '''
+  Collects the metrics of one run of an action on a node: the duration and
+  outcome of each phase (plan step), the commands issued, and values such as
+  backup sizes.
+  '''
+
+  def __init__(self, node, action, started=None):
+    self.node = node
+    self.action = action
+    self.started = started or time.time()
+    self.phases = OrderedDict()
+    self.commands = 0
+    self.failed_commands = 0
+    self.values = dict()
+
+
+  def phase(self, name, duration, success):
+    '''
+    Records a phase.  Phases run more than once in an action (make, for
+    example) add up.
+    '''
+    previous = self.phases.get(name, dict(duration=0, success=True))
+    self.phases[name] = dict(duration=previous['duration'] + duration, success=previous['success'] and bool(success))
+
+
+  def command(self, succeeded):
+    self.commands += 1
+    if not succeeded:
+      self.failed_commands += 1
+
+
+  def set(self, name, value):
+    self.values[name] = value
+
+
+  def share(self):
+    '''
+    Returns a stand-in for these metrics in the processes of concurrent steps
+    (see Node.run_concurrently()), whose commands are added by collect().
+    '''
+    return SharedMetrics(self.node, self.action, self.started)
+
+
+  def collect(self, shared):
+    self.commands += shared.counts[0]
+    self.failed_commands += shared.counts[1]
+
+
+  def record(self, success, now=None):
+    '''
+    Returns the metrics of the run as a dict, for write_metrics().  The run
+    failed if any of its phases did, even if the action recovered from it (by
+    restoring a backup, for example).
+    '''
+    now = now or time.time()
+    record = dict(
+      node=self.node,
+      action=self.action,
+      started=round(self.started, 3),
+      duration=round(now - self.started, 3),
+      success=bool(success) and all(phase['success'] for phase in self.phases.values()),
+      commands=self.commands,
+      failed_commands=self.failed_commands,
+      phases=OrderedDict((name, dict(duration=round(phase['duration'], 3), success=phase['success'])) for name, phase in self.phases.items()),
+    )
+    record.update(self.values)
+    return record
+
+
+class SharedMetrics(Metrics):
+  '''
+  Counts commands in shared memory, see Metrics.share().  Phases are read back
+  from the step history instead.
+  '''
+
+  def __init__(self, node, action, started=None):
+    Metrics.__init__(self, node, action, started)
+    # Commands, and failed commands.
+    self.counts = multiprocessing.Array('l', 2)
+
+
+  def command(self, succeeded):
+    with self.counts.get_lock():
+      self.counts[0] += 1
+      if not succeeded:
+        self.counts[1] += 1
+
+
+def compression_ratio(size, uncompressed_size):
+  '''
+  Returns the compression ratio of gzipped data, or None if it is not known
+  (see GZIP_SIZE_LIMIT).
+  '''
+  if not size or uncompressed_size < size or uncompressed_size >= GZIP_SIZE_LIMIT:
+    return None
+  return round(float(uncompressed_size) / size, 3)
+
+
+def escape_label(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus(records):
+  '''
+  Formats the latest record of each action on each node in the Prometheus
+  text format.
+  '''
+  lines = list()
+  records = sorted(records, key=lambda record: (record['node'], record['action']))
+  for name, help_text, key in ACTION_METRICS:
+    samples = [record for record in records if record.get(key) is not None]
+    if not samples:
+      continue
+    lines.append('# HELP %s %s' % (name, help_text))
+    lines.append('# TYPE %s gauge' % (name))
+    for record in samples:
+      lines.append('%s{node="%s",action="%s"} %s' % (name, escape_label(record['node']), escape_label(record['action']), float(record[key])))
+  lines.append('# HELP drubs_phase_duration_seconds Duration of each phase of the latest run of the action.')
+  lines.append('# TYPE drubs_phase_duration_seconds gauge')
+  for record in records:
+    for phase, values in record.get('phases', dict()).items():
+      lines.append('drubs_phase_duration_seconds{node="%s",action="%s",phase="%s"} %s' % (
+        escape_label(record['node']),
+        escape_label(record['action']),
+        escape_label(phase),
+        float(values['duration']),
+      ))
+  return '\n'.join(lines) + '\n'
+
+
+def write_metrics(config_dir, record):
+  '''
+  Appends the record of a run to the project's JSON lines file, and rewrites
+  its Prometheus file with the latest record of each action on each node.
+
+  Runs on several nodes (see TaskGraph) may finish at once; they take turns
+  through a lock file.  The Prometheus file is replaced atomically, so the
+  textfile collector never reads it half written.
+  '''
+  state_file = join(config_dir, '.drubs', 'metrics_latest.json')
+  if not isdir(dirname(state_file)):
+    os.makedirs(dirname(state_file))
+  with open(state_file + '.lock', 'w') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    with open(join(config_dir, JSON_LINES_FILE), 'a') as stream:
+      stream.write(json.dumps(record, sort_keys=True) + '\n')
+    latest = dict()
+    if isfile(state_file):
+      with open(state_file) as stream:
+        latest = json.load(stream, object_pairs_hook=OrderedDict)
+    latest['%s/%s' % (record['node'], record['action'])] = record
+    with open(state_file + '.tmp', 'w') as stream:
+      json.dump(latest, stream, indent=2)
+    os.rename(state_file + '.tmp', state_file)
+    prometheus_file = join(config_dir, PROMETHEUS_FILE)
+    with open(prometheus_file + '.tmp', 'w') as stream:
+      stream.write(format_prometheus(latest.values()))
+    os.rename(prometheus_file + '.tmp', prometheus_file)
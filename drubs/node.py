@@ -1,66 +1,126 @@
-import subprocess
 import time
 import sys
+import json
+import shutil
+import makefile
+from cache import PackageCache
 from fabric.state import env
-from fabric.operations import local, put
-from fabric.api import lcd, cd, run, task, hosts, quiet, runs_once
-from os.path import isfile, dirname, basename, normpath, splitext, exists as local_exists
-from os import getcwd
+from fabric.operations import local, _AttributeString
+from fabric.api import run, task, hosts, quiet, runs_once, settings, hide
+from os.path import isfile, isdir, isabs, join, getsize, dirname, basename, normpath, exists as local_exists
+from os import getcwd, walk, urandom, rename, utime, makedirs
+from xml.etree.ElementTree import ParseError
 from re import search
 from contextlib import contextmanager
+from itertools import groupby
+from plan import Plan, Step
+from taskgraph import TaskGraph
+from history import History, history_file, format_duration
+from metrics import Metrics, compression_ratio, write_metrics
+from progress import Progress, NoProgress
+from fileops import LocalFiles, RemoteFiles
+from webclient import WebClient, parse_sitemap, summarize, benchmark, regressions
+from binascii import hexlify
+from capture import CAPTURE_LIMIT, stream_local, stream_remote, put_file, get_file, prefix_command, open_log, remove_old_logs
+from context import NodeContext, current_context, load_config_script, local_identity
+from binlog import BASE, INCREMENT, LOG_FILE_PATTERN, LOG_POS_PATTERN, backup_name, parse_backups, restore_chain, removable_backups, log_range
+from replicate import ChunkStore, LocalPaths, SftpPaths, RateLimit, file_checksums, checksums_command, replicate_file
+from sync import SYNC_FILES_EXCLUDE, LocalCommand, RemoteCommand, Throughput, gzip_member, relay
+from verify import record_file, load_record, save_record, verify_command, parse_results, update_record, format_rate
+from sqlscript import statement_chunks, build_script, error_messages
+from snapshot import SNAPSHOT_FILES, snapshots_dir, snapshot_key, snapshot_exists, quote_string, rewrite_settings, remove_old_snapshots
 from datetime import datetime, timedelta
 from fabric.contrib.console import confirm
-from fabric.contrib.files import exists as remote_exists
 from fabric.colors import red, yellow, green, cyan
 from prettytable import PrettyTable
 from pprint import pprint
+from StringIO import StringIO
+
+
+# Builds of make files with unpinned projects are reused for this long, see
+# Node.make_shared_build().
+SHARED_BUILD_MAX_AGE_MINUTES = 60
+
+# Shared builds unused for this long are removed.
+SHARED_BUILD_LIFETIME_DAYS = 14
+
+# At most this many pages from a sitemap are requested when warming up.
+WARMUP_SITEMAP_LIMIT = 500
+
+# Latencies which grow by less than this (in seconds) are never regressions,
+# however large the relative change, see Node.benchmark_after().
+BENCHMARK_MIN_REGRESSION = 0.05
+
+# The manifest of the last build, in sites/all, see Node.make_incrementally().
+# Drupal's .htaccess denies access to files whose names start with a dot.
+MAKE_MANIFEST_FILE = '.drubs-make.json'
+
+# Number of install snapshots kept per project, see Node.save_snapshot().
+SNAPSHOT_KEEP = 3
+
+# Prefixes the structured events an agent prints, see Node.emit_event().
+AGENT_EVENT_PREFIX = 'DRUBS-EVENT '
 
 
 class Node(object):
 
-  def __init__(self, env):
+  def __new__(cls, context=None):
+    if not isinstance(context, NodeContext):
+      # py_files create a Node(env) when loaded: give them the Node of the
+      # context they are loaded for (see load_config_script()).
+      return current_context().instance
+    return object.__new__(cls)
+
+
+  def __init__(self, context):
+    if not isinstance(context, NodeContext):
+      # A Node(env) from a py_file, already initialized, see __new__().
+      return
     self.env = env
 
-    # Get server_hostname from server on which command is being run.
-    # This is done outside of fabric's usual "run" or "local" commands (because
-    # it isn't known yet at this point whether the command is being run locally
-    # or remotely).
-    output = subprocess.Popen(["hostname", "-f"], stdout=subprocess.PIPE)
-    hostname = output.stdout.read().strip()
-
-    # If the 'server_hostname' for this node, from the project.yml file
-    # is equal to the hostname from 'hostname -f' (obtained above), then set/use
-    # local commands.
-    if env.host == hostname:
-      env.host_is_local = True
-      env.cd = lcd
-      env.exists = local_exists
-    else:
-      env.host_is_local = False
-      env.cd = cd
-      env.exists = remote_exists
-      env.forward_agent = True
-
-    # Set env.files_dir, the absolute path to the project's files dir.
-    if env.host_is_local:
-      env.files_dir = env.config_dir + '/files'
+    # The state of the node this instance drives, kept off fabric's global env
+    # so that several nodes can be driven in one process.
+    self.context = context
+    context.instance = self
+
+    # File operations, performed in-process on local nodes.
+    if self.context.host_is_local:
+      self.fs = LocalFiles(self)
     else:
-      env.files_dir = '/tmp/' + env.config['project_settings']['project_name'] + '/files'
+      self.fs = RemoteFiles(self)
+
+    # Directories known to exist on the node, see ensure_directory().
+    self.directories = set()
+
+    # Durations of past steps run on each node, see run_step().
+    self.history = History(history_file(env.config_dir))
+    self.action = env.command
+
+    # Reports progress while a plan runs, see run_plan().
+    self.progress = NoProgress()
+
+    # The metrics of the action being run, see run_action().
+    self.metrics = Metrics(context.node_name, self.action, context.start_time)
 
-    # Get node name from host.
-    env.node_name = self.get_node(env.config['nodes'], env.host)
+    # Lets warm-up requests through while access to the site is disabled, see
+    # disable_apache_access() and warm_up().
+    self.warmup_token = hexlify(urandom(16))
 
-    # Set env.node, a shortcut.
-    env.node = env.config['nodes'][env.node_name]
+    # Latency statistics of the site before an update, see benchmark_before().
+    self.benchmark_baseline = None
 
-    # Start a timer, used later by print_elapsed_time().
-    env.start_time = time.time()
+    # The install snapshot key of the node, see get_snapshot_dir().
+    self.snapshot_key = None
 
-    # Append the configs directory for the specified project to the python path.
-    sys.path.append(env.config_dir)
+    # The log file all command output of this run is written to, see
+    # run_command().
+    self.log = None
+
+    # Whether pv is installed on the node, see backup_write().
+    self.pv_installed = None
 
     # Import attributes/functions from the appropriate config script.
-    self.config_script = __import__(splitext(env.node['py_file'])[0])
+    self.config_script = load_config_script(context)
 
 
   def drubs_run(self, cmd, *args, **kwargs):
@@ -79,26 +139,143 @@ class Node(object):
     local() function.  In order to capture output from local and remote commands
     branching logic based on local/remote host would have to be used.  With
     drubs_run(), a single command can be written, using 'capture=True', which
-    will apply to any local() calls, but be stripped from any run() calls.
+    returns the output of both local and remote commands without printing it.
+
+    All output is streamed to the run's log file (see get_log()), and only the
+    last CAPTURE_LIMIT bytes of it are kept in memory and returned.  Values
+    needed from output too long for that can be requested with 'fields', a dict
+    of name => regular expression: the first match of each (its first group,
+    if it has one) is returned in the result's 'fields' dict.  With
+    'limit=None', all of the output is kept.  'warn_only=True' returns a
+    failed command's result rather than aborting, like fabric's warn_only
+    setting.
+
+    Commands run in the directory and with the prefixes of the node's context
+    (see NodeContext.cd() and NodeContext.prefix()), rather than fabric's.
+
+    Commands are only printed, not run, when planning (--plan), unless they are
+    read-only queries marked with 'query=True'.
+    '''
+    query = kwargs.pop('query', False)
+    if env.plan_only and not query:
+      self.print_planned_command(cmd)
+      result = _AttributeString()
+      result.return_code = 0
+      result.failed = False
+      result.succeeded = True
+      result.fields = dict()
+      return result
+    if env.plan_only:
+      with hide('running'):
+        return self.run_command(cmd, *args, **kwargs)
+    return self.run_command(cmd, *args, **kwargs)
+
+
+  def run_command(self, cmd, *args, **kwargs):
+    succeeded = False
+    try:
+      result = self.issue_command(cmd, *args, **kwargs)
+      succeeded = result.succeeded
+      return result
+    finally:
+      self.metrics.command(succeeded)
+
+
+  def issue_command(self, cmd, *args, **kwargs):
+    options = dict(
+      capture=kwargs.pop('capture', False),
+      fields=kwargs.pop('fields', None),
+      warn_only=kwargs.pop('warn_only', False),
+      limit=kwargs.pop('limit', CAPTURE_LIMIT),
+      cwd=self.context.cwd,
+      prefixes=self.context.prefixes,
+    )
+    if args or kwargs:
+      # Options only fabric understands (shell, pty...): run the command with
+      # fabric, holding all of its output in memory.
+      cmd = prefix_command(cmd, self.context.cwd, self.context.prefixes)
+      with settings(warn_only=options['warn_only'] or env.warn_only):
+        if self.context.host_is_local:
+          return local(cmd, *args, capture=options['capture'], **kwargs)
+        with settings(host_string=self.context.host_string):
+          return run(cmd, *args, **kwargs)
+    if self.context.host_is_local:
+      return stream_local(cmd, self.get_log(), **options)
+    return stream_remote(cmd, self.context.host_string, self.get_log(), **options)
+
+
+  def get_log(self):
     '''
-    if env.host_is_local:
-      return local(cmd, *args, **kwargs)
+    Returns the log file this run's command output is written to, opening it
+    (under .drubs/logs in the project's config directory) on first use.
+    '''
+    if self.log is None:
+      self.log = open_log(env.config_dir, self.context.node_name, self.action, self.context.start_time)
+      remove_old_logs(env.config_dir)
+    return self.log
+
+
+  def drubs_put(self, local_path, remote_path):
+    '''
+    Uploads a file to the node, like fabric's put(), printing rather than
+    uploading when planning.
+    '''
+    remote_path = self.node_path(remote_path)
+    if env.plan_only:
+      self.print_planned_command('put %s %s' % (local_path, remote_path), cwd=False)
+    elif self.context.host_is_local:
+      shutil.copyfile(local_path, remote_path)
     else:
-      kwargs.pop('capture', None)
-      return run(cmd, *args, **kwargs)
+      put_file(self.context.host_string, local_path, remote_path)
 
 
-  def get_node(self, d, host):
+  def drubs_get(self, remote_path, local_path):
     '''
-    Recursive function to determine node name from hostname.
+    Downloads a file from the node, like fabric's get(), printing rather than
+    downloading when planning.
     '''
-    for k,v in d.items():
-      if isinstance(v,dict):
-        p = self.get_node(v,host)
-        if p:
-          return k
-      elif v == host:
-        return k
+    remote_path = self.node_path(remote_path)
+    if env.plan_only:
+      self.print_planned_command('get %s %s' % (remote_path, local_path), cwd=False)
+    elif self.context.host_is_local:
+      shutil.copyfile(remote_path, local_path)
+    else:
+      get_file(self.context.host_string, remote_path, local_path)
+
+
+  def node_path(self, path):
+    '''
+    Returns a path on the node, relative paths being relative to the directory
+    commands run in (see NodeContext.cd()).
+    '''
+    if isabs(path) or path.startswith('~') or not self.context.cwd:
+      return path
+    return join(self.context.cwd.replace(r'\ ', ' '), path)
+
+
+  def print_planned_command(self, cmd, cwd=True):
+    '''
+    Prints a command that would be issued to the node, when planning.
+    '''
+    directory = self.context.cwd
+    if cwd and directory:
+      cmd = 'cd %s && %s' % (directory, cmd)
+    print('       $ %s' % (cmd))
+
+
+  def run_action(self, action):
+    '''
+    Runs an action, then records its metrics (see metrics.py) next to the
+    project config file, unless planning.
+    '''
+    self.metrics = Metrics(self.context.node_name, action, self.context.start_time)
+    success = False
+    try:
+      getattr(self, action)()
+      success = True
+    finally:
+      if not env.plan_only:
+        write_metrics(env.config_dir, self.metrics.record(success))
 
 
   def status(self):
@@ -110,100 +287,562 @@ class Node(object):
     '''
     Installs a site/project, based on .make and .py configuration files.
     '''
-    self.check_destructive_action_protection()
-    self.disable_apache_access()
-    self.check_and_create_backup()
-    with self.cleanup_on_failure():
-      self.put_files()
-      self.provision()
-      self.make()
-      self.preconfigure()
-      self.site_install()
-      self.postconfigure()
-      self.secure()
-      self.remove_files()
-      # The order/flow below is important.
-      self.drush('updb')
-      self.drush('cc all')
-    if not env.no_backup:
-      self.remove_old_backups()
-    self.enable_apache_access()
-    self.print_elapsed_time()
+    self.run_plan(self.install_plan())
+
+
+  def install_plan(self):
+    plan = Plan('install', self.clear_cache)
+    plan.add('check_destructive_action_protection', self.check_destructive_action_protection)
+    plan.add('disable_apache_access', self.disable_apache_access)
+    plan.add('check_and_create_backup', self.check_and_create_backup)
+    # Uploading files, recreating the database and building the codebase do
+    # not depend on each other.
+    plan.add('put_files', self.put_files, guarded=True, after=[])
+    plan.add('provision_database', self.provision_database, guarded=True, after=[])
+    plan.add('provision_site_root', self.provision_site_root, guarded=True, after=[])
+    plan.add('make', self.make, guarded=True, clears_cache=True, after=['provision_site_root'])
+    plan.add('preconfigure', self.preconfigure, guarded=True)
+    if self.get_snapshot_enabled() and snapshot_exists(self.get_snapshot_dir()):
+      plan.add('restore_snapshot', self.restore_snapshot, guarded=True, clears_cache=True)
+    else:
+      plan.add('site_install', self.site_install, guarded=True)
+      plan.add('postconfigure', self.postconfigure, guarded=True, clears_cache=True)
+      if self.get_snapshot_enabled():
+        plan.add('save_snapshot', self.save_snapshot, guarded=True, needs_clean_cache=True)
+    plan.add('secure', self.secure, guarded=True)
+    plan.add('remove_files', self.remove_files, guarded=True)
+    # The order/flow below is important.
+    plan.add('updb', self.update_database, guarded=True, clears_cache=True)
+    self.add_finish_steps(plan)
+    return plan
 
 
   def update(self):
     '''
     Updates a site/project, based on .make and .py configuration files.
     '''
-    self.disable_apache_access()
-    self.check_and_create_backup()
-    with self.cleanup_on_failure():
-      self.put_files()
-      self.make()
-      self.postconfigure()
-      self.secure()
-      self.remove_files()
-      # The order/flow below is important.
-      self.drush('updb')
-      self.drush('cc all')
+    self.run_plan(self.update_plan())
+
+
+  def update_plan(self):
+    plan = Plan('update', self.clear_cache)
+    if self.get_benchmark_enabled():
+      plan.add('benchmark_before', self.benchmark_before)
+    plan.add('disable_apache_access', self.disable_apache_access)
+    plan.add('check_and_create_backup', self.check_and_create_backup)
+    plan.add('put_files', self.put_files, guarded=True, after=[])
+    plan.add('make', self.make, guarded=True, clears_cache=True, after=[])
+    plan.add('postconfigure', self.postconfigure, guarded=True, clears_cache=True)
+    plan.add('secure', self.secure, guarded=True)
+    plan.add('remove_files', self.remove_files, guarded=True)
+    # The order/flow below is important.
+    plan.add('updb', self.update_database, guarded=True, clears_cache=True)
+    if self.get_benchmark_enabled():
+      plan.add('benchmark_after', self.benchmark_after, guarded=True, needs_clean_cache=True)
+    self.add_finish_steps(plan)
+    return plan
+
+
+  def add_finish_steps(self, plan):
+    '''
+    Adds the steps which finish an install or update to a plan.
+    '''
     if not env.no_backup:
-      self.remove_old_backups()
-    self.enable_apache_access()
-    self.print_elapsed_time()
+      plan.add('remove_old_backups', self.remove_old_backups)
+    if self.get_warmup_enabled():
+      plan.add('warm_up', self.warm_up, needs_clean_cache=True)
+    plan.add('enable_apache_access', self.enable_apache_access, needs_clean_cache=True)
+    plan.add('print_elapsed_time', self.print_elapsed_time)
 
 
   def disable(self):
     '''
     Disables a site using Drupal's maintenance mode.
     '''
-    print(cyan('Disabling site...'))
-    with env.cd(env.node['site_root']):
-      self.drush('vset maintenance_mode 1')
-      self.drush('cc all')
-    self.print_elapsed_time()
+    plan = Plan('disable', self.clear_cache)
+    plan.add('maintenance_mode', lambda: self.set_maintenance_mode(1), clears_cache=True)
+    plan.add('print_elapsed_time', self.print_elapsed_time, needs_clean_cache=True)
+    self.run_plan(plan)
 
 
   def enable(self):
     '''
     Enables a site by disabling Drupal's maintenance mode.
     '''
-    print(cyan('Enabling site...'))
-    with env.cd(env.node['site_root']):
-      self.drush('vset maintenance_mode 0')
-      self.drush('cc all')
-    self.print_elapsed_time()
+    plan = Plan('enable', self.clear_cache)
+    plan.add('maintenance_mode', lambda: self.set_maintenance_mode(0), clears_cache=True)
+    plan.add('print_elapsed_time', self.print_elapsed_time, needs_clean_cache=True)
+    self.run_plan(plan)
 
 
   def backup(self):
     '''
-    Creates a drush archive dump backup of the site.
-    '''
-    self.create_backup()
-    self.remove_old_backups()
-    self.print_elapsed_time()
+    Creates a backup of the site (see create_backup()).
+    '''
+    plan = Plan('backup', self.clear_cache)
+    plan.add('create_backup', lambda: self.create_backup(clear_cache=True))
+    plan.add('remove_old_backups', self.remove_old_backups)
+    if env.verify:
+      plan.add('verify_backups', self.verify_backups)
+    if env.replicate:
+      plan.add('replicate_backups', self.replicate_backups)
+    plan.add('print_elapsed_time', self.print_elapsed_time)
+    self.run_plan(plan)
+    # Agents are not given --verify or --replicate: verification records and
+    # replicas are kept here.
+    if env.agent and not env.plan_only and not self.context.host_is_local:
+      if env.verify:
+        self.verify_backups()
+      if env.replicate:
+        self.replicate_backups()
 
 
   def destroy(self):
-    self.check_destructive_action_protection()
-    self.check_and_create_backup()
+    plan = Plan('destroy', self.clear_cache)
+    plan.add('check_destructive_action_protection', self.check_destructive_action_protection)
+    plan.add('check_and_create_backup', self.check_and_create_backup)
+    plan.add('remove_database', self.remove_database)
+    plan.add('remove_site_root', self.remove_site_root)
+    if not env.no_backup:
+      plan.add('remove_old_backups', self.remove_old_backups)
+    plan.add('print_elapsed_time', self.print_elapsed_time)
+    self.run_plan(plan)
+
+
+  def sync(self):
+    '''
+    Replaces the node's database and sites/default/files with those of another
+    node (env.sync_source), streamed from one node to the other without
+    writing them anywhere in between.
+    '''
+    source = Node(NodeContext.for_node(env.sync_source))
+    plan = Plan('sync', self.clear_cache)
+    plan.add('check_destructive_action_protection', self.check_destructive_action_protection)
+    plan.add('check_and_create_backup', self.check_and_create_backup)
+    # The database and the files are streamed at the same time.
+    plan.add('sync_database', lambda: self.sync_database(source), guarded=True, clears_cache=True, after=[])
+    plan.add('sync_files', lambda: self.sync_files(source), guarded=True, after=[])
+    plan.add('print_elapsed_time', self.print_elapsed_time, needs_clean_cache=True)
+    self.run_plan(plan)
+
+
+  def run_plan(self, plan):
+    '''
+    Runs the coalesced steps of a plan.
+
+    Consecutive guarded steps are run inside cleanup_on_failure(); if one of
+    them fails, the remaining guarded steps are skipped, and the plan continues
+    with the next unguarded step (as for install and update).  Consecutive
+    steps which declare what they run after are run concurrently, see
+    run_concurrently().
+
+    When planning (--plan), steps are listed along with the commands they would
+    issue, and their durations estimated from past runs, instead.
+    '''
+    if env.plan_only:
+      self.print_plan(plan)
+      return
+    if env.agent and not self.context.host_is_local:
+      self.run_agent(plan)
+      return
+    self.action = plan.action
+    steps = plan.coalesced()
+    self.emit_event('plan', action=plan.action, steps=[step.name for step in steps])
+    if env.progress_interval > 0:
+      self.progress = Progress(
+        [(step.name, self.history.estimate(self.context.node_name, step.name)) for step in steps],
+        interval=env.progress_interval,
+      )
+      self.progress.start()
+    try:
+      for guarded, group in groupby(steps, lambda step: step.guarded):
+        if guarded:
+          with self.cleanup_on_failure():
+            self.run_steps(list(group))
+        else:
+          self.run_steps(list(group))
+    finally:
+      if isinstance(self.progress, Progress):
+        self.progress.stop()
+      self.progress = NoProgress()
+
+
+  def run_steps(self, steps):
+    '''
+    Runs steps in order, running consecutive steps which declare what they run
+    after concurrently.
+    '''
+    for concurrent, group in groupby(steps, lambda step: step.after is not None):
+      group = list(group)
+      if concurrent and len(group) > 1:
+        self.run_concurrently(group)
+      else:
+        for step in group:
+          self.run_step(step)
+
+
+  def run_concurrently(self, steps):
+    '''
+    Runs steps as a TaskGraph, each one as soon as the steps it runs after are
+    done.  If one of them fails, the others are cancelled and the plan fails
+    as for any other failed step.
+
+    Steps run in separate processes, so changes they make to the Node or
+    fabric's env are not seen by later steps.
+    '''
+    print(cyan('Running %s at the same time...' % (', '.join(step.name for step in steps))))
+    graph = TaskGraph(workers=len(steps))
+    for step in steps:
+      graph.add(step.name, step, step.after)
+    # Progress is reported from the first of the steps.
+    self.progress.start_step(steps[0].name)
+    self.run_graph(graph, lambda name, step: self.run_step(step))
+
+
+  def run_graph(self, graph, runner):
+    '''
+    Runs a TaskGraph whose tasks run as steps (runner(name, func) runs one).
+
+    Each task runs in its own process, where progress is not reported: this
+    process reports it, adding up the bytes the tasks transfer.  The commands
+    they run are counted alike, and their phases collected from the step
+    history once they are done.
+    '''
+    progress, metrics = self.progress, self.metrics
+    shared_progress, shared_metrics = progress.share(), metrics.share()
+    def run(name, func):
+      self.progress = shared_progress
+      self.metrics = shared_metrics
+      runner(name, func)
+    started = time.time()
+    try:
+      graph.run(runner=run)
+    finally:
+      # Tasks run in this process when the graph has a single worker.
+      self.progress, self.metrics = progress, metrics
+      progress.collect(shared_progress)
+      metrics.collect(shared_metrics)
+      for name, duration, success in self.history.runs_since(self.context.node_name, list(graph.tasks), started):
+        metrics.phase(name, duration, success)
+
+
+  def run_step(self, step):
+    '''
+    Runs a step, recording its duration in the node's step history.
+    '''
+    started = time.time()
+    success = False
+    self.progress.start_step(step.name)
+    try:
+      step.func()
+      success = True
+    finally:
+      self.history.record(self.context.node_name, self.action, step.name, started, time.time() - started, success)
+      self.metrics.phase(step.name, time.time() - started, success)
+      self.emit_event('step', action=self.action, step=step.name, started=started, duration=time.time() - started, success=success)
+
+
+  def run_tasks(self, graph):
+    '''
+    Runs a TaskGraph (see taskgraph.py), recording each task in the node's step
+    history like any other step.  When planning (--plan), tasks are listed one
+    after another in dependency order instead.
+    '''
+    if env.plan_only:
+      graph.run(runner=self.print_planned_task, concurrent=False)
+      return
+    # Tasks are part of the plan step running them: progress stays on it.
+    self.run_graph(graph, lambda name, func: self.run_step(Step(name, func)))
+
+
+  def print_planned_task(self, name, func):
+    print(yellow('      - task %s' % (name)))
+    func()
+
+
+  def emit_event(self, event, **data):
+    '''
+    Prints a structured event for the controller, when running as an agent.
+    '''
+    if env.events:
+      data['event'] = event
+      data['node'] = self.context.node_name
+      print('%s%s' % (AGENT_EVENT_PREFIX, json.dumps(data)))
+      sys.stdout.flush()
+
+
+  def run_agent(self, plan):
+    '''
+    Runs a plan through a drubs agent on the node itself.
+
+    The project config, the node's make and py files and the 'files' directory
+    are shipped to the node, and a single drubs process is started there in
+    local mode (--local) to run the whole action without any per-command SSH
+    round trips.  The agent streams structured events back, which are used to
+    record step durations in the controller's step history.  Requires drubs
+    to be installed on the node ('drubs_command' sets how it is invoked).
+    '''
+    print(cyan("Shipping project configuration to drubs agent on node '%s'..." % (self.context.node_name)))
+    # The project config holds every node's passwords: ship it to a directory
+    # only the node's user can read, removed once the agent is done.
+    with hide('running', 'stdout'):
+      agent_dir = self.drubs_run('umask 077 && mktemp -d /tmp/drubs-agent-XXXXXXXX', capture=True).strip()
+    try:
+      result = self.run_agent_in(agent_dir, plan)
+    finally:
+      self.drubs_run('rm -rf %s' % (agent_dir))
+      self.forget_directory(agent_dir)
+
+    failed_steps = list()
+    for line in result.splitlines():
+      line = line.strip()
+      if not line.startswith(AGENT_EVENT_PREFIX):
+        continue
+      event = json.loads(line[len(AGENT_EVENT_PREFIX):])
+      if event['event'] == 'step':
+        self.history.record(self.context.node_name, event['action'], event['step'], event['started'], event['duration'], event['success'])
+        self.metrics.phase(event['step'], event['duration'], event['success'])
+        if not event['success']:
+          failed_steps.append(event['step'])
+    if result.failed:
+      print(red("The drubs agent on node '%s' exited with status %d. Exiting..." % (self.context.node_name, result.return_code)))
+      exit(1)
+    if failed_steps:
+      print(red("Step(s) failed on node '%s': %s" % (self.context.node_name, ', '.join(failed_steps))))
+
+
+  def run_agent_in(self, agent_dir, plan):
+    '''
+    Ships the project to 'agent_dir' on the node and runs the drubs agent
+    there, see run_agent().  Returns the agent's output.
+    '''
+    shipped = [basename(env.config_file), self.context.node['make_file'], self.context.node['py_file']]
+    if isfile(makefile.lock_file_name(join(env.config_dir, self.context.node['make_file']))):
+      shipped.append(makefile.lock_file_name(self.context.node['make_file']))
+    if isfile(history_file(env.config_dir)):
+      shipped.append(history_file(env.config_dir)[len(env.config_dir) + 1:])
+    snapshot_dir = self.get_snapshot_dir()
+    if self.get_snapshot_enabled() and snapshot_exists(snapshot_dir):
+      shipped.extend(join(snapshot_dir, name)[len(env.config_dir) + 1:] for name in SNAPSHOT_FILES)
+    for name in shipped:
+      self.ensure_directory(dirname(join(agent_dir, name)))
+      self.drubs_put(join(env.config_dir, name), join(agent_dir, name))
+    self.upload_tree(join(env.config_dir, 'files'), join(agent_dir, 'files'))
+
+    print(cyan("Starting drubs agent for '%s' on node '%s'..." % (plan.action, self.context.node_name)))
+    # All of the agent's output is kept, for its events.
+    result = self.drubs_run('%s -f %s --local --events %s %s %s' % (
+      self.context.node.get('drubs_command', '').strip() or 'drubs',
+      join(agent_dir, basename(env.config_file)),
+      ' '.join(self.agent_options()),
+      plan.action,
+      self.context.node_name,
+    ), warn_only=True, limit=None)
+    # Keep any install snapshot the agent saved.
+    agent_snapshot_dir = join(agent_dir, snapshot_dir[len(env.config_dir) + 1:])
+    if self.get_snapshot_enabled() and not snapshot_exists(snapshot_dir) and self.context.exists(agent_snapshot_dir):
+      makedirs(snapshot_dir)
+      for name in SNAPSHOT_FILES:
+        self.drubs_get(join(agent_snapshot_dir, name), join(snapshot_dir, name))
+    return result
+
+
+  def agent_options(self):
+    '''
+    Returns the command line options this drubs process passes to an agent.
+    '''
+    options = list()
+    for flag, option in (
+      ('verbose', '-v'),
+      ('debug', '-d'),
+      ('cache', '-c'),
+      ('no_backup', '-b'),
+      ('no_restore', '-r'),
+      ('yes', '-y'),
+      ('offline', '-o'),
+      ('full_make', '--full-make'),
+    ):
+      if env[flag]:
+        options.append(option)
+    options.append('--progress-interval=%d' % (env.progress_interval))
+    return options
+
+
+  def print_plan(self, plan):
+    '''
+    Prints the steps of a plan with the commands each would issue.
+    '''
+    print(cyan("Plan for '%s' on node '%s' (nothing will be changed):" % (plan.action, self.context.node_name)))
+    total = 0
+    unknown = list()
+    for number, step in enumerate(plan.coalesced(), 1):
+      estimate = self.history.estimate(self.context.node_name, step.name)
+      if estimate is None:
+        unknown.append(step.name)
+        estimate_text = 'no history'
+      else:
+        total += estimate
+        estimate_text = 'est. %s' % (format_duration(estimate))
+      flags = [flag for flag, is_set in (('guarded', step.guarded), ('concurrent', step.after is not None)) if is_set]
+      print(yellow('  %2d. %-40s %s' % (number, step.name + (' (%s)' % (', '.join(flags)) if flags else ''), estimate_text)))
+      step.func()
+    print(cyan('Estimated total: %s' % (format_duration(total))))
+    if unknown:
+      print(yellow('No history for step(s): %s' % (', '.join(unknown))))
+
+
+  def update_database(self):
+    self.drush('updb')
+
+
+  def clear_cache(self):
+    self.drush('cc all')
+
+
+  def set_maintenance_mode(self, value):
+    print(cyan('%s site...' % ('Disabling' if value else 'Enabling')))
+    self.drush('vset maintenance_mode %d' % (value))
+
+
+  def sync_database(self, source):
+    '''
+    Recreates the node's database from a dump of the database of 'source' (a
+    Node), streamed through a compressed pipe.  The statements in the node's
+    'sync_sanitize_file' (if any) are run right after the dump is loaded.
+    '''
+    print(cyan("Syncing database from node '%s'..." % (source.context.node_name)))
+    dump = 'set -o pipefail; mysqldump %s --single-transaction --quick --routines --triggers %s | gzip -1' % (
+      source.get_mysql_options(),
+      source.context.node['db_name'],
+    )
+    load = 'set -o pipefail; gunzip -c | mysql %s %s' % (self.get_mysql_options(), self.context.node['db_name'])
+    sanitize = self.get_sanitize_sql()
+    self.provision_database()
+    self.relay_from(source, dump, load, 'Database', gzip_member(sanitize) if sanitize else '')
+
+
+  def get_sanitize_sql(self):
+    '''
+    Returns the SQL statements which sanitize a database synced to the node,
+    read from the file (relative to the project config directory) set as the
+    node's 'sync_sanitize_file'.
+    '''
+    sanitize_file = self.context.node.get('sync_sanitize_file', '').strip()
+    if not sanitize_file:
+      return ''
+    path = join(env.config_dir, sanitize_file)
+    if not isfile(path):
+      print(red("The sync_sanitize_file '%s' for node '%s' does not exist. Exiting..." % (path, self.context.node_name)))
+      exit(1)
+    print(cyan("Sanitizing with '%s'..." % (sanitize_file)))
+    with open(path) as stream:
+      return stream.read() + '\n'
+
+
+  def sync_files(self, source):
+    '''
+    Replaces the node's sites/default/files with those of 'source' (a Node),
+    streamed through a compressed pipe.  Files which Drupal regenerates (see
+    SYNC_FILES_EXCLUDE) are left out.
+    '''
+    source_dir = source.context.node['site_root'] + '/sites/default'
+    target_dir = self.context.node['site_root'] + '/sites/default'
+    if not env.plan_only and not source.context.exists(source_dir + '/files'):
+      print(yellow("No files directory found on node '%s'.  No files synced..." % (source.context.node_name)))
+      return
+    print(cyan("Syncing files from node '%s'..." % (source.context.node_name)))
+    if self.context.exists(target_dir):
+      self.fs.chmod(target_dir, 'u+w')
+    if self.context.exists(target_dir + '/files'):
+      self.fs.discard(target_dir + '/files', self.get_trash_dir())
+    self.ensure_directory(target_dir)
+    pack = 'set -o pipefail; tar -cf - -C %s%s files | gzip -1' % (
+      source_dir,
+      ''.join(' --exclude=files/%s' % (name) for name in SYNC_FILES_EXCLUDE),
+    )
+    unpack = 'tar -xzf - -C %s' % (target_dir)
+    self.relay_from(source, pack, unpack, 'Files')
+
+
+  def relay_from(self, source, source_command, target_command, description, trailer=''):
+    '''
+    Runs a command on 'source' (a Node) and another on this node, relaying the
+    output of the first into the second as it is produced, see sync.relay().
+    '''
+    if env.plan_only:
+      self.print_planned_command('[%s] %s | [%s] %s' % (
+        source.context.node_name,
+        source_command,
+        self.context.node_name,
+        target_command,
+      ), cwd=False)
+      return
+    throughput = Throughput(
+      "Syncing %s from node '%s'" % (description.lower(), source.context.node_name),
+      interval=env.progress_interval,
+    )
+    relay(source.open_command(source_command), self.open_command(target_command), throughput, trailer)
+    self.progress.add_bytes(throughput.bytes)
+    print(green("%s synced from node '%s': %s." % (description, source.context.node_name, throughput.status())))
+
+
+  def open_command(self, cmd):
+    '''
+    Starts a command on the node with its input and output open to drubs, see
+    sync.relay().
+    '''
+    if self.context.host_is_local:
+      return LocalCommand(cmd, self.get_log(), self.context.cwd, self.context.prefixes)
+    return RemoteCommand(cmd, self.context.host_string, self.get_log(), self.context.cwd, self.context.prefixes)
+
+
+  def remove_database(self):
     print(cyan('Removing database...'))
     self.drubs_run('mysql -h%s -u%s -p%s -e "DROP DATABASE IF EXISTS %s";' % (
-      env.node['db_host'],
-      env.node['db_user'],
-      env.node['db_pass'],
-      env.node['db_name'],
+      self.context.node['db_host'],
+      self.context.node['db_user'],
+      self.context.node['db_pass'],
+      self.context.node['db_name'],
     ))
+
+
+  def remove_site_root(self):
     print(cyan('Removing files...'))
-    if env.exists(env.node['site_root']):
-      self.drubs_run('chmod -R u+w %s' % (env.node['site_root']))
-      self.drubs_run('rm -rf %s' % (env.node['site_root']))
+    if self.context.exists(self.context.node['site_root']):
+      self.fs.discard(self.context.node['site_root'], self.get_trash_dir())
+      self.forget_directory(self.context.node['site_root'])
     else:
       print(yellow('Site root %s does not exist.  Nothing to remove.' % (
-        env.node['site_root'],
+        self.context.node['site_root'],
       )))
-    if not env.no_backup:
-      self.remove_old_backups()
-    self.print_elapsed_time()
+
+
+  def ensure_directory(self, path):
+    '''
+    Creates a directory (with parents) on the node, at most once per action.
+    '''
+    if path not in self.directories:
+      self.fs.mkdir(path)
+      self.directories.add(path)
+
+
+  def get_trash_dir(self):
+    '''
+    Returns the directory site root contents are moved to when removed, to be
+    deleted in the background (see fileops.purge_command()).  It is next to the
+    site root, so that moving there is a rename on the same filesystem, and
+    outside of it, so that it is never served.
+    '''
+    return join(dirname(self.context.node['site_root'].rstrip('/')), '.drubs-trash')
+
+
+  def forget_directory(self, path):
+    '''
+    Forgets that a directory (and anything below it) exists, after removing it.
+    '''
+    for directory in list(self.directories):
+      if directory == path or directory.startswith(path.rstrip('/') + '/'):
+        self.directories.discard(directory)
 
 
   def var_dump(self):
@@ -222,7 +861,7 @@ class Node(object):
       cmd += ' -v'
     if env.debug:
       cmd += ' -d'
-    with env.cd(env.node['site_root']):
+    with self.context.cd(self.context.node['site_root']):
       self.drubs_run('drush %s -y' % (cmd))
 
 
@@ -240,7 +879,7 @@ class Node(object):
     be properly understood.  (Encoding queries with base64 in transit may be
     helpful.)
     '''
-    if env.host_is_local:
+    if self.context.host_is_local:
       sql = sql.replace('"', '\\"')
     else:
       sql = sql.replace('"', '\\\\\"')
@@ -249,28 +888,131 @@ class Node(object):
       options += ' -v'
     if env.debug:
       options += ' -d'
-    with env.cd(env.node['site_root']):
+    with self.context.cd(self.context.node['site_root']):
       self.drubs_run(r'drush sql-query "%s" %s -y' % (sql, options))
 
 
+  def drush_sql_bulk(self, statements):
+    '''
+    Runs many sql statements, or a .sql file, in a single transaction.
+
+    Unlike drush_sql(), the sql is never placed on a command line.  It is
+    streamed to a single 'drush sql-cli' invocation on the node's stdin, so no
+    shell escaping is needed and the same sql works on local and remote nodes.
+
+    'statements' is either a list of sql statements, or the path to a .sql file
+    (relative paths are relative to the project's 'files' directory).  If any
+    statement fails, the transaction is rolled back, the failing statement is
+    reported, and drubs exits.
+
+    Note that MySQL implicitly commits most DDL statements (CREATE, ALTER, DROP,
+    etc.), so these cannot be rolled back.
+    '''
+    if isinstance(statements, basestring):
+      sql_file = statements
+      if not isabs(sql_file):
+        sql_file = join(env.config_dir, 'files', sql_file)
+      if not isfile(sql_file):
+        print(red("SQL file '%s' does not exist or could not be read. Exiting..." % (sql_file)))
+        exit(1)
+      with open(sql_file, 'r') as stream:
+        chunks = [(sql_file, stream.read())]
+      print(cyan("Running sql file '%s' in a single transaction..." % (sql_file)))
+    else:
+      chunks = statement_chunks(statements)
+      print(cyan('Running %d sql statements in a single transaction...' % (len(chunks))))
+    script, chunk_lines = build_script(chunks)
+
+    options = list()
+    if env.verbose:
+      options.append('-v')
+    if env.debug:
+      options.append('-d')
+
+    if env.plan_only:
+      self.print_planned_command('drush sql-cli %s < (%d line sql script)' % (' '.join(options), script.count('\n')))
+      return
+    # The script is written to a file only the node's user can read, and
+    # removed once run.
+    with hide('running', 'stdout'):
+      sql_path = self.drubs_run('umask 077 && mktemp /tmp/drubs-sql-XXXXXXXX', capture=True).strip()
+    try:
+      self.put_contents(script, sql_path)
+      with self.context.cd(self.context.node['site_root']):
+        result = self.drubs_run('drush sql-cli %s < %s' % (' '.join(options), sql_path), warn_only=True)
+    finally:
+      self.drubs_run('rm -f %s' % (sql_path))
+
+    if result.failed:
+      errors = error_messages(result, chunk_lines)
+      for message in errors:
+        print(red(message))
+      if not errors:
+        print(red('SQL statements could not be executed.'))
+      print(red('All statements in the transaction have been rolled back. Exiting...'))
+      exit(1)
+
+
+  def file_size(self, path):
+    '''
+    Returns the size in bytes of a file on the node, or 0 if it is missing.
+    '''
+    if env.plan_only:
+      return 0
+    if self.context.host_is_local:
+      return getsize(path) if local_exists(path) else 0
+    with hide('running', 'stdout'):
+      size = self.drubs_run('stat -c %%s %s 2>/dev/null || echo 0' % (path), query=True)
+    return int(size.strip() or 0)
+
+
+  def put_contents(self, contents, path):
+    '''
+    Writes a string to a file on the node, creating its directory if needed.
+    '''
+    self.ensure_directory(dirname(path))
+    if env.plan_only:
+      self.print_planned_command('write %d bytes to %s' % (len(contents), path), cwd=False)
+    elif self.context.host_is_local:
+      with open(path, 'w') as stream:
+        stream.write(contents)
+    else:
+      put_file(self.context.host_string, StringIO(contents), self.node_path(path))
+
+
   def provision(self):
     '''
     Creates database and site root.
     '''
+    self.provision_database()
+    self.provision_site_root()
+
+
+  def provision_database(self):
+    '''
+    Creates (or recreates) the database.
+    '''
     print(cyan('Creating database...'))
     self.drubs_run('mysql -h%s -u%s -p%s -e "DROP DATABASE IF EXISTS %s;CREATE DATABASE %s;"' % (
-      env.node['db_host'],
-      env.node['db_user'],
-      env.node['db_pass'],
-      env.node['db_name'],
-      env.node['db_name'],
+      self.context.node['db_host'],
+      self.context.node['db_user'],
+      self.context.node['db_pass'],
+      self.context.node['db_name'],
+      self.context.node['db_name'],
     ))
+
+
+  def provision_site_root(self):
+    '''
+    Creates (or empties) the site root.
+    '''
     print(cyan('Creating site root location...'))
-    if env.exists(env.node['site_root'] + '/sites/default'):
-      with env.cd(env.node['site_root']):
-        self.drubs_run('chmod u+w sites/default')
-        self.drubs_run('ls -A | grep -v ".htaccess.drubs" | xargs rm -rf')
-    self.drubs_run('mkdir -p %s' % (env.node['site_root']))
+    if self.context.exists(self.context.node['site_root'] + '/sites/default'):
+      self.fs.chmod(self.context.node['site_root'] + '/sites/default', 'u+w')
+      self.fs.discard_children(self.context.node['site_root'], self.get_trash_dir(), keep=['.htaccess.drubs'])
+      self.forget_directory(self.context.node['site_root'])
+      self.directories.add(self.context.node['site_root'])
+    self.ensure_directory(self.context.node['site_root'])
 
 
   def make(self):
@@ -278,38 +1020,292 @@ class Node(object):
     Runs drush make using the make file specified in project configs.
     '''
     print(cyan('Beginning drush make...'))
-    with env.cd(env.node['site_root']):
-      if env.exists(env.node['site_root'] + '/sites/default'):
-        self.drubs_run('chmod 775 sites/default')
-      make_file = env.config_dir + '/' + env.node['make_file']
+    with self.context.cd(self.context.node['site_root']):
+      # Checked on the node rather than remembered from provision_site_root(),
+      # which may have run in another process (see run_concurrently()).
+      if self.context.exists(self.context.node['site_root'] + '/sites/default'):
+        self.fs.chmod(self.context.node['site_root'] + '/sites/default', '775')
+      make_file = env.config_dir + '/' + self.context.node['make_file']
+      node_make_file = '/tmp/%s/%s' % (
+        env.config['project_settings']['project_name'],
+        self.context.node['make_file'],
+      )
 
       cache_option = str()
       if not env.cache:
         cache_option += ' --no-cache'
-
-      # Remove all modules/themes/libraries to ensure any deleted files are
-      # removed.  See: https://github.com/komlenic/drubs/issues/30
-      self.drubs_run('rm -rf sites/all/*')
-
-      if env.host_is_local:
-        self.drush('make --working-copy --no-gitinfofile %s %s' % (
-          cache_option,
-          make_file,
-        ))
+      make_options = '--working-copy --no-gitinfofile'
+
+      lock_file = makefile.lock_file_name(make_file)
+      package_cache = self.get_package_cache()
+      shared_build_dir = self.get_shared_build_dir()
+      make_info = self.get_make_info()
+      drush_info = make_info
+      if package_cache or isfile(lock_file):
+        # Build from the lockfile (if any) and/or the shared package cache,
+        # using a rewritten copy of the make file on the node.
+        info = make_info
+        if package_cache:
+          info = package_cache.apply(info)
+        drush_info = info = makefile.drush_make_info(info)
+        self.put_contents(makefile.dump_make_string(info), node_make_file)
+      elif self.context.host_is_local:
+        node_make_file = make_file
       else:
         # Copy drush make file for the node to /tmp on the node.
-        put(make_file, '/tmp/' + env.config['project_settings']['project_name'])
+        self.ensure_directory(dirname(node_make_file))
+        self.drubs_put(make_file, node_make_file)
+
+      if shared_build_dir:
+        self.make_shared_build(shared_build_dir, make_info, make_options, cache_option, node_make_file)
+      elif not self.make_incrementally(make_info, drush_info, make_options, cache_option):
+        # Remove all modules/themes/libraries to ensure any deleted files are
+        # removed.  See: https://github.com/komlenic/drubs/issues/30
+        self.fs.discard_children(self.context.node['site_root'] + '/sites/all', self.get_trash_dir())
+
         # Run drush make.
-        self.drush('make --working-copy --no-gitinfofile %s /tmp/%s/%s' % (
-          cache_option,
-          env.config['project_settings']['project_name'],
-          env.node['make_file'],
-        ))
-        # Remove drush make file from /tmp on the node.
-        self.drubs_run('rm -rf /tmp/%s/%s' % (
-          env.config['project_settings']['project_name'],
-          env.node['make_file'],
-        ))
+        self.drush('make %s %s %s' % (make_options, cache_option, node_make_file))
+        self.write_make_manifest(make_info, make_options, self.find_build_paths(make_info, makefile.build_entries(make_info).keys()))
+        self.suggest_shared_build()
+
+      # Remove drush make file from /tmp on the node.
+      if node_make_file != make_file:
+        self.fs.remove(node_make_file)
+
+      if package_cache:
+        package_cache.evict()
+
+
+  def make_incrementally(self, make_info, drush_info, make_options, cache_option):
+    '''
+    Rebuilds only the projects and libraries which were added or changed in
+    the make file since the last build on the node, and removes those which
+    were removed from it, leaving the rest of sites/all in place.  Builds are
+    compared through the manifest each build leaves in sites/all (see
+    makefile.incremental_changes()).
+
+    Returns False if a full build is needed instead: when there is no usable
+    manifest, when core, defaults or make options changed, when --full-make
+    was given, or when the incremental build failed.
+    '''
+    if env.full_make:
+      return False
+    sites_all = self.context.node['site_root'] + '/sites/all'
+    manifest = self.read_make_manifest()
+    changes = makefile.incremental_changes(manifest, make_info, make_options)
+    if changes is None:
+      if manifest:
+        print(cyan('Core, defaults or make options changed since the last build.  Rebuilding everything...'))
+      return False
+    changed, removed = changes
+    if not changed and not removed:
+      print(cyan('Codebase matches the make file.  Nothing to rebuild...'))
+      return True
+    print(cyan('Rebuilding %d added or changed project(s), removing %d...' % (len(changed), len(removed))))
+    built = manifest['entries']
+    paths = dict((key, entry['path']) for key, entry in built.items() if key not in removed)
+    for key in changed + removed:
+      if key in built:
+        self.fs.discard('%s/%s' % (sites_all, built[key]['path']), self.get_trash_dir())
+        paths.pop(key, None)
+    if changed:
+      partial_make_file = '/tmp/%s/%s.partial' % (
+        env.config['project_settings']['project_name'],
+        basename(self.context.node['make_file']),
+      )
+      self.put_contents(makefile.dump_make_string(makefile.subset_info(drush_info, changed)), partial_make_file)
+      try:
+        self.drush('make --no-core --contrib-destination=sites/all %s %s %s' % (make_options, cache_option, partial_make_file))
+      except SystemExit:
+        print(yellow('Incremental build failed.  Rebuilding everything...'))
+        return False
+      finally:
+        self.fs.remove(partial_make_file)
+      paths.update(self.find_build_paths(make_info, changed))
+    self.write_make_manifest(make_info, make_options, paths)
+    return True
+
+
+  def read_make_manifest(self):
+    '''
+    Returns the manifest of the last build in the node's sites/all, or None.
+    '''
+    with hide('running', 'stdout'):
+      contents = self.drubs_run('cat %s/sites/all/%s 2>/dev/null || true' % (
+        self.context.node['site_root'],
+        MAKE_MANIFEST_FILE,
+      ), capture=True, query=True)
+    try:
+      return json.loads(contents)
+    except ValueError:
+      return None
+
+
+  def write_make_manifest(self, make_info, make_options, paths):
+    manifest = makefile.build_manifest(make_info, make_options, paths)
+    self.put_contents(json.dumps(manifest, indent=2), '%s/sites/all/%s' % (self.context.node['site_root'], MAKE_MANIFEST_FILE))
+
+
+  def find_build_paths(self, make_info, keys):
+    '''
+    Returns the paths in sites/all of built projects and libraries, see
+    makefile.project_paths().
+    '''
+    if env.plan_only:
+      return dict()
+    with hide('running', 'stdout'):
+      info_files = self.drubs_run("cd %s/sites/all && find . -maxdepth 5 \\( -name '*.info' -o -name '*.info.yml' \\)" % (
+        self.context.node['site_root'],
+      ), capture=True, query=True)
+    return makefile.project_paths(make_info, keys, info_files)
+
+
+  def get_shared_build_dir(self):
+    return self.context.node.get('shared_build_dir', '').strip().rstrip('/')
+
+
+  def make_shared_build(self, shared_build_dir, info, make_options, cache_option, node_make_file):
+    '''
+    Builds the codebase once per server, for all nodes with the same make file.
+
+    Builds live in 'shared_build_dir', named by a fingerprint of the (locked)
+    make file and drush make options, so nodes on the same server which share
+    the directory and make file reuse one build.  Builds of make files with
+    unpinned projects are only reused for SHARED_BUILD_MAX_AGE_MINUTES.
+    '''
+    build_dir = '%s/%s' % (shared_build_dir, makefile.build_fingerprint(info, make_options))
+    check = '[ -d %s ] && [ -f %s.built ]' % (build_dir, build_dir)
+    if not makefile.is_reproducible(info):
+      check += ' && [ -n "$(find %s.built -mmin -%d)" ]' % (build_dir, SHARED_BUILD_MAX_AGE_MINUTES)
+    with hide('running', 'stdout'):
+      reusable = self.drubs_run('%s && echo yes || true' % (check), capture=True, query=True)
+
+    if reusable.strip() == 'yes':
+      print(cyan("Reusing shared build '%s'..." % (build_dir)))
+    else:
+      print(cyan("Building shared codebase in '%s'..." % (build_dir)))
+      build_tmp = '%s.%s.tmp' % (build_dir, self.context.node_name)
+      self.ensure_directory(shared_build_dir)
+      self.fs.remove(build_dir + '.built')
+      self.fs.remove(build_dir)
+      self.fs.remove(build_tmp)
+      self.drush('make %s %s %s %s' % (make_options, cache_option, node_make_file, build_tmp))
+      # Files are shared by every node linking the build, so none of them may
+      # be modified through a site root.
+      self.fs.make_read_only(build_tmp)
+      if not env.plan_only and self.context.exists(build_dir):
+        # Another node finished the same build in the meantime.
+        self.fs.remove(build_tmp)
+      else:
+        self.fs.move(build_tmp, build_dir)
+      self.fs.touch(build_dir + '.built')
+
+    self.link_shared_build(build_dir)
+    # Mark the build as used, see remove_old_shared_builds().
+    self.fs.touch(build_dir)
+    self.remove_old_shared_builds(shared_build_dir)
+
+
+  def link_shared_build(self, build_dir):
+    '''
+    Lays out a shared build in the node's site root.
+
+    Everything is hardlinked from the build, except sites/default: the node's
+    own settings and files are kept, and anything missing is copied into it.
+    '''
+    site_root = self.context.node['site_root']
+    print(cyan('Linking shared build into site root...'))
+    self.fs.discard_children(site_root, self.get_trash_dir(), keep=['.htaccess.drubs', 'sites'])
+    self.fs.discard_children(site_root + '/sites', self.get_trash_dir(), keep=['default'])
+    if env.plan_only:
+      self.print_planned_command('cp -RlP %s/* %s/ (except sites/default)' % (build_dir, site_root), cwd=False)
+    else:
+      for name in self.fs.list(build_dir):
+        if name != 'sites':
+          self.fs.link_tree('%s/%s' % (build_dir, name), '%s/%s' % (site_root, name))
+      for name in self.fs.list(build_dir + '/sites'):
+        if name != 'default':
+          self.fs.link_tree('%s/sites/%s' % (build_dir, name), '%s/sites/%s' % (site_root, name))
+    self.ensure_directory(site_root + '/sites/default')
+    self.fs.copy_tree(build_dir + '/sites/default', site_root + '/sites/default', overwrite=False)
+
+
+  def remove_old_shared_builds(self, shared_build_dir):
+    '''
+    Removes shared builds which no node has used for SHARED_BUILD_LIFETIME_DAYS.
+
+    Nodes still running an old build are unaffected, as their site roots hold
+    their own hardlinks to its files.
+    '''
+    with hide('running', 'stdout'):
+      result = self.drubs_run('find %s -mindepth 1 -maxdepth 1 -type d -mtime +%d' % (
+        shared_build_dir,
+        SHARED_BUILD_LIFETIME_DAYS,
+      ), capture=True, query=True)
+    for path in result.split():
+      print(cyan("Removing unused shared build '%s'..." % (path)))
+      self.fs.remove(path)
+      self.fs.remove(path + '.built')
+
+
+  def suggest_shared_build(self):
+    '''
+    Points out other nodes on the same server which build the same make file.
+    '''
+    make_file = env.config_dir + '/' + self.context.node['make_file']
+    if env.plan_only or not isfile(make_file):
+      return
+    checksum = makefile.file_checksum(make_file)
+    siblings = list()
+    for name, node in sorted(env.config['nodes'].items()):
+      other_make_file = env.config_dir + '/' + node.get('make_file', '')
+      if (name != self.context.node_name
+          and node.get('server_host') == self.context.node['server_host']
+          and isfile(other_make_file)
+          and makefile.file_checksum(other_make_file) == checksum):
+        siblings.append(name)
+    if siblings:
+      print(yellow("Node(s) %s build the same make file on this server.  Set 'shared_build_dir' for these nodes to build the codebase only once." % (
+        ', '.join(siblings),
+      )))
+
+
+  def get_make_info(self):
+    '''
+    Returns the parsed make file for the node, or its lockfile if one exists.
+
+    Exits if the lockfile is out of date with respect to the make file.
+    '''
+    make_file = env.config_dir + '/' + self.context.node['make_file']
+    lock_file = makefile.lock_file_name(make_file)
+    if not isfile(lock_file):
+      return makefile.parse_make_file(make_file)
+    if makefile.lock_file_source_checksum(lock_file) != makefile.file_checksum(make_file):
+      print(red("Lockfile '%s' is out of date with '%s'.  Run 'drubs lock %s' to update it. Exiting..." % (
+        basename(lock_file),
+        self.context.node['make_file'],
+        self.context.node_name,
+      )))
+      exit(1)
+    print(cyan("Using lockfile '%s'..." % (basename(lock_file))))
+    return makefile.parse_make_file(lock_file)
+
+
+  def get_package_cache(self):
+    '''
+    Returns the node's shared package cache, or None if it has none.
+    '''
+    if not self.context.node.get('package_cache_dir', '').strip():
+      if env.offline:
+        print(red("Offline mode requires 'package_cache_dir' to be set for node '%s'. Exiting..." % (self.context.node_name)))
+        exit(1)
+      return None
+    return PackageCache(
+      self,
+      self.context.node['package_cache_dir'].strip(),
+      self.context.node.get('package_cache_size_mb', '').strip() or '4096',
+      offline=env.offline,
+    )
 
 
   def site_install(self):
@@ -317,22 +1313,22 @@ class Node(object):
     Runs drush site install.
     '''
     db_url = 'mysql://%s:%s@%s/%s' % (
-      env.node['db_user'],
-      env.node['db_pass'],
-      env.node['db_host'],
-      env.node['db_name'],
+      self.context.node['db_user'],
+      self.context.node['db_pass'],
+      self.context.node['db_host'],
+      self.context.node['db_name'],
     )
-    with env.cd(env.node['site_root']):
+    with self.context.cd(self.context.node['site_root']):
       print(cyan('Beginning drush site-install...'))
       self.drush('si --account-name="%s" --account-pass="%s" --account-mail="%s" --site-mail="%s" --db-url="%s" --site-name="%s"' % (
-        env.node['account_name'],
-        env.node['account_pass'],
-        env.node['account_mail'],
-        env.node['site_mail'],
+        self.context.node['account_name'],
+        self.context.node['account_pass'],
+        self.context.node['account_mail'],
+        self.context.node['site_mail'],
         db_url,
-        env.node['site_name'],
+        self.context.node['site_name'],
       ))
-      self.drubs_run('chmod 775 sites/default/files')
+      self.fs.chmod(self.context.node['site_root'] + '/sites/default/files', '775')
 
 
   def secure(self):
@@ -340,11 +1336,153 @@ class Node(object):
     Performs some security best-practices.
     '''
     print(cyan('Performing security practices...'))
-    with env.cd(env.node['site_root']):
+    with self.context.cd(self.context.node['site_root']):
       # Remove all txt files in site root (except robots.txt)
-      self.drubs_run('ls | grep .txt | grep -v "robots.txt" | xargs rm -rf')
+      self.fs.remove_matching(self.context.node['site_root'], '.txt', 'robots.txt')
       # Ensure restrictive settings on settings.php
-      self.drubs_run('chmod 444 sites/default/settings.php')
+      self.fs.chmod(self.context.node['site_root'] + '/sites/default/settings.php', '444')
+
+
+  def get_snapshot_enabled(self):
+    return self.context.node.get('install_snapshot', '').strip() == 'on'
+
+
+  def get_snapshot_dir(self):
+    '''
+    Returns the directory (next to the project config) holding the snapshot of
+    a clean install of the node, whether or not it exists yet.
+    '''
+    if self.snapshot_key is None:
+      self.snapshot_key = snapshot_key(
+        env.config_dir,
+        self.context.node,
+        env.config['project_settings'].get('drupal_core_version', ''),
+      )
+    return join(snapshots_dir(env.config_dir), self.snapshot_key)
+
+
+  @contextmanager
+  def node_snapshot_dir(self):
+    '''
+    Yields the directory on the node snapshot files are transferred through.
+
+    On local nodes, this is the snapshot directory itself.  On remote nodes,
+    snapshots (holding the site's database and settings.php) go through a
+    directory only the node's user can read, removed afterwards.
+    '''
+    if self.context.host_is_local:
+      yield self.get_snapshot_dir()
+      return
+    with hide('running', 'stdout'):
+      path = self.drubs_run('umask 077 && mktemp -d /tmp/drubs-snapshot-XXXXXXXX', capture=True).strip() or '/tmp/drubs-snapshot-XXXXXXXX'
+    self.directories.add(path)
+    try:
+      yield path
+    finally:
+      self.drubs_run('rm -rf %s' % (path))
+      self.forget_directory(path)
+
+
+  def save_snapshot(self):
+    '''
+    Saves a snapshot of the database and sites/default after a clean install.
+
+    Snapshots are kept next to the project config (in .drubs/snapshots), keyed
+    by the make file, py_file, 'files' directory and core version, so that any
+    node set to 'install_snapshot: on' can restore it instead of running drush
+    site-install and post().  As they are shared between nodes, a py_file's
+    post() must not depend on the node it runs on.
+    '''
+    print(cyan('Saving install snapshot...'))
+    snapshot_dir = self.get_snapshot_dir()
+    with self.node_snapshot_dir() as node_snapshot_dir:
+      if self.context.host_is_local:
+        # Written under a temporary name, so a partial snapshot is never used.
+        node_snapshot_dir += '.tmp'
+        self.fs.remove(node_snapshot_dir)
+        self.ensure_directory(node_snapshot_dir)
+      with self.context.cd(self.context.node['site_root']):
+        self.drush('sql-dump --gzip --result-file=%s/database.sql' % (node_snapshot_dir))
+        self.drubs_run('tar -czf %s/sites-default.tar.gz -C %s/sites default' % (
+          node_snapshot_dir,
+          self.context.node['site_root'],
+        ))
+      if self.context.host_is_local:
+        self.fs.remove(snapshot_dir)
+        self.fs.move(node_snapshot_dir, snapshot_dir)
+      else:
+        if not env.plan_only and not isdir(snapshot_dir + '.tmp'):
+          makedirs(snapshot_dir + '.tmp')
+        for name in SNAPSHOT_FILES:
+          self.drubs_get('%s/%s' % (node_snapshot_dir, name), '%s.tmp/%s' % (snapshot_dir, name))
+        if not env.plan_only:
+          if isdir(snapshot_dir):
+            shutil.rmtree(snapshot_dir)
+          rename(snapshot_dir + '.tmp', snapshot_dir)
+    if not env.plan_only:
+      remove_old_snapshots(env.config_dir, SNAPSHOT_KEEP)
+    print(green("Install snapshot '%s' saved." % (self.snapshot_key)))
+
+
+  def restore_snapshot(self):
+    '''
+    Restores a snapshot of a clean install (see save_snapshot()) in place of
+    drush site-install and post(), then rewrites the node's database
+    credentials, hash salt, private keys, admin account, site name and mail.
+    '''
+    print(cyan("Restoring install snapshot '%s'..." % (self.snapshot_key)))
+    snapshot_dir = self.get_snapshot_dir()
+    site_default = self.context.node['site_root'] + '/sites/default'
+    with self.node_snapshot_dir() as node_snapshot_dir:
+      if not self.context.host_is_local:
+        for name in SNAPSHOT_FILES:
+          self.drubs_put(join(snapshot_dir, name), '%s/%s' % (node_snapshot_dir, name))
+      if not env.plan_only:
+        # Marks the snapshot as recently used, see remove_old_snapshots().
+        utime(snapshot_dir, None)
+
+      self.fs.chmod(site_default, 'u+w')
+      self.drubs_run('tar -xzf %s/sites-default.tar.gz -C %s/sites' % (node_snapshot_dir, self.context.node['site_root']))
+      self.fs.chmod(site_default + '/settings.php', 'u+w')
+      if env.plan_only:
+        self.print_planned_command('rewrite database credentials and hash salt in %s/settings.php' % (site_default), cwd=False)
+      else:
+        with hide('running', 'stdout'):
+          contents = self.drubs_run('cat %s/settings.php' % (site_default), capture=True, query=True)
+        self.put_contents(rewrite_settings(contents, dict(
+          database=self.context.node['db_name'],
+          username=self.context.node['db_user'],
+          password=self.context.node['db_pass'],
+          host=self.context.node['db_host'],
+        ), hexlify(urandom(32))), site_default + '/settings.php')
+
+      print(cyan('Loading snapshot database...'))
+      with self.context.cd(self.context.node['site_root']):
+        # A truncated dump fails the load, rather than loading partially.
+        self.drubs_run('set -o pipefail; gunzip -c %s/database.sql.gz | drush sql-cli' % (node_snapshot_dir))
+    self.fs.chmod(site_default + '/files', '775')
+
+    print(cyan('Rewriting site settings...'))
+    core = env.config['project_settings'].get('drupal_core_version', '')
+    self.drush_sql_bulk([
+      'UPDATE %s SET name = %s, mail = %s, init = %s WHERE uid = 1' % (
+        'users_field_data' if core == '8' else 'users',
+        quote_string(self.context.node['account_name']),
+        quote_string(self.context.node['account_mail']),
+        quote_string(self.context.node['account_mail']),
+      ),
+    ])
+    self.drush('upwd "%s" --password="%s"' % (self.context.node['account_name'], self.context.node['account_pass']))
+    if core == '8':
+      self.drush('config-set system.site name "%s"' % (self.context.node['site_name']))
+      self.drush('config-set system.site mail "%s"' % (self.context.node['site_mail']))
+      self.drush('state-set system.cron_key %s' % (hexlify(urandom(32))))
+      self.drush('state-set system.private_key %s' % (hexlify(urandom(32))))
+    else:
+      self.drush('vset site_name "%s"' % (self.context.node['site_name']))
+      self.drush('vset site_mail "%s"' % (self.context.node['site_mail']))
+      self.drush('vset cron_key %s' % (hexlify(urandom(32))))
+      self.drush('vset drupal_private_key %s' % (hexlify(urandom(32))))
 
 
   def preconfigure(self):
@@ -364,19 +1502,41 @@ class Node(object):
   def put_files(self):
     '''
     Copies the 'files' directory to /tmp location.
+
+    Local nodes use the 'files' directory in place (self.context.files_dir points to
+    it), so nothing is copied for them.
     '''
+    if self.context.host_is_local:
+      print(cyan("Using project files in '%s'..." % (self.context.files_dir)))
+      return
     print(cyan('Copying project files...'))
-    self.drubs_run('mkdir -p /tmp/%s/files' % (env.config['project_settings']['project_name']))
-    if env.host_is_local:
-      self.drubs_run('cp -R %s/files/ /tmp/%s/' % (
-        env.config_dir,
-        env.config['project_settings']['project_name'],
-      ))
-    else:
-      put(
-        '%s/files/' % (env.config_dir),
-        '/tmp/%s/' % (env.config['project_settings']['project_name'])
-      )
+    self.ensure_directory('/tmp/%s/files' % (env.config['project_settings']['project_name']))
+    self.upload_tree(
+      '%s/files' % (env.config_dir),
+      '/tmp/%s/files' % (env.config['project_settings']['project_name']),
+    )
+
+
+  def upload_tree(self, local_root, remote_root):
+    '''
+    Uploads a local directory tree to a remote node.
+
+    Files are uploaded one by one, so that progress can report bytes as they
+    go, and directories are created in a single command.
+    '''
+    directories = [remote_root]
+    uploads = list()
+    for path, dirs, names in walk(local_root):
+      remote_path = remote_root + path[len(local_root):]
+      directories.extend(join(remote_path, name) for name in dirs)
+      uploads.extend((join(path, name), join(remote_path, name)) for name in names)
+    directories = [directory for directory in directories if directory not in self.directories]
+    if directories:
+      self.drubs_run('mkdir -p %s' % (' '.join(directories)))
+      self.directories.update(directories)
+    for local_path, remote_path in uploads:
+      self.drubs_put(local_path, remote_path)
+      self.progress.add_bytes(getsize(local_path))
 
 
   def remove_files(self):
@@ -384,7 +1544,8 @@ class Node(object):
     Removes temporarily copied files (if any).
     '''
     print(cyan('Removing project files...'))
-    self.drubs_run('rm -rf /tmp/%s' % (env.config['project_settings']['project_name']))
+    self.fs.remove('/tmp/%s' % (env.config['project_settings']['project_name']))
+    self.forget_directory('/tmp/%s' % (env.config['project_settings']['project_name']))
 
 
   def disable_apache_access(self):
@@ -394,17 +1555,9 @@ class Node(object):
     Used to temporarily return 503 during site install/update.
     '''
     print(cyan('Temporarily disabling access to site...'))
-    self.drubs_run('mkdir -p %s' % (env.node['site_root']))
-    if env.host_is_local:
-      self.drubs_run('cp %s/templates/htaccess.drubs %s/.htaccess.drubs' % (
-        env.drubs_data_dir,
-        env.node['site_root'],
-      ))
-    else:
-      put(
-        '%s/templates/htaccess.drubs' % (env.drubs_data_dir),
-        '%s/.htaccess.drubs' % (env.node['site_root'])
-      )
+    with open('%s/templates/htaccess.drubs' % (env.drubs_data_dir), 'r') as stream:
+      htaccess = stream.read().replace('DRUBS_WARMUP_TOKEN', self.warmup_token)
+    self.put_contents(htaccess, '%s/.htaccess.drubs' % (self.context.node['site_root']))
 
 
   def enable_apache_access(self):
@@ -414,37 +1567,194 @@ class Node(object):
     Used to remove 503 put in place during site install/upgrade.
     '''
     print(cyan('Re-enabling access to site...'))
-    if env.exists(env.node['site_root'] + '/.htaccess.drubs'):
-      self.drubs_run('rm %s/.htaccess.drubs' % (env.node['site_root']))
+    if self.context.exists(self.context.node['site_root'] + '/.htaccess.drubs'):
+      self.fs.remove('%s/.htaccess.drubs' % (self.context.node['site_root']))
+
+
+  def get_warmup_enabled(self):
+    return bool(self.context.node.get('site_url', '').strip() and (
+      self.context.node.get('warmup_urls', '').strip() or self.context.node.get('warmup_sitemap', '').strip()
+    ))
+
+
+  def get_web_client(self):
+    '''
+    Returns a WebClient for the node's site, which passes the 503 put in place
+    by disable_apache_access().
+    '''
+    return WebClient(
+      self.context.node['site_url'].strip(),
+      address=self.context.node.get('warmup_address', '').strip(),
+      headers={'X-Drubs-Warmup': self.warmup_token},
+    )
+
+
+  def warm_up(self):
+    '''
+    Requests a set of pages, so that Drupal's caches are warm before access to
+    the site is re-enabled.
+
+    Pages are listed in 'warmup_urls' (paths relative to 'site_url', or full
+    urls) and/or found in the sitemap at 'warmup_sitemap'.  Up to
+    'warmup_concurrency' pages are requested at a time.  Requests are sent to
+    'warmup_address' (host[:port]) instead of the site's host, if it is set.
+    '''
+    print(cyan('Warming up caches...'))
+    client = self.get_web_client()
+    concurrency = int(self.context.node.get('warmup_concurrency', '').strip() or 4)
+    paths = self.context.node.get('warmup_urls', '').replace(',', ' ').split()
+    sitemap = self.context.node.get('warmup_sitemap', '').strip()
+    if env.plan_only:
+      self.print_planned_command('GET %s%d page(s) from %s, %d at a time' % (
+        'sitemap %s and ' % (sitemap) if sitemap else '',
+        len(paths),
+        client.base_url,
+        concurrency,
+      ), cwd=False)
+      return
+    if sitemap:
+      paths.extend(self.get_sitemap_paths(client, sitemap))
+
+    started = time.time()
+    responses = client.request_all(paths, concurrency)
+    self.print_latencies('Warm-up', responses, time.time() - started)
+
+
+  def get_sitemap_paths(self, client, sitemap):
+    '''
+    Returns the pages listed in a sitemap (following one level of sitemap
+    indexes), up to WARMUP_SITEMAP_LIMIT.
+    '''
+    pages = list()
+    sitemaps = [sitemap]
+    nested = True
+    while sitemaps and len(pages) < WARMUP_SITEMAP_LIMIT:
+      url = sitemaps.pop(0)
+      try:
+        found, indexed = parse_sitemap(client.get(url))
+      except (IOError, ParseError) as e:
+        print(yellow("Could not read sitemap '%s': %s" % (url, e)))
+        continue
+      pages.extend(found)
+      if nested:
+        sitemaps.extend(indexed)
+        nested = False
+    return pages[:WARMUP_SITEMAP_LIMIT]
+
+
+  def print_latencies(self, label, responses, elapsed):
+    '''
+    Prints latency statistics for a list of webclient Responses.
+    '''
+    stats = summarize(responses)
+    print(cyan('%s: %d page(s) in %s, latency p50 %s, p95 %s, max %s' % (
+      label,
+      stats['count'],
+      format_duration(elapsed),
+      '%.3fs' % (stats['p50']) if stats['p50'] is not None else '-',
+      '%.3fs' % (stats['p95']) if stats['p95'] is not None else '-',
+      '%.3fs' % (stats['max']) if stats['max'] is not None else '-',
+    )))
+    for response in [response for response in responses if not response.ok][:10]:
+      print(yellow('  %s: %s' % (response.url, response.error or 'HTTP %s' % (response.status))))
+    if stats['failed'] > 10:
+      print(yellow('  ... and %d more failed request(s)' % (stats['failed'] - 10)))
+
+
+  def get_benchmark_enabled(self):
+    return bool(self.context.node.get('site_url', '').strip() and self.context.node.get('benchmark_urls', '').strip())
+
+
+  def run_benchmark(self, label):
+    '''
+    Benchmarks the pages in 'benchmark_urls', returning latency statistics.
+    '''
+    client = self.get_web_client()
+    paths = self.context.node['benchmark_urls'].replace(',', ' ').split()
+    repetitions = int(self.context.node.get('benchmark_requests', '').strip() or 5)
+    if env.plan_only:
+      self.print_planned_command('GET %d page(s) from %s, %d time(s) each' % (
+        len(paths),
+        client.base_url,
+        repetitions,
+      ), cwd=False)
+      return None
+    started = time.time()
+    responses = benchmark(client, paths, repetitions)
+    self.print_latencies(label, responses, time.time() - started)
+    return summarize(responses)
+
+
+  def benchmark_before(self):
+    '''
+    Benchmarks the site before an update, as a baseline for benchmark_after().
+    '''
+    print(cyan('Benchmarking site before update...'))
+    stats = self.run_benchmark('Benchmark before update')
+    if stats and stats['failed']:
+      print(yellow('Some benchmark pages could not be loaded before the update.  Skipping latency regression check...'))
+      return
+    self.benchmark_baseline = stats
+
+
+  def benchmark_after(self):
+    '''
+    Benchmarks the site after an update, failing the update if pages fail to
+    load, or if the p50 or p95 latency grew by more than 'benchmark_threshold'
+    times (default 1.5) compared to benchmark_before().
+    '''
+    if self.benchmark_baseline is None and not env.plan_only:
+      return
+    print(cyan('Benchmarking site after update...'))
+    stats = self.run_benchmark('Benchmark after update')
+    if stats is None:
+      return
+    if stats['failed']:
+      print(red('%d benchmark request(s) failed after the update. Exiting...' % (stats['failed'])))
+      exit(1)
+    threshold = float(self.context.node.get('benchmark_threshold', '').strip() or 1.5)
+    regressed = regressions(self.benchmark_baseline, stats, threshold, BENCHMARK_MIN_REGRESSION)
+    for stat, before, after in regressed:
+      print(red('%s latency regressed from %.3fs to %.3fs (%.1fx, threshold %.1fx).' % (
+        stat,
+        before,
+        after,
+        after / max(before, 0.001),
+        threshold,
+      )))
+    if regressed:
+      print(red('Site latency regressed after the update. Exiting...'))
+      exit(1)
+    print(green('No latency regression found.'))
 
 
   def check_destructive_action_protection(self):
     '''
     Prevents execution if destructive action protection is 'on' for the node.
     '''
-    if env.node['destructive_action_protection'] == 'on':
+    if self.context.node['destructive_action_protection'] == 'on':
 
       if self.site_bootstrapped():
         print(red("Destructive action protection is 'on' for node '%s', and '%s' task is potentially destructive. A properly functioning site appears to already exist. Exiting..." % (
-          env.node_name,
+          self.context.node_name,
           env.command,
         )))
         exit(1)
 
       if self.site_files_exist() or self.site_database_exists():
         print(red("Destructive action protection is 'on' for node '%s', and '%s' task is potentially destructive. An installed site does not appear to be functioning properly, but files OR the site database seem to be present.  For more information, run 'drubs status %s' or 'drubs status all'.  Exiting..." % (
-          env.node_name,
+          self.context.node_name,
           env.command,
-          env.node_name,
+          self.context.node_name,
         )))
         exit(1)
 
     else:
-      if env.no_backup and int(env.node['backup_minimum_count']) == 0 and int(env.node['backup_lifetime_days']) == 0:
+      if env.no_backup and int(self.context.node['backup_minimum_count']) == 0 and int(self.context.node['backup_lifetime_days']) == 0:
         if not env.yes:
           if not confirm(yellow("The requested operation may cause irreversible loss of data or code on node '%s'. The command has been executed using the '--no-backup' option; and 'backup_minimum_count' as well as 'backup_lifetime_days' are set to 0 for node '%s'. Continue?" % (
-            env.node_name,
-            env.node_name,
+            self.context.node_name,
+            self.context.node_name,
           )), default=False):
             print(cyan('Exiting...'))
             exit(0)
@@ -456,11 +1766,13 @@ class Node(object):
 
     Returns 1 if the site is bootstrapped, 0 otherwise.
     '''
-    if not env.exists(env.node['site_root']):
+    if not self.context.exists(self.context.node['site_root']):
       return 0
-    with env.cd(env.node['site_root']):
-      result = self.drubs_run('drush status --fields=bootstrap --no-field-labels', capture=True)
-      if (result.find('Successful') != -1):
+    with self.context.cd(self.context.node['site_root']):
+      result = self.drubs_run('drush status --fields=bootstrap --no-field-labels', capture=True, query=True, fields=dict(
+        bootstrap='Successful',
+      ))
+      if 'bootstrap' in result.fields:
         return 1
       else:
         return 0
@@ -472,7 +1784,7 @@ class Node(object):
 
     Returns 1 if site files exist, 0 otherwise.
     '''
-    if env.exists(env.node['site_root']) and env.exists(env.node['site_root'] + '/index.php'):
+    if self.context.exists(self.context.node['site_root']) and self.context.exists(self.context.node['site_root'] + '/index.php'):
       return 1
     else:
       return 0
@@ -487,19 +1799,19 @@ class Node(object):
     of mysql_config_editor tools.
     '''
     status = self.drubs_run('mysql -u %s -p%s -h %s -ss -e "SHOW DATABASES LIKE \'%s\'"' % (
-      env.node['db_user'],
-      env.node['db_pass'],
-      env.node['db_host'],
-      env.node['db_name'],
-    ), capture=True)
+      self.context.node['db_user'],
+      self.context.node['db_pass'],
+      self.context.node['db_host'],
+      self.context.node['db_name'],
+    ), capture=True, query=True)
     status.replace('Warning: Using a password on the command line interface can be insecure.', '')
     if status != '':
       table_count = self.drubs_run('mysql -u %s -p%s -h %s -ss -e "SELECT COUNT(DISTINCT table_name) FROM information_schema.columns WHERE table_schema = \'%s\'"' % (
-        env.node['db_user'],
-        env.node['db_pass'],
-        env.node['db_host'],
-        env.node['db_name'],
-      ), capture=True)
+        self.context.node['db_user'],
+        self.context.node['db_pass'],
+        self.context.node['db_host'],
+        self.context.node['db_name'],
+      ), capture=True, query=True)
       table_count.replace('Warning: Using a password on the command line interface can be insecure.', '')
       if table_count > 0:
         return 1
@@ -514,74 +1826,128 @@ class Node(object):
       self.create_backup()
 
 
-  def create_backup(self):
+  def create_backup(self, clear_cache=False):
     '''
-    Creates a drush archive dump backup of a site.
+    Creates a drush archive dump backup of a site (or, with 'backup_mode' set
+    to 'binlog', a binlog backup, see create_binlog_backup()).
+
+    If 'clear_cache' is set, caches are cleared first to keep cache tables out
+    of the archive.  Install and update do not do this, since they clear caches
+    once at the end anyway.
     '''
-    if self.site_bootstrapped():
+    bootstrapped = self.site_bootstrapped()
+    if bootstrapped and self.get_backup_mode() == 'binlog':
+      if clear_cache:
+        with self.context.cd(self.context.node['site_root']):
+          self.clear_cache()
+      with self.backup_priority():
+        self.create_binlog_backup()
+    elif bootstrapped:
       print(cyan('Creating site backup...'))
-      with env.cd(env.node['site_root']):
-        if not env.exists(env.node['backup_directory']):
-          self.drubs_run('mkdir -p %s' % (env.node['backup_directory']))
-        self.drush('cc all')
-        self.drush('archive-dump --destination="%s/%s_%s_%s.tar.gz" --preserve-symlinks' % (
-          env.node['backup_directory'],
+      with self.context.cd(self.context.node['site_root']):
+        self.ensure_directory(self.context.node['backup_directory'])
+        if clear_cache:
+          self.clear_cache()
+        backup_file = '%s/%s_%s_%s.tar.gz' % (
+          self.context.node['backup_directory'],
           env.config['project_settings']['project_name'],
-          env.node_name,
+          self.context.node_name,
           time.strftime("%Y-%m-%d_%H-%M-%S"),
-        ))
+        )
+        with self.backup_priority():
+          self.archive_dump(backup_file)
+        self.measure_backup([backup_file])
     else:
       print(cyan('No pre-existing properly-functioning site found.  Skipping backup...'))
 
 
+  def archive_dump(self, backup_file):
+    '''
+    Runs drush archive-dump, writing the archive through backup_write().
+
+    drush builds archives in place (appending to the tarball, then compressing
+    it) rather than writing them to a pipe.  With a write-rate limit, the
+    archive is built in a temporary directory only the node's user can read,
+    then written to the backup directory through pv.
+    '''
+    write = self.backup_write(backup_file)
+    if write == '> %s' % (backup_file):
+      self.drush('archive-dump --destination="%s" --preserve-symlinks' % (backup_file))
+      return
+    with hide('running', 'stdout'):
+      archive_dir = self.drubs_run('umask 077 && mktemp -d /tmp/drubs-archive-XXXXXXXX', capture=True).strip() or '/tmp/drubs-archive-XXXXXXXX'
+    try:
+      archive = join(archive_dir, basename(backup_file))
+      self.drush('archive-dump --destination="%s" --preserve-symlinks' % (archive))
+      self.drubs_run('set -o pipefail; cat %s %s' % (archive, write))
+    finally:
+      self.drubs_run('rm -rf %s' % (archive_dir))
+
+
+  def measure_backup(self, paths):
+    '''
+    Records the size of a new backup's gzipped files, and their size
+    uncompressed, in the action's metrics.
+    '''
+    if env.plan_only:
+      return
+    with hide('running', 'stdout'):
+      sizes = self.drubs_run("gzip -lq %s | awk '{ size += $1; uncompressed += $2 } END { print size, uncompressed }'" % (
+        ' '.join(paths),
+      ), capture=True).split()
+    if len(sizes) != 2:
+      return
+    size, uncompressed_size = int(sizes[0]), int(sizes[1])
+    self.progress.add_bytes(size)
+    self.metrics.set('backup_bytes', size)
+    ratio = compression_ratio(size, uncompressed_size)
+    if ratio is not None:
+      self.metrics.set('backup_uncompressed_bytes', uncompressed_size)
+      self.metrics.set('backup_compression_ratio', ratio)
+
+
   def restore_latest_backup(self):
     '''
     Restores a drush archive dump backup of a site.
     '''
+    if self.get_backup_mode() == 'binlog':
+      self.restore_binlog_backup()
+      return
     print(cyan('Restoring latest site backup...'))
 
     # Make the backup directory if for some reason it doesn't already exist.
-    if not env.exists(env.node['backup_directory']):
-      self.drubs_run('mkdir -p %s' % (env.node['backup_directory']))
+    self.ensure_directory(self.context.node['backup_directory'])
 
-    with env.cd(env.node['backup_directory']):
+    with self.context.cd(self.context.node['backup_directory']):
 
       # Get a list of available backup files sorted with newest first.
-      backup_files = self.drubs_run("ls -1 %s | grep -E '%s_%s_[0-9]{4}\-[0-9]{2}\-[0-9]{2}_[0-9]{2}\-[0-9]{2}\-[0-9]{2}\.tar\.gz' | awk '{print \"%s/\" $0}'" % (
-        env.node['backup_directory'],
-        env.config['project_settings']['project_name'],
-        env.node_name,
-        env.node['backup_directory'],
-      ), capture=True)
-      backup_files = backup_files.splitlines()
-      backup_files.sort(reverse=True)
+      backup_files = self.list_archive_backups()
 
-      # If backup files exist, restore the latest backup file.
+      # If backup files exist, restore the latest intact backup file.
       if len(backup_files) > 0:
-        latest_backup_file = backup_files[0]
-        if env.exists(latest_backup_file):
-          if not env.exists(env.node['site_root']):
-            self.drubs_run('mkdir -p %s' % (env.node['site_root']))
-          with env.cd(env.node['site_root']):
+        latest_backup_file = self.newest_intact_archive(backup_files)
+        if latest_backup_file:
+          self.ensure_directory(self.context.node['site_root'])
+          with self.context.cd(self.context.node['site_root']):
             self.drush('archive-restore %s --overwrite --destination="%s"' % (
               latest_backup_file,
-              env.node['site_root'],
+              self.context.node['site_root'],
             ))
-            self.drush('cc all')
+            self.clear_cache()
             print(green("Latest backup '%s' restored to '%s' on node '%s'..." % (
               latest_backup_file,
-              env.node['site_root'],
-              env.node_name,
+              self.context.node['site_root'],
+              self.context.node_name,
             )))
         else:
-          print(red("Latest backup file does not exist or cannot be read in '%s' on node '%s'..." % (
-            env.node['backup_directory'],
-            env.node_name,
+          print(red("No intact backup file found in '%s' on node '%s'.  Cannot restore..." % (
+            self.context.node['backup_directory'],
+            self.context.node_name,
           )))
       else:
         print(red("No backup files found in '%s' on node '%s'.  Cannot restore..." % (
-          env.node['backup_directory'],
-          env.node_name,
+          self.context.node['backup_directory'],
+          self.context.node_name,
         )))
 
 
@@ -589,24 +1955,19 @@ class Node(object):
     '''
     Removes existing backup files based on the node's backup settings.
     '''
+    if self.get_backup_mode() == 'binlog':
+      self.remove_old_binlog_backups()
+      return
     print(cyan("Checking for site backups to be removed..."))
 
     # Make the backup directory if for some reason it doesn't already exist.
-    if not env.exists(env.node['backup_directory']):
-      self.drubs_run('mkdir -p %s' % (env.node['backup_directory']))
+    self.ensure_directory(self.context.node['backup_directory'])
 
     # Get a list of available backup files sorted with newest first.
-    backup_files = self.drubs_run("ls -1 %s | grep -E '%s_%s_[0-9]{4}\-[0-9]{2}\-[0-9]{2}_[0-9]{2}\-[0-9]{2}\-[0-9]{2}\.tar\.gz' | awk '{print \"%s/\" $0}'" % (
-      env.node['backup_directory'],
-      env.config['project_settings']['project_name'],
-      env.node_name,
-      env.node['backup_directory'],
-    ), capture=True)
-    backup_files = backup_files.splitlines()
-    backup_files.sort(reverse=True)
+    backup_files = self.list_archive_backups()
 
     # Exclude the first n items from the list, where n is backup_minimum_count.
-    del backup_files[:int(env.node['backup_minimum_count'])]
+    del backup_files[:int(self.context.node['backup_minimum_count'])]
 
     # Delete any remaining backup files in the list that are older than
     # backup_lifetime_days, if the list still has backups in it.
@@ -615,17 +1976,455 @@ class Node(object):
         match = search(r'\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}', backup_filename)
         backup_time = datetime.strptime(match.group(), '%Y-%m-%d_%H-%M-%S')
         now = datetime.now()
-        if backup_time < (now - timedelta(days=int(env.node['backup_lifetime_days']))):
-          self.drubs_run('rm -f %s' % (backup_filename))
+        if backup_time < (now - timedelta(days=int(self.context.node['backup_lifetime_days']))):
+          self.fs.remove(backup_filename)
+
+
+  def list_archive_backups(self):
+    '''
+    Returns the paths of the node's archive backup files, newest first.
+    '''
+    backup_files = self.drubs_run("ls -1 %s | grep -E '%s_%s_[0-9]{4}\-[0-9]{2}\-[0-9]{2}_[0-9]{2}\-[0-9]{2}\-[0-9]{2}\.tar\.gz' | awk '{print \"%s/\" $0}'" % (
+      self.context.node['backup_directory'],
+      env.config['project_settings']['project_name'],
+      self.context.node_name,
+      self.context.node['backup_directory'],
+    ), capture=True, query=True)
+    backup_files = backup_files.splitlines()
+    backup_files.sort(reverse=True)
+    return backup_files
+
+
+  def get_backup_mode(self):
+    '''
+    Returns the node's 'backup_mode': 'archive' (drush archive-dump, the
+    default) or 'binlog' (see create_binlog_backup()).
+    '''
+    mode = self.context.node.get('backup_mode', '').strip() or 'archive'
+    if mode not in ('archive', 'binlog'):
+      print(red("Unknown backup_mode '%s' for node '%s'. Exiting..." % (mode, self.context.node_name)))
+      exit(1)
+    return mode
+
+
+  @contextmanager
+  def backup_priority(self):
+    '''
+    Runs the commands issued in the block at the node's backup CPU and IO
+    priority, so that backups compete less with the site's traffic:
+    'backup_nice' (a niceness, 0-19) and 'backup_ionice' (options for ionice,
+    for example '-c 3' for the idle class).
+    '''
+    commands = list()
+    if self.context.node.get('backup_nice', '').strip():
+      commands.append('renice -n %s -p $$ >/dev/null' % (self.context.node['backup_nice'].strip()))
+    if self.context.node.get('backup_ionice', '').strip():
+      commands.append('ionice %s -p $$' % (self.context.node['backup_ionice'].strip()))
+    if not commands:
+      yield
+      return
+    # Commands issued under the context's prefix() run in a shell which first
+    # lowers its own priority; every process of the command inherits it.
+    with self.context.prefix(' && '.join(commands)):
+      yield
+
+
+  def backup_write(self, path):
+    '''
+    Returns the end of a shell pipeline writing a backup file, limited to the
+    node's 'backup_write_mbps' (if set, and pv is installed on the node).
+    '''
+    rate = float(self.context.node.get('backup_write_mbps', '').strip() or '0')
+    if rate <= 0:
+      return '> %s' % (path)
+    if self.pv_installed is None:
+      with hide('running', 'stdout'):
+        self.pv_installed = self.drubs_run('command -v pv >/dev/null 2>&1 && echo yes || true', capture=True, query=True) == 'yes'
+      if not self.pv_installed:
+        print(yellow("pv is not installed on node '%s'; backups are written without a rate limit..." % (self.context.node_name)))
+    if not self.pv_installed:
+      return '> %s' % (path)
+    return '| pv -q -L %dk > %s' % (rate * 1024, path)
+
+
+  def get_backup_prefix(self):
+    return '%s_%s' % (env.config['project_settings']['project_name'], self.context.node_name)
+
+
+  def get_mysql_options(self):
+    return '-h%s -u%s -p%s' % (
+      self.context.node['db_host'],
+      self.context.node['db_user'],
+      self.context.node['db_pass'],
+    )
+
+
+  def list_binlog_backups(self):
+    return parse_backups(self.fs.list(self.context.node['backup_directory']), self.get_backup_prefix())
+
+
+  def create_binlog_backup(self):
+    '''
+    Creates an incremental backup of a site, using MySQL's binary log.
+
+    Each backup is a directory in the node's backup_directory holding an
+    archive of the site root ('files.tar.gz') and the binary log position it
+    ends at ('position').  A base backup ('.base') also holds a full dump of
+    the database; every later backup ('.incr') holds only the part of the
+    binary log written since the backup before it.  A new base is taken once
+    the last one is 'backup_base_days' old, after a restore, or when binary
+    logs needed for an increment have been purged.
+
+    Requires binary logging on the database server, and a database user with
+    the RELOAD and REPLICATION CLIENT/SLAVE privileges (and SUPER or
+    BINLOG_ADMIN, to restore).
+    '''
+    backup_directory = self.context.node['backup_directory']
+    self.ensure_directory(backup_directory)
+    chain = restore_chain(self.list_binlog_backups())
+    restored_marker = join(backup_directory, self.get_backup_prefix() + '.restored')
+    base_days = int(self.context.node.get('backup_base_days', '').strip() or '7')
+    if not chain:
+      self.create_binlog_base()
+    elif chain[0].time < datetime.now() - timedelta(days=base_days):
+      print(cyan("Latest base backup is more than %d day(s) old..." % (base_days)))
+      self.create_binlog_base()
+    elif self.context.exists(restored_marker):
+      print(cyan('Site has been restored since the latest backup...'))
+      self.create_binlog_base()
+      self.fs.remove(restored_marker)
+    else:
+      self.create_binlog_increment(chain[-1])
+
+
+  def create_binlog_base(self):
+    print(cyan('Creating base site backup...'))
+    path = join(self.context.node['backup_directory'], backup_name(self.get_backup_prefix(), BASE, datetime.now()))
+    self.fs.mkdir(path)
+    dump = join(path, 'database.sql.gz')
+    # --master-data=2 records (as a comment) the binary log position the dump
+    # is consistent with, where the next increment starts.
+    self.drubs_run('mysqldump %s --single-transaction --master-data=2 --flush-logs --routines --triggers %s | gzip %s' % (
+      self.get_mysql_options(),
+      self.context.node['db_name'],
+      self.backup_write(dump),
+    ))
+    # Output piped to gzip hides a failed mysqldump; a complete dump ends with
+    # a 'Dump completed' comment.
+    tail = self.drubs_run('gunzip -c %s | tail -n 1' % (dump), capture=True, fields=dict(completed='Dump completed'))
+    if not env.plan_only and 'completed' not in tail.fields:
+      print(red("Database dump '%s' is incomplete. Exiting..." % (dump)))
+      exit(1)
+    head = self.drubs_run('gunzip -c %s | head -n 50' % (dump), capture=True, fields=dict(
+      file=LOG_FILE_PATTERN,
+      position=LOG_POS_PATTERN,
+    ))
+    if not env.plan_only and len(head.fields) < 2:
+      print(red("No binary log position found in '%s'.  Is binary logging enabled on the database server? Exiting..." % (dump)))
+      exit(1)
+    self.finish_binlog_backup(path, head.fields.get('file'), head.fields.get('position'))
+    self.measure_backup([dump, join(path, 'files.tar.gz')])
+
+
+  def create_binlog_increment(self, previous):
+    '''
+    Creates a backup holding the binary log since the backup 'previous'.
+    '''
+    backup_directory = self.context.node['backup_directory']
+    start = self.drubs_run('cat %s' % (join(backup_directory, previous.name, 'position')), capture=True, query=True).split()
+    logs = self.drubs_run('mysql %s -ss -e "SHOW BINARY LOGS"' % (self.get_mysql_options()), capture=True, query=True)
+    end = self.drubs_run('mysql %s -ss -e "SHOW MASTER STATUS"' % (self.get_mysql_options()), capture=True, query=True).split()
+    log_files = log_range(logs, start[0], end[0]) if len(start) == 2 and len(end) >= 2 else None
+    if log_files is None:
+      print(yellow("The binary logs since backup '%s' are no longer available..." % (previous.name)))
+      self.create_binlog_base()
+      return
+
+    print(cyan("Creating incremental site backup (since '%s')..." % (previous.name)))
+    path = join(backup_directory, backup_name(self.get_backup_prefix(), INCREMENT, datetime.now()))
+    self.fs.mkdir(path)
+    binlog = join(path, 'binlog.sql.gz')
+    try:
+      self.drubs_run('set -o pipefail; mysqlbinlog --read-from-remote-server %s --database=%s --start-position=%s --stop-position=%s %s | gzip %s' % (
+        self.get_mysql_options(),
+        self.context.node['db_name'],
+        start[1],
+        end[1],
+        ' '.join(log_files),
+        self.backup_write(binlog),
+      ))
+      # A complete binary log dump ends with an 'End of log file' comment (and
+      # a few statements resetting the session).
+      tail = self.drubs_run('gunzip -c %s | tail -n 5' % (binlog), capture=True, fields=dict(completed='End of log file'))
+      if not env.plan_only and 'completed' not in tail.fields:
+        print(red("Binary log dump '%s' is incomplete. Exiting..." % (binlog)))
+        exit(1)
+    except SystemExit:
+      # An increment missing part of the binary log would leave a hole in the
+      # database restored from it: the next backup starts from the last
+      # complete one instead.
+      self.fs.remove(path)
+      raise
+    self.finish_binlog_backup(path, end[0], end[1])
+    self.measure_backup([binlog, join(path, 'files.tar.gz')])
+
+
+  def finish_binlog_backup(self, path, log_file, log_position):
+    '''
+    Archives the site root into a binlog backup and records its position.  The
+    position is written last: backups without one are incomplete.
+    '''
+    self.drubs_run('tar -czf - -C %s . %s' % (self.context.node['site_root'], self.backup_write(join(path, 'files.tar.gz'))))
+    self.put_contents('%s %s\n' % (log_file, log_position), join(path, 'position'))
+    print(green("Backup '%s' created on node '%s'..." % (path, self.context.node_name)))
+
+
+  def restore_binlog_backup(self, name=None):
+    '''
+    Restores a binlog backup (the latest by default): the site root from its
+    archive, and the database from its base dump and every increment since.
+    '''
+    print(cyan('Restoring latest site backup...'))
+    backup_directory = self.context.node['backup_directory']
+    self.ensure_directory(backup_directory)
+    backups = self.list_binlog_backups()
+    chain = restore_chain(backups, name)
+    while chain:
+      intact = self.intact_binlog_chain(chain)
+      if intact:
+        if intact != chain:
+          print(yellow("Backup '%s' is damaged; restoring '%s' instead..." % (chain[len(intact)].name, intact[-1].name)))
+        chain = intact
+        break
+      print(yellow("Base backup '%s' is damaged; trying an earlier backup..." % (chain[0].name)))
+      chain = restore_chain([backup for backup in backups if backup.time < chain[0].time])
+    if not chain:
+      print(red("No backup files found in '%s' on node '%s'.  Cannot restore..." % (
+        backup_directory,
+        self.context.node_name,
+      )))
+      return
+    target = join(backup_directory, chain[-1].name)
+
+    self.ensure_directory(self.context.node['site_root'])
+    if self.context.exists(self.context.node['site_root'] + '/sites/default'):
+      self.fs.chmod(self.context.node['site_root'] + '/sites/default', 'u+w')
+    self.fs.discard_children(self.context.node['site_root'], self.get_trash_dir(), keep=['.htaccess.drubs'])
+    self.drubs_run('tar -xzf %s -C %s' % (join(target, 'files.tar.gz'), self.context.node['site_root']))
+
+    self.provision_database()
+    self.drubs_run('gunzip -c %s | mysql %s %s' % (
+      join(backup_directory, chain[0].name, 'database.sql.gz'),
+      self.get_mysql_options(),
+      self.context.node['db_name'],
+    ))
+    for increment in chain[1:]:
+      print(cyan("Replaying binary log from '%s'..." % (increment.name)))
+      self.drubs_run('gunzip -c %s | mysql %s %s' % (
+        join(backup_directory, increment.name, 'binlog.sql.gz'),
+        self.get_mysql_options(),
+        self.context.node['db_name'],
+      ))
+    # The restore itself is in the binary log now; start a new chain.
+    self.fs.touch(join(backup_directory, self.get_backup_prefix() + '.restored'))
+
+    with self.context.cd(self.context.node['site_root']):
+      self.clear_cache()
+    print(green("Backup '%s' restored to '%s' on node '%s'..." % (
+      target,
+      self.context.node['site_root'],
+      self.context.node_name,
+    )))
+
+
+  def remove_old_binlog_backups(self):
+    '''
+    Removes binlog backups based on the node's backup settings (see
+    binlog.removable_backups()).
+    '''
+    print(cyan("Checking for site backups to be removed..."))
+    self.ensure_directory(self.context.node['backup_directory'])
+    for backup in removable_backups(
+      self.list_binlog_backups(),
+      self.context.node['backup_minimum_count'],
+      self.context.node['backup_lifetime_days'],
+    ):
+      self.fs.remove(join(self.context.node['backup_directory'], backup.name), force=True)
+
+
+  def list_backup_files(self):
+    '''
+    Returns the paths (relative to backup_directory) of every file in the
+    node's complete backups, oldest first.
+    '''
+    if self.get_backup_mode() == 'archive':
+      return [basename(path) for path in reversed(self.list_archive_backups())]
+    names = list()
+    for backup in self.list_binlog_backups():
+      files = self.fs.list(join(self.context.node['backup_directory'], backup.name))
+      # Backups without a position were interrupted.
+      if 'position' in files:
+        names.extend(join(backup.name, name) for name in sorted(files) if '.partial-' not in name)
+    return names
+
+
+  def get_verify_concurrency(self):
+    return int(self.context.node.get('verify_concurrency', '').strip() or '4')
+
+
+  def verify_backup_files(self, names):
+    '''
+    Checks backup files (named relative to backup_directory), streaming each
+    through sha256sum and 'gzip -t' on the node, 'verify_concurrency' files at
+    a time, and records the results (see verify.update_record()).
+
+    Returns a dict of name => whether the file is intact.  Files which are not
+    gzipped are only checked to exist.
+    '''
+    backup_directory = self.context.node['backup_directory']
+    gzipped = [name for name in names if name.endswith('.gz')]
+    if env.plan_only:
+      if gzipped:
+        self.print_planned_command(verify_command([join(backup_directory, name) for name in gzipped], self.get_verify_concurrency()), cwd=False)
+      return dict((name, True) for name in names)
+    intact = dict((name, self.context.exists(join(backup_directory, name))) for name in names if name not in gzipped)
+    if not gzipped:
+      return intact
+    paths = [join(backup_directory, name) for name in gzipped]
+    size = sum(self.file_size(path) for path in paths)
+    started = time.time()
+    print(cyan('Verifying %d backup file(s)...' % (len(paths))))
+    with hide('running', 'stdout'), self.backup_priority():
+      output = self.drubs_run(verify_command(paths, self.get_verify_concurrency()), capture=True, query=True)
+    seconds = time.time() - started
+    results = parse_results(output, paths)
+    record_path = record_file(env.config_dir, self.context.node_name)
+    record = load_record(record_path)
+    checked = update_record(record, dict((name, results[join(backup_directory, name)]) for name in gzipped))
+    save_record(record_path, record)
+    for name in gzipped:
+      intact[name] = checked[name][0]
+      if not intact[name]:
+        print(red("Backup file '%s' is damaged or unreadable..." % (join(backup_directory, name))))
+    print(cyan('Verified %.1f MB in %s (%s)...' % (size / 1000000.0, format_duration(seconds), format_rate(size, seconds))))
+    return intact
+
+
+  def newest_intact_archive(self, backup_files):
+    '''
+    Returns the newest of a list of archive backup paths (newest first) which
+    verifies as intact, checking them in batches of 'verify_concurrency'.
+    '''
+    batch_size = self.get_verify_concurrency()
+    for start in range(0, len(backup_files), batch_size):
+      batch = backup_files[start:start + batch_size]
+      intact = self.verify_backup_files([basename(path) for path in batch])
+      for path in batch:
+        if intact[basename(path)]:
+          if path != backup_files[0]:
+            print(yellow("Latest backup '%s' is damaged; restoring '%s' instead..." % (backup_files[0], path)))
+          return path
+    return None
+
+
+  def intact_binlog_chain(self, chain):
+    '''
+    Verifies the backups of a binlog chain, returning the longest intact part
+    of it (from its base), which is empty if the base is damaged.
+    '''
+    files = dict()
+    for backup in chain:
+      files[backup.name] = [join(backup.name, name) for name in self.fs.list(join(self.context.node['backup_directory'], backup.name))]
+    intact = self.verify_backup_files([name for backup in chain for name in files[backup.name]])
+    for index, backup in enumerate(chain):
+      if join(backup.name, 'position') not in files[backup.name] or not all(intact[name] for name in files[backup.name]):
+        return chain[:index]
+    return chain
+
+
+  def verify_backups(self):
+    '''
+    Verifies every backup of the node (see verify_backup_files()), exiting if
+    any is damaged.
+    '''
+    print(cyan("Verifying backups of node '%s'..." % (self.context.node_name)))
+    names = self.list_backup_files()
+    intact = self.verify_backup_files(names)
+    damaged = [name for name in names if not intact[name]]
+    if damaged:
+      print(red('%d of %d backup file(s) are damaged. Exiting...' % (len(damaged), len(names))))
+      exit(1)
+    print(green('All %d backup file(s) are intact.' % (len(names))))
+
+
+  def get_replica_store(self):
+    '''
+    Returns the ChunkStore a node's backups are replicated to: 'replicate_to',
+    either a directory on the controller (by default .drubs/replicas in the
+    project's config directory) or '<node>:<directory>' on another node.
+    '''
+    destination = self.context.node.get('replicate_to', '').strip()
+    if ':' in destination:
+      node_name, path = destination.split(':', 1)
+      if node_name not in env.config['nodes']:
+        print(red("No node named '%s' (in replicate_to for node '%s') found. Exiting..." % (node_name, self.context.node_name)))
+        exit(1)
+      other = env.config['nodes'][node_name]
+      if other['server_host'].strip() in local_identity():
+        return ChunkStore(LocalPaths(), path)
+      return ChunkStore(SftpPaths('%s@%s:%s' % (
+        other['server_user'].strip(),
+        other['server_host'].strip(),
+        other['server_port'].strip(),
+      )), path)
+    return ChunkStore(LocalPaths(), join(env.config_dir, destination or join('.drubs', 'replicas')))
+
+
+  def replicate_backups(self):
+    '''
+    Copies the node's backups, not yet replicated, to its replica store (see
+    get_replica_store() and replicate.replicate_file()).
+
+    Files are sent in checksummed chunks, 'replicate_concurrency' at a time,
+    within 'replicate_bandwidth_kbps' (if set).  Chunks already in the store
+    are not sent again, so an interrupted replication resumes when run again.
+    '''
+    print(cyan("Replicating backups of node '%s'..." % (self.context.node_name)))
+    store = self.get_replica_store()
+    rate = RateLimit(int(self.context.node.get('replicate_bandwidth_kbps', '').strip() or '0') * 1024)
+    workers = int(self.context.node.get('replicate_concurrency', '').strip() or '4')
+    names = self.list_backup_files()
+    if env.plan_only:
+      for name in names:
+        self.print_planned_command('replicate %s/%s to %s' % (self.context.node['backup_directory'], name, store.root), cwd=False)
+      return
+    source = LocalPaths() if self.context.host_is_local else SftpPaths(self.context.host_string)
+    for name in names:
+      path = join(self.context.node['backup_directory'], name)
+      replica = join(self.context.node_name, name)
+      manifest = store.get_manifest(replica)
+      if manifest and manifest['size'] == source.size(path):
+        continue
+      if self.context.host_is_local:
+        checksums = file_checksums(path)
+      else:
+        with hide('running', 'stdout'):
+          checksums = self.drubs_run(checksums_command(path), capture=True, query=True).split()
+      try:
+        sent = replicate_file(source, path, checksums, store, replica, workers=workers, rate=rate)
+      except IOError as e:
+        print(red('%s  Replicate again to resume. Exiting...' % (e)))
+        exit(1)
+      print(green("Replicated '%s' (%d of %d chunks sent)..." % (path, sent, len(checksums))))
 
 
   def get_requirement_version(self, check_command, version_command):
     '''
     Gets the version for software if it exists.
     '''
-    requirement = self.drubs_run(check_command, capture=True)
+    requirement = self.drubs_run(check_command, capture=True, query=True)
     if (requirement.return_code == 0):
-      version = self.drubs_run(version_command, capture=True)
+      version = self.drubs_run(version_command, capture=True, query=True)
     else:
       version = red("Missing")
     return version
@@ -655,8 +2454,8 @@ class Node(object):
 
     with quiet():
 
-      status_table.add_row(['Node name', env.node_name])
-      status_table.add_row(['Hostname', env.node['server_host']])
+      status_table.add_row(['Node name', self.context.node_name])
+      status_table.add_row(['Hostname', self.context.node['server_host']])
 
       if self.site_bootstrapped():
         bootstrap = green('yes')
@@ -676,7 +2475,7 @@ class Node(object):
         files = red('no')
       status_table.add_row(['Site files exist', files])
 
-      distro = self.drubs_run('lsb_release -ds 2>/dev/null || cat /etc/*release 2>/dev/null | head -n1 || uname -om', capture=True)
+      distro = self.drubs_run('lsb_release -ds 2>/dev/null || cat /etc/*release 2>/dev/null | head -n1 || uname -om', capture=True, query=True)
       status_table.add_row(['Server OS', distro])
 
       req = self.get_requirement_versions_per_node()
@@ -695,10 +2494,7 @@ class Node(object):
     '''
     Prints the elapsed time.
     '''
-    seconds = time.time() - env.start_time
-    m, s = divmod(seconds, 60)
-    h, m = divmod(m, 60)
-    print(cyan("Elapsed time: %dh:%02dm:%02ds" % (h, m, s)))
+    print(cyan("Elapsed time: %s" % (format_duration(time.time() - self.context.start_time))))
 
 
   @contextmanager
@@ -712,7 +2508,9 @@ class Node(object):
 
       # Restore site from backup if allowed by command options.
       if not env.no_restore:
+        started = time.time()
         self.restore_latest_backup()
+        self.metrics.set('restore_duration', round(time.time() - started, 3))
       else:
         print(yellow("Command was executed with the '--no-backup' or '--no-restore' option.  No site backup has been restored..."))
 
@@ -0,0 +1,74 @@
+class Step(object):
+  '''
+  A single step in the pipeline of a node action.
+
+  name              - a short name for the step, as printed in plans.
+  func              - the callable which performs the step.
+  guarded           - run the step inside Node.cleanup_on_failure(), so that a
+                      failure restores the latest backup.
+  clears_cache      - the step leaves Drupal's caches stale.  Rather than
+                      clearing them itself, it relies on the plan to clear them
+                      once, later.
+  needs_clean_cache - the step must not run while caches are stale.
+  after             - if set (even to an empty list), the step may run at the
+                      same time as its neighbouring steps which also set it,
+                      once the steps named in it are done.  See
+                      Node.run_concurrently().
+  '''
+
+  def __init__(self, name, func, guarded=False, clears_cache=False, needs_clean_cache=False, after=None):
+    self.name = name
+    self.func = func
+    self.guarded = guarded
+    self.clears_cache = clears_cache
+    self.needs_clean_cache = needs_clean_cache
+    self.after = after
+
+
+  def __repr__(self):
+    return '<Step %s>' % (self.name)
+
+
+class Plan(object):
+  '''
+  An ordered list of steps making up a node action (install, update, etc.).
+
+  Steps are added in their natural order.  Before it is run, a plan is
+  coalesced: all cache clears needed by the steps are merged into as few
+  'clear_cache' steps as possible - one at the end of the guarded part of the
+  plan, unless a step needs clean caches earlier.
+  '''
+
+  def __init__(self, action, clear_cache):
+    self.action = action
+    self.clear_cache = clear_cache
+    self.steps = list()
+
+
+  def add(self, name, func, **kwargs):
+    self.steps.append(Step(name, func, **kwargs))
+    return self
+
+
+  def coalesced(self):
+    '''
+    Returns the coalesced list of steps to run.
+    '''
+    steps = list()
+    stale = None
+    for step in self.steps:
+      # Flush stale caches before a step that needs them clean, or before
+      # leaving the guarded (or unguarded) part of the plan that staled them.
+      if stale and (step.needs_clean_cache or step.guarded != stale.guarded):
+        steps.append(self.clear_cache_step(stale.guarded))
+        stale = None
+      steps.append(step)
+      if step.clears_cache:
+        stale = step
+    if stale:
+      steps.append(self.clear_cache_step(stale.guarded))
+    return steps
+
+
+  def clear_cache_step(self, guarded):
+    return Step('clear_cache', self.clear_cache, guarded=guarded)
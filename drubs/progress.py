@@ -0,0 +1,174 @@
+import sys
+import time
+import threading
+import multiprocessing
+from fabric.colors import cyan
+from history import format_duration
+
+
+def format_bytes(count):
+  '''
+  Formats a byte count in human readable units.
+  '''
+  for unit in ('B', 'KB', 'MB', 'GB'):
+    if count < 1024 or unit == 'GB':
+      break
+    count /= 1024.0
+  return ('%d %s' if unit == 'B' else '%.1f %s') % (count, unit)
+
+
+class Progress(object):
+  '''
+  Reports progress through the steps of a running plan.
+
+  Expected step durations come from the node's step history.  While a plan
+  runs, a background thread prints a one-line update every 'interval' seconds:
+  the current step, the percentage of the expected total time used, an ETA and
+  the number of bytes transferred so far.  Updates are plain lines, so they
+  work in CI logs as well as on a terminal.
+  '''
+
+  def __init__(self, steps, interval=15, stream=None):
+    # A list of (step name, expected duration in seconds or None).
+    self.steps = steps
+    self.interval = interval
+    self.stream = stream or sys.stdout
+    self.expected_total = sum(estimate or 0 for name, estimate in steps)
+    self.index = -1
+    self.started = None
+    self.step_started = None
+    self.bytes = 0
+    # Stand-ins for this Progress in other processes, see share().
+    self.shared = list()
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.thread = None
+
+
+  def start(self):
+    self.started = time.time()
+    self.thread = threading.Thread(target=self.report_periodically)
+    self.thread.daemon = True
+    self.thread.start()
+
+
+  def stop(self):
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join()
+
+
+  def start_step(self, name):
+    with self.lock:
+      self.index = [step[0] for step in self.steps].index(name, self.index + 1)
+      self.step_started = time.time()
+
+
+  def add_bytes(self, count):
+    '''
+    Adds to the number of bytes transferred (uploads, backups, streams).
+    '''
+    with self.lock:
+      self.bytes += count
+
+
+  def share(self):
+    '''
+    Returns a stand-in for this Progress in the processes of concurrent steps
+    (see Node.run_concurrently()).  The bytes they transfer are counted here
+    as they are transferred.
+    '''
+    shared = SharedProgress()
+    with self.lock:
+      self.shared.append(shared)
+    return shared
+
+
+  def collect(self, shared):
+    '''
+    Adds the bytes counted by a stand-in from share(), once its processes are
+    done.
+    '''
+    with self.lock:
+      self.shared.remove(shared)
+      self.bytes += shared.bytes()
+
+
+  def report_periodically(self):
+    while not self.stopped.wait(self.interval):
+      self.report()
+
+
+  def status(self):
+    '''
+    Returns a one-line description of the current progress.
+    '''
+    with self.lock:
+      now = time.time()
+      name, estimate = self.steps[self.index]
+      step_elapsed = now - self.step_started
+      parts = ['%s (%d/%d)' % (name, self.index + 1, len(self.steps))]
+      if estimate:
+        parts.append('step %s of ~%s' % (format_duration(step_elapsed), format_duration(estimate)))
+      else:
+        parts.append('step %s, no history' % (format_duration(step_elapsed)))
+      if self.expected_total:
+        remaining = max(0, (estimate or 0) - step_elapsed)
+        remaining += sum(step[1] or 0 for step in self.steps[self.index + 1:])
+        parts.append('%d%% of ~%s' % (
+          100 * (now - self.started) / self.expected_total,
+          format_duration(self.expected_total),
+        ))
+        parts.append('ETA %s' % (format_duration(remaining)))
+      transferred = self.bytes + sum(shared.bytes() for shared in self.shared)
+      if transferred:
+        parts.append('%s transferred' % (format_bytes(transferred)))
+    return 'Progress: ' + ' | '.join(parts)
+
+
+  def report(self):
+    if self.index < 0:
+      return
+    line = self.status()
+    if self.stream.isatty():
+      line = cyan(line)
+    self.stream.write(line + '\n')
+    self.stream.flush()
+
+
+class NoProgress(object):
+  '''
+  Stands in for Progress when no plan is running.
+  '''
+
+  def start_step(self, name):
+    pass
+
+  def add_bytes(self, count):
+    pass
+
+  def share(self):
+    return self
+
+  def collect(self, shared):
+    pass
+
+
+class SharedProgress(object):
+  '''
+  Stands in for Progress in other processes, counting bytes in shared memory,
+  see Progress.share().
+  '''
+
+  def __init__(self):
+    self.counter = multiprocessing.Value('d', 0)
+
+  def start_step(self, name):
+    pass
+
+  def add_bytes(self, count):
+    with self.counter.get_lock():
+      self.counter.value += count
+
+  def bytes(self):
+    return int(self.counter.value)
@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import errno
+import threading
+from Queue import Queue
+from hashlib import sha256
+from os.path import join, dirname, getsize, lexists
+from fabric.state import connections
+
+
+# Backups are replicated in chunks of this many bytes.  Each chunk is stored
+# once, under its checksum, so a transfer resumes from the chunks already
+# stored, and chunks the store already holds (from any backup) are not sent.
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Bytes read at a time while sending a chunk, see RateLimit.
+READ_SIZE = 64 * 1024
+
+
+class RateLimit(object):
+  '''
+  Caps the combined rate at which threads transfer data.
+  '''
+
+  def __init__(self, bytes_per_second=0):
+    self.bytes_per_second = bytes_per_second
+    self.lock = threading.Lock()
+    self.next_time = time.time()
+
+
+  def consume(self, size):
+    '''
+    Waits until 'size' more bytes may be transferred.
+    '''
+    if not self.bytes_per_second:
+      return
+    with self.lock:
+      now = time.time()
+      start = max(now, self.next_time)
+      self.next_time = start + float(size) / self.bytes_per_second
+    if start > now:
+      time.sleep(start - now)
+
+
+class LocalPaths(object):
+  '''
+  Files on the machine drubs is running on.
+  '''
+
+  def open(self, path, mode='rb'):
+    return open(path, mode)
+
+
+  def exists(self, path):
+    return lexists(path)
+
+
+  def size(self, path):
+    return getsize(path)
+
+
+  def makedirs(self, path):
+    try:
+      os.makedirs(path)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+
+  def rename(self, source, destination):
+    os.rename(source, destination)
+
+
+class SftpPaths(object):
+  '''
+  Files on a node, accessed over SFTP on the node's fabric connection (with a
+  session per thread).
+  '''
+
+  def __init__(self, host_string):
+    self.host_string = host_string
+    self.local = threading.local()
+    # Connect now, rather than from several threads at once.
+    self.sftp()
+
+
+  def sftp(self):
+    if not hasattr(self.local, 'sftp'):
+      self.local.sftp = connections[self.host_string].open_sftp()
+    return self.local.sftp
+
+
+  def open(self, path, mode='rb'):
+    return self.sftp().open(path, mode)
+
+
+  def exists(self, path):
+    try:
+      self.sftp().stat(path)
+      return True
+    except IOError:
+      return False
+
+
+  def size(self, path):
+    return self.sftp().stat(path).st_size
+
+
+  def makedirs(self, path):
+    if path in ('', '/') or self.exists(path):
+      return
+    self.makedirs(dirname(path))
+    try:
+      self.sftp().mkdir(path)
+    except IOError:
+      if not self.exists(path):
+        raise
+
+
+  def rename(self, source, destination):
+    self.sftp().posix_rename(source, destination)
+
+
+class ChunkStore(object):
+  '''
+  A store of replicated backups: chunks, named by checksum, and a manifest per
+  backup file listing its chunks.  A backup file is replicated once its
+  manifest exists; manifests are written last.
+  '''
+
+  def __init__(self, paths, root):
+    self.paths = paths
+    self.root = root
+
+
+  def chunk_path(self, digest):
+    return join(self.root, 'chunks', digest[:2], digest)
+
+
+  def has_chunk(self, digest):
+    return self.paths.exists(self.chunk_path(digest))
+
+
+  def put_chunk(self, digest, data):
+    path = self.chunk_path(digest)
+    self.paths.makedirs(dirname(path))
+    self.write(path, data)
+
+
+  def manifest_path(self, name):
+    return join(self.root, 'manifests', name + '.json')
+
+
+  def get_manifest(self, name):
+    '''
+    Returns the manifest of a replicated backup file, or None.
+    '''
+    if not self.paths.exists(self.manifest_path(name)):
+      return None
+    with self.paths.open(self.manifest_path(name)) as stream:
+      return json.loads(stream.read())
+
+
+  def put_manifest(self, name, manifest):
+    path = self.manifest_path(name)
+    self.paths.makedirs(dirname(path))
+    self.write(path, json.dumps(manifest, indent=2, sort_keys=True))
+
+
+  def write(self, path, data):
+    # Written under a temporary name and renamed, so that an interrupted
+    # transfer never leaves a partial chunk or manifest behind.
+    partial = '%s.partial-%d-%s' % (path, os.getpid(), threading.current_thread().ident)
+    with self.paths.open(partial, 'wb') as stream:
+      stream.write(data)
+    self.paths.rename(partial, path)
+
+
+def file_checksums(path, chunk_size=CHUNK_SIZE):
+  '''
+  Returns the sha256 checksums of the chunks of a local file.
+  '''
+  checksums = list()
+  with open(path, 'rb') as stream:
+    for chunk in iter(lambda: stream.read(chunk_size), ''):
+      checksums.append(sha256(chunk).hexdigest())
+  return checksums
+
+
+def checksums_command(path, chunk_size=CHUNK_SIZE):
+  '''
+  Returns a shell command printing the sha256 checksums of the chunks of a file
+  (one per line), for checksumming files on a node where they are.
+  '''
+  return ' '.join([
+    'size=$(stat -c %%s %s);' % (path),
+    'count=$(( (size + %d - 1) / %d ));' % (chunk_size, chunk_size),
+    'i=0; while [ $i -lt $count ]; do',
+    'dd if=%s bs=%d skip=$i count=1 2>/dev/null | sha256sum | cut -d" " -f1;' % (path, chunk_size),
+    'i=$((i + 1)); done',
+  ])
+
+
+def replicate_file(source, path, checksums, store, name, chunk_size=CHUNK_SIZE, workers=4, rate=None):
+  '''
+  Replicates a file (at 'path' on 'source', a LocalPaths or SftpPaths) into a
+  ChunkStore as 'name', given the checksums of its chunks.
+
+  Chunks the store does not hold yet are sent by 'workers' threads at once, at
+  the rate allowed by 'rate' (a RateLimit), and checked against their checksum
+  as they arrive.  Returns the number of chunks sent.  Raises IOError if any
+  chunk could not be sent; chunks which were sent are kept, so replicating the
+  file again resumes where this left off.
+  '''
+  rate = rate or RateLimit()
+  size = source.size(path)
+  if len(checksums) != (size + chunk_size - 1) // chunk_size:
+    raise IOError("'%s' changed while being replicated." % (path))
+  missing = list()
+  seen = set()
+  for index, digest in enumerate(checksums):
+    if digest not in seen and not store.has_chunk(digest):
+      missing.append((index, digest))
+    seen.add(digest)
+
+  queue = Queue()
+  for item in missing:
+    queue.put(item)
+  errors = list()
+
+  def work():
+    while True:
+      index, digest = queue.get()
+      if digest is None:
+        return
+      try:
+        with source.open(path) as stream:
+          stream.seek(index * chunk_size)
+          data = list()
+          remaining = min(chunk_size, size - index * chunk_size)
+          while remaining > 0:
+            rate.consume(min(READ_SIZE, remaining))
+            piece = stream.read(min(READ_SIZE, remaining))
+            if not piece:
+              break
+            data.append(piece)
+            remaining -= len(piece)
+        data = ''.join(data)
+        if sha256(data).hexdigest() != digest:
+          raise IOError('chunk %d of %s does not match its checksum' % (index, path))
+        store.put_chunk(digest, data)
+      except (IOError, OSError) as e:
+        errors.append(e)
+
+  threads = list()
+  for i in range(max(1, min(int(workers), len(missing)))):
+    queue.put((None, None))
+    thread = threading.Thread(target=work)
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise IOError('%d chunk(s) of %s could not be replicated: %s' % (len(errors), path, errors[0]))
+  store.put_manifest(name, dict(size=size, chunk_size=chunk_size, chunks=checksums))
+  return len(missing)
+
+
+def assemble(store, name, destination):
+  '''
+  Writes a replicated backup file back out of a ChunkStore to a local path,
+  checking every chunk.
+  '''
+  manifest = store.get_manifest(name)
+  if manifest is None:
+    raise IOError("No replica of '%s' found." % (name))
+  with open(destination, 'wb') as output:
+    for digest in manifest['chunks']:
+      with store.paths.open(store.chunk_path(digest)) as stream:
+        data = stream.read()
+      if sha256(data).hexdigest() != digest:
+        raise IOError("Chunk %s of '%s' is damaged." % (digest, name))
+      output.write(data)
@@ -0,0 +1,104 @@
+import os
+import shutil
+from re import sub
+from hashlib import sha256
+from os.path import join, isdir, isfile, relpath, getmtime
+
+
+# Bump to invalidate all existing snapshots when their layout changes.
+SNAPSHOT_FORMAT = '1'
+
+# The files making up a snapshot.
+SNAPSHOT_FILES = ('database.sql.gz', 'sites-default.tar.gz')
+
+
+def snapshots_dir(config_dir):
+  '''
+  Returns the directory holding a project's install snapshots.
+  '''
+  return join(config_dir, '.drubs', 'snapshots')
+
+
+def snapshot_key(config_dir, node, core_version):
+  '''
+  Returns the key identifying the snapshot of a clean install of a node.
+
+  The key is a checksum of everything an install depends on, other than the
+  settings rewritten when a snapshot is restored: the make file (or its
+  lockfile), the py_file, the project's 'files' directory and the Drupal core
+  version.
+  '''
+  digest = sha256()
+  digest.update('format %s\ncore %s\n' % (SNAPSHOT_FORMAT, core_version))
+  make_file = join(config_dir, node['make_file'])
+  for path in (make_file + '.lock' if isfile(make_file + '.lock') else make_file, join(config_dir, node['py_file'])):
+    digest.update(path[len(config_dir):] + '\n')
+    with open(path, 'rb') as stream:
+      digest.update(stream.read())
+  files_dir = join(config_dir, 'files')
+  for root, dirs, names in os.walk(files_dir):
+    dirs.sort()
+    for name in sorted(names):
+      digest.update('\n' + relpath(join(root, name), files_dir) + '\n')
+      with open(join(root, name), 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1024 * 1024), ''):
+          digest.update(chunk)
+  return digest.hexdigest()[:16]
+
+
+def snapshot_exists(path):
+  return all(isfile(join(path, name)) for name in SNAPSHOT_FILES)
+
+
+def quote_string(value):
+  '''
+  Returns a value as a single-quoted string literal, escaped for both PHP and
+  MySQL.
+  '''
+  return "'%s'" % (value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def rewrite_settings(contents, database, hash_salt):
+  '''
+  Rewrites the database credentials and hash salt in the contents of a
+  settings.php file written by drush site-install (Drupal 6, 7 or 8).
+
+  'database' is a dict of the 'database', 'username', 'password' and 'host' to
+  set.  Drupal 6 uses a single $db_url instead.
+  '''
+  for key in ('database', 'username', 'password', 'host'):
+    contents = sub(
+      r"('%s'\s*=>\s*)'(?:[^'\\]|\\.)*'" % (key),
+      lambda match: match.group(1) + quote_string(database[key]),
+      contents,
+    )
+  contents = sub(
+    r"(\$db_url\s*=\s*)'(\w+)://(?:[^'\\]|\\.)*'",
+    lambda match: match.group(1) + quote_string('%s://%s:%s@%s/%s' % (
+      match.group(2),
+      database['username'],
+      database['password'],
+      database['host'],
+      database['database'],
+    )),
+    contents,
+  )
+  contents = sub(
+    r"(\$drupal_hash_salt\s*=\s*|\$settings\['hash_salt'\]\s*=\s*)'(?:[^'\\]|\\.)*'",
+    lambda match: match.group(1) + quote_string(hash_salt),
+    contents,
+  )
+  return contents
+
+
+def remove_old_snapshots(config_dir, keep):
+  '''
+  Removes all but the 'keep' most recently used snapshots of a project.
+  '''
+  directory = snapshots_dir(config_dir)
+  if not isdir(directory):
+    return
+  paths = [join(directory, name) for name in os.listdir(directory)]
+  paths.sort(key=getmtime, reverse=True)
+  for path in paths[keep:]:
+    shutil.rmtree(path, ignore_errors=True)
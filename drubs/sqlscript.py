@@ -0,0 +1,51 @@
+from re import findall
+
+
+def statement_chunks(statements):
+  '''
+  Returns a list of sql statements as chunks for build_script(): a list of
+  (label, sql), each statement ending with a semicolon.
+  '''
+  chunks = list()
+  for index, statement in enumerate(statements):
+    statement = statement.strip()
+    if not statement.endswith(';'):
+      statement += ';'
+    chunks.append(('statement %d' % (index + 1), statement))
+  return chunks
+
+
+def build_script(chunks):
+  '''
+  Assembles chunks of sql (a list of (label, sql)) into a script running them
+  in a single transaction.
+
+  Returns the script, and a list of (script line the chunk starts on, label,
+  sql) for each chunk, so that mysql errors ('... at line n') can be mapped
+  back to it (see error_messages()).
+  '''
+  script_lines = ['START TRANSACTION;']
+  chunk_lines = list()
+  for label, sql in chunks:
+    chunk_lines.append((len(script_lines) + 1, label, sql))
+    script_lines.extend(sql.splitlines())
+  script_lines.append('COMMIT;')
+  return '\n'.join(script_lines) + '\n', chunk_lines
+
+
+def error_messages(output, chunk_lines):
+  '''
+  Returns a message for each mysql error in the output of a script from
+  build_script(), naming the statement (or the line of the sql file) which
+  failed.
+  '''
+  messages = list()
+  for code, state, line, message in findall(r'ERROR (\d+) \(([0-9A-Z]+)\) at line (\d+): (.*)', output):
+    for start, label, sql in reversed(chunk_lines):
+      if int(line) >= start:
+        break
+    if label.startswith('statement '):
+      messages.append("SQL error %s (%s) in %s: %s\n  %s" % (code, state, label, message.strip(), sql))
+    else:
+      messages.append("SQL error %s (%s) in '%s' at line %d: %s" % (code, state, label, int(line) - start + 1, message.strip()))
+  return messages
@@ -0,0 +1,198 @@
+import sys
+import time
+import zlib
+import threading
+import subprocess
+from fabric.state import connections
+from fabric.operations import _prefix_env_vars, _shell_wrap
+from fabric.utils import error
+from capture import OutputCapture, prefix_command, read_lines
+from progress import format_bytes
+from verify import format_rate
+
+
+# Bytes relayed from the source command to the target command at a time.
+RELAY_SIZE = 256 * 1024
+
+# Directories in sites/default/files which Drupal regenerates on demand (image
+# styles, aggregated CSS and JS, compiled PHP), and which are not synced.
+SYNC_FILES_EXCLUDE = ('styles', 'css', 'js', 'php')
+
+
+class LocalCommand(object):
+  '''
+  A command running on the machine drubs is running on, with its standard
+  input and output open to drubs.
+  '''
+
+  def __init__(self, command, log=None, cwd='', prefixes=()):
+    self.command = command
+    self.process = subprocess.Popen(
+      [prefix_command(_prefix_env_vars(command, local=True), cwd, prefixes)],
+      shell=True,
+      executable='/bin/bash',
+      stdin=subprocess.PIPE,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE,
+      close_fds=True,
+    )
+    self.stderr = OutputCapture(log)
+    self.reader = threading.Thread(target=read_lines, args=(self.process.stderr, self.stderr))
+    self.reader.daemon = True
+    self.reader.start()
+
+
+  def read(self, size):
+    return self.process.stdout.read(size)
+
+
+  def write(self, data):
+    self.process.stdin.write(data)
+
+
+  def close_input(self):
+    self.process.stdin.close()
+
+
+  def abort(self):
+    # Closing its output ends the command (with SIGPIPE) if it is still
+    # writing.
+    self.process.stdout.close()
+
+
+  def wait(self):
+    if not self.process.stdout.closed:
+      self.process.stdout.close()
+    self.reader.join()
+    return self.process.wait()
+
+
+class RemoteCommand(object):
+  '''
+  A command running on a node, over the node's SSH connection, with its
+  standard input and output open to drubs.
+  '''
+
+  def __init__(self, command, host_string, log=None, cwd='', prefixes=()):
+    self.command = command
+    self.channel = connections[host_string].get_transport().open_session()
+    self.channel.exec_command(_shell_wrap(prefix_command(_prefix_env_vars(command), cwd, prefixes), shell_escape=True))
+    self.stdout = self.channel.makefile('rb')
+    self.stderr = OutputCapture(log)
+    self.reader = threading.Thread(target=read_lines, args=(self.channel.makefile_stderr('rb'), self.stderr))
+    self.reader.daemon = True
+    self.reader.start()
+    self.aborted = False
+
+
+  def read(self, size):
+    return self.stdout.read(size)
+
+
+  def write(self, data):
+    self.channel.sendall(data)
+
+
+  def close_input(self):
+    self.channel.shutdown_write()
+
+
+  def abort(self):
+    self.channel.close()
+    self.aborted = True
+
+
+  def wait(self):
+    if self.aborted:
+      self.reader.join()
+      return -1
+    status = self.channel.recv_exit_status()
+    self.reader.join()
+    self.channel.close()
+    return status
+
+
+def gzip_member(data):
+  '''
+  Returns data compressed as a gzip member.  Concatenated members decompress
+  as one stream, so this can be sent after the output of 'gzip'.
+  '''
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush()
+
+
+class Throughput(object):
+  '''
+  Counts the bytes relayed by a stream, printing a line with the total and
+  the rate every 'interval' seconds (0 disables).
+  '''
+
+  def __init__(self, description, interval=15, stream=None):
+    self.description = description
+    self.interval = interval
+    self.stream = stream or sys.stdout
+    self.bytes = 0
+    self.started = time.time()
+    self.stopped = threading.Event()
+    self.thread = None
+    if interval > 0:
+      self.thread = threading.Thread(target=self.report_periodically)
+      self.thread.daemon = True
+      self.thread.start()
+
+
+  def add(self, count):
+    self.bytes += count
+
+
+  def status(self):
+    return '%s (compressed) at %s' % (
+      format_bytes(self.bytes),
+      format_rate(self.bytes, time.time() - self.started),
+    )
+
+
+  def report_periodically(self):
+    while not self.stopped.wait(self.interval):
+      self.stream.write('%s: %s\n' % (self.description, self.status()))
+      self.stream.flush()
+
+
+  def stop(self):
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join()
+
+
+def relay(source, target, throughput, trailer=''):
+  '''
+  Copies the output of a source command (a LocalCommand or RemoteCommand) into
+  the input of a target command, as it is produced, followed by 'trailer'.
+
+  Fails (as a failed fabric command does) if either command fails; a target
+  which exits early fails the source too, rather than leaving it blocked.
+  '''
+  broken = None
+  try:
+    for data in iter(lambda: source.read(RELAY_SIZE), ''):
+      target.write(data)
+      throughput.add(len(data))
+    if trailer:
+      target.write(trailer)
+      throughput.add(len(trailer))
+  except EnvironmentError as e:
+    broken = e
+    source.abort()
+  finally:
+    throughput.stop()
+    try:
+      target.close_input()
+    except EnvironmentError:
+      pass
+  target_status = target.wait()
+  source_status = source.wait()
+  for command, status in ((source, source_status), (target, target_status)):
+    if status != 0:
+      error("'%s' failed (return code %s): %s" % (command.command, status, command.stderr.value().strip()))
+  if broken is not None:
+    error('Streaming failed: %s' % (broken))
@@ -0,0 +1,224 @@
+import os
+import time
+import signal
+import multiprocessing
+from collections import OrderedDict
+from fabric import state
+from fabric.colors import red
+
+
+class Task(object):
+  '''
+  A named callable, run after the tasks it depends on ('after').
+  '''
+
+  def __init__(self, name, func, after=()):
+    self.name = name
+    self.func = func
+    self.after = list(after)
+
+
+  def __repr__(self):
+    return '<Task %s>' % (self.name)
+
+
+class TaskGraph(object):
+  '''
+  A set of tasks with dependencies, run at the same time where they allow it.
+
+  Tasks are declared with the task() decorator, for example in a py_file:
+
+    graph = TaskGraph()
+
+    @graph.task()
+    def sync_assets():
+      drubs_run('rsync ...')
+
+    @graph.task()
+    def configure_vhost():
+      ...
+
+    @graph.task(after=['sync_assets'])
+    def build_theme():
+      ...
+
+  and run with run(), or Node.run_tasks().  Each task runs in its own process
+  (as fabric runs parallel tasks), so tasks do not share changes to fabric's
+  env or connections.  At most 'workers' tasks run at once, started at least
+  'stagger' seconds apart.  If a task fails, the tasks still running are
+  cancelled, no more tasks are started, and run() exits - inside an install or
+  update, the latest backup is then restored as for any other failure.
+  '''
+
+  # Seconds between checks for finished tasks.
+  POLL_INTERVAL = 0.1
+
+  def __init__(self, workers=4, stagger=0):
+    self.workers = workers
+    self.stagger = stagger
+    self.tasks = OrderedDict()
+
+
+  def task(self, name=None, after=()):
+    '''
+    Decorator adding a function to the graph as a task, named after the
+    function unless 'name' is given.
+    '''
+    def decorator(func):
+      self.add(name or func.__name__, func, after)
+      return func
+    return decorator
+
+
+  def add(self, name, func, after=()):
+    if name in self.tasks:
+      raise ValueError("Task '%s' is defined more than once." % (name))
+    self.tasks[name] = Task(name, func, after)
+    return self
+
+
+  def order(self):
+    '''
+    Returns the task names in an order satisfying their dependencies, keeping
+    the order in which tasks were added wherever possible.
+
+    Raises ValueError for unknown or circular dependencies.
+    '''
+    for task in self.tasks.values():
+      for dependency in task.after:
+        if dependency not in self.tasks:
+          raise ValueError("Task '%s' depends on unknown task '%s'." % (task.name, dependency))
+    ordered = list()
+    remaining = list(self.tasks)
+    while remaining:
+      ready = [name for name in remaining if all(dependency in ordered for dependency in self.tasks[name].after)]
+      if not ready:
+        raise ValueError('Tasks %s depend on each other.' % (', '.join(remaining)))
+      ordered.append(ready[0])
+      remaining.remove(ready[0])
+    return ordered
+
+
+  def run(self, runner=None, concurrent=True, keep_going=False):
+    '''
+    Runs all tasks.
+
+    'runner' is called as runner(name, func) to run each task, and defaults to
+    calling func().  Unless 'concurrent' is set, tasks run one at a time in
+    dependency order, in this process.  At least 'stagger' seconds pass between
+    the starts of tasks, unless 'concurrent' is unset (when planning).
+
+    If 'keep_going' is set, a failed task does not cancel the others: only the
+    tasks depending on it are skipped, and run() exits once every other task
+    has finished.
+    '''
+    runner = runner or (lambda name, func: func())
+    try:
+      order = self.order()
+    except ValueError as e:
+      print(red('%s Exiting...' % (e)))
+      exit(1)
+    failed = list()
+    if not concurrent or self.workers <= 1:
+      last_start = None
+      for name in order:
+        if any(dependency in failed for dependency in self.tasks[name].after):
+          failed.append(name)
+          continue
+        if concurrent and last_start is not None:
+          time.sleep(max(0, self.stagger - (time.time() - last_start)))
+        last_start = time.time()
+        try:
+          runner(name, self.tasks[name].func)
+        except SystemExit:
+          if not keep_going:
+            raise
+          print(red("Task '%s' failed." % (name)))
+          failed.append(name)
+      self.check_failed(failed)
+      return
+
+    pending = list(order)
+    running = OrderedDict()
+    done = set()
+    last_start = 0
+    try:
+      while pending or running:
+        for name in list(pending):
+          if any(dependency in failed for dependency in self.tasks[name].after):
+            pending.remove(name)
+            failed.append(name)
+            continue
+          if len(running) >= self.workers or time.time() - last_start < self.stagger:
+            break
+          if all(dependency in done for dependency in self.tasks[name].after):
+            pending.remove(name)
+            running[name] = self.start(name, runner)
+            last_start = time.time()
+        finished = [name for name, process in running.items() if not process.is_alive()]
+        if not finished:
+          time.sleep(self.POLL_INTERVAL)
+          continue
+        for name in finished:
+          process = running.pop(name)
+          process.join()
+          if process.exitcode != 0 and keep_going:
+            print(red("Task '%s' failed." % (name)))
+            failed.append(name)
+          elif process.exitcode != 0:
+            self.cancel(running)
+            print(red("Task '%s' failed.%s Exiting..." % (
+              name,
+              ' Cancelled task(s) %s.' % (', '.join(running)) if running else '',
+            )))
+            exit(1)
+          else:
+            done.add(name)
+    except KeyboardInterrupt:
+      # Tasks run in their own process groups, out of reach of the terminal's
+      # interrupt.
+      self.cancel(running)
+      raise
+    self.check_failed(failed)
+
+
+  def check_failed(self, failed):
+    if failed:
+      print(red('Task(s) %s failed or were skipped. Exiting...' % (', '.join(failed))))
+      exit(1)
+
+
+  def start(self, name, runner):
+    '''
+    Starts a task in its own process, and process group: the commands it runs
+    locally are in that group too, so that cancel() stops them with it.
+    '''
+    def target():
+      os.setpgid(0, 0)
+      # As fabric does for parallel tasks, do not share SSH connections with
+      # the parent process.
+      state.connections.clear()
+      runner(name, self.tasks[name].func)
+    process = multiprocessing.Process(target=target, name=name)
+    process.start()
+    try:
+      # Also set here, so that the group exists as soon as start() returns.
+      os.setpgid(process.pid, process.pid)
+    except OSError:
+      pass
+    return process
+
+
+  def cancel(self, running):
+    '''
+    Stops running tasks along with the local commands they started.  Their
+    SSH connections close as their processes end, hanging up the commands
+    they were running on remote nodes (see capture.stream_remote()).
+    '''
+    for process in running.values():
+      try:
+        os.killpg(process.pid, signal.SIGTERM)
+      except OSError:
+        process.terminate()
+    for process in running.values():
+      process.join()
@@ -1,43 +1,67 @@
 import node
+from context import NodeContext
+from taskgraph import TaskGraph
 from fabric.api import task
 from fabric.state import env
 
+def run_action(action, context=None):
+  '''
+  Runs an action on a node (by default each requested node on the host fabric
+  is executing on, in turn), in the node's own context.
+  '''
+  for context in [context] if context else NodeContext.from_env():
+    with context.activate():
+      node.Node(context).run_action(action)
+
+def backup_nodes(nodes):
+  '''
+  Backs up several nodes, at most env.parallel at a time, started env.stagger
+  seconds apart.  A failed backup does not stop the others.
+  '''
+  graph = TaskGraph(workers=env.parallel, stagger=env.stagger)
+  for name in nodes:
+    graph.add(name, lambda name=name: run_action('backup', NodeContext.for_node(name)))
+  graph.run(keep_going=True)
+
+def sync_nodes(source, target):
+  '''
+  Syncs the database and files of the node 'source' to the node 'target'.
+  '''
+  env.command = 'sync'
+  env.sync_source = source
+  # Data is relayed between the two nodes by this process, so the action is
+  # never handed to an agent.
+  env.agent = False
+  run_action('sync', NodeContext.for_node(target))
+
 @task
 def status():
-  instance = node.Node(env)
-  instance.status()
+  run_action('status')
 
 @task
 def install():
-  instance = node.Node(env)
-  instance.install()
+  run_action('install')
 
 @task
 def update():
-  instance = node.Node(env)
-  instance.update()
+  run_action('update')
 
 @task
 def disable():
-  instance = node.Node(env)
-  instance.disable()
+  run_action('disable')
 
 @task
 def enable():
-  instance = node.Node(env)
-  instance.enable()
+  run_action('enable')
 
 @task
 def destroy():
-  instance = node.Node(env)
-  instance.destroy()
+  run_action('destroy')
 
 @task
 def backup():
-  instance = node.Node(env)
-  instance.backup()
+  run_action('backup')
 
 @task
 def var_dump():
-  instance = node.Node(env)
-  instance.var_dump()
+  run_action('var_dump')
@@ -0,0 +1,94 @@
+import os
+import json
+from os.path import join, isfile, dirname
+from datetime import datetime
+
+
+def record_file(config_dir, node_name):
+  '''
+  Returns the path of a node's backup verification record.
+  '''
+  return join(config_dir, '.drubs', 'verify', '%s.json' % (node_name))
+
+
+def load_record(path):
+  if not isfile(path):
+    return dict()
+  with open(path) as stream:
+    return json.load(stream)
+
+
+def save_record(path, record):
+  if not os.path.isdir(dirname(path)):
+    os.makedirs(dirname(path))
+  with open(path + '.tmp', 'w') as stream:
+    json.dump(record, stream, indent=2, sort_keys=True)
+  os.rename(path + '.tmp', path)
+
+
+def verify_command(paths, workers=4):
+  '''
+  Returns a shell command checking gzipped backup files, 'workers' at a time.
+
+  Each file is read once: streamed through sha256sum and 'gzip -t' together,
+  without writing anything out.  For each file the command prints its checksum
+  ('<sha256>  <path>') and then 'ok <path>' or 'bad <path>'.
+  '''
+  check = (
+    'set -o pipefail; '
+    'if { tee >(sha256sum | sed "s|-\\$|$0|" >&3) < "$0" | gzip -t 2>/dev/null; } 3>&1; '
+    'then echo "ok $0"; else echo "bad $0"; fi'
+  )
+  return "printf '%%s\\n' %s | xargs -P %d -n 1 bash -c '%s'" % (
+    ' '.join(paths),
+    int(workers),
+    check.replace("'", "'\\''"),
+  )
+
+
+def parse_results(output, paths):
+  '''
+  Parses the output of verify_command() into a dict of path => (ok, sha256).
+  Files missing from the output failed.
+  '''
+  checksums = dict()
+  status = dict()
+  for line in output.splitlines():
+    parts = line.split()
+    if len(parts) != 2:
+      continue
+    if parts[0] in ('ok', 'bad'):
+      status[parts[1]] = parts[0] == 'ok'
+    else:
+      checksums[parts[1]] = parts[0]
+  return dict((path, (status.get(path, False) and path in checksums, checksums.get(path))) for path in paths)
+
+
+def update_record(record, results, now=None):
+  '''
+  Records the results of a verification (a dict of backup file name => (ok,
+  sha256)).  Backup files never change once written: a file whose checksum
+  differs from the one recorded before is marked as damaged.
+
+  Returns the results, with such files marked as failed.
+  '''
+  now = (now or datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+  checked = dict()
+  for name, (ok, checksum) in results.items():
+    previous = record.get(name, dict())
+    if ok and previous.get('sha256') and previous['sha256'] != checksum:
+      ok = False
+    record[name] = dict(
+      ok=ok,
+      sha256=checksum if ok else previous.get('sha256'),
+      verified=now,
+    )
+    checked[name] = (ok, checksum)
+  return checked
+
+
+def format_rate(size, seconds):
+  '''
+  Returns a throughput in MB/s.
+  '''
+  return '%.1f MB/s' % (size / 1000000.0 / seconds if seconds > 0 else 0)
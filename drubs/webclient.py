@@ -0,0 +1,194 @@
+import ssl
+import time
+import socket
+import threading
+import urllib2
+from math import ceil
+from Queue import Queue
+from urlparse import urlsplit, urlunsplit, urljoin
+from xml.etree import ElementTree
+
+
+SITEMAP_NAMESPACE = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+
+
+class Response(object):
+  '''
+  The outcome of one timed request.
+  '''
+
+  def __init__(self, url, status=None, seconds=0.0, size=0, error=None):
+    self.url = url
+    self.status = status
+    self.seconds = seconds
+    self.size = size
+    self.error = error
+
+
+  @property
+  def ok(self):
+    return self.error is None and self.status is not None and self.status < 400
+
+
+  def __repr__(self):
+    return '<Response %s %s %.3fs>' % (self.url, self.error or self.status, self.seconds)
+
+
+class WebClient(object):
+  '''
+  A small HTTP client for timing requests to the pages of a node's site.
+
+  base_url - the site's base url, against which relative paths are resolved.
+  address  - optionally, a 'host[:port]' to connect to instead of the host in
+             base_url (for example a vhost on the node itself), sending the
+             host in base_url as the Host header.
+  headers  - extra headers sent with every request.
+  '''
+
+  def __init__(self, base_url, address='', headers=None, timeout=30):
+    self.base_url = base_url.rstrip('/') + '/'
+    self.address = address
+    self.headers = headers or dict()
+    self.timeout = timeout
+
+
+  def url(self, path):
+    return urljoin(self.base_url, path.lstrip('/') if '://' not in path else path)
+
+
+  def open(self, path):
+    '''
+    Opens a page, returning the urllib2 response.  Raises IOError on failure.
+    '''
+    url = self.url(path)
+    headers = dict(self.headers)
+    kwargs = dict()
+    if self.address:
+      scheme, netloc, url_path, query, fragment = urlsplit(url)
+      headers['Host'] = netloc
+      url = urlunsplit((scheme, self.address, url_path, query, fragment))
+      if scheme == 'https':
+        # The certificate names the site, not the address connected to.
+        kwargs['context'] = ssl._create_unverified_context()
+    return urllib2.urlopen(urllib2.Request(url, headers=headers), timeout=self.timeout, **kwargs)
+
+
+  def get(self, path):
+    '''
+    Returns the body of a page.  Raises IOError on failure.
+    '''
+    try:
+      return self.open(path).read()
+    except socket.error as e:
+      raise IOError(e)
+
+
+  def request(self, path):
+    '''
+    Requests a page, reading the whole response, and returns a Response.
+    '''
+    started = time.time()
+    try:
+      response = self.open(path)
+      size = len(response.read())
+      return Response(path, response.getcode(), time.time() - started, size)
+    except urllib2.HTTPError as e:
+      return Response(path, e.code, time.time() - started)
+    except (IOError, socket.error) as e:
+      return Response(path, seconds=time.time() - started, error=str(getattr(e, 'reason', e)))
+
+
+  def request_all(self, paths, concurrency=4):
+    '''
+    Requests pages with at most 'concurrency' requests in flight, returning
+    their Responses in the order of 'paths'.
+    '''
+    queue = Queue()
+    for index, path in enumerate(paths):
+      queue.put((index, path))
+    responses = [None] * len(paths)
+
+    def work():
+      while True:
+        index, path = queue.get()
+        if path is None:
+          return
+        responses[index] = self.request(path)
+
+    threads = list()
+    for i in range(max(1, min(int(concurrency), len(paths)))):
+      queue.put((None, None))
+      thread = threading.Thread(target=work)
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      thread.join()
+    return responses
+
+
+def parse_sitemap(xml):
+  '''
+  Returns the page urls and the nested sitemap urls listed in a sitemap.
+  '''
+  root = ElementTree.fromstring(xml)
+  pages = [loc.text.strip() for loc in root.iter(SITEMAP_NAMESPACE + 'loc') if loc.text]
+  if root.tag == SITEMAP_NAMESPACE + 'sitemapindex':
+    return list(), pages
+  return pages, list()
+
+
+def percentile(values, p):
+  '''
+  Returns the p-th percentile (nearest rank) of a list of numbers.
+  '''
+  values = sorted(values)
+  if not values:
+    return None
+  rank = int(ceil(p / 100.0 * len(values))) - 1
+  return values[max(0, min(rank, len(values) - 1))]
+
+
+def summarize(responses):
+  '''
+  Returns latency statistics (in seconds) for a list of Responses.
+  '''
+  seconds = [response.seconds for response in responses if response.ok]
+  return dict(
+    count=len(responses),
+    failed=len([response for response in responses if not response.ok]),
+    p50=percentile(seconds, 50),
+    p95=percentile(seconds, 95),
+    max=max(seconds) if seconds else None,
+  )
+
+
+def benchmark(client, paths, repetitions=5):
+  '''
+  Times repeated requests for each page, one request at a time.
+
+  Each page is requested once, untimed, beforehand, so that cold caches do not
+  skew the results.  Returns the timed Responses.
+  '''
+  responses = list()
+  for path in paths:
+    client.request(path)
+    for i in range(int(repetitions)):
+      responses.append(client.request(path))
+  return responses
+
+
+def regressions(before, after, threshold, min_seconds=0.0):
+  '''
+  Compares the statistics (as returned by summarize()) of two benchmarks.
+
+  Returns a list of (statistic, before, after) for the p50 and p95 latencies
+  which grew by more than 'threshold' times, and by more than 'min_seconds'.
+  '''
+  regressed = list()
+  for stat in ('p50', 'p95'):
+    if before[stat] is None or after[stat] is None:
+      continue
+    if after[stat] > before[stat] * threshold and after[stat] - before[stat] > min_seconds:
+      regressed.append((stat, before[stat], after[stat]))
+  return regressed
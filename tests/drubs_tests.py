@@ -9,3 +9,880 @@ def teardown():
 
 def test_example():
   print "test"
+
+def test_parse_make_string():
+  from drubs import makefile
+  info = makefile.parse_make_string('\n'.join([
+    'core = 7.x',
+    '; A comment = ignored',
+    'projects[] = token',
+    'projects[views] = "3.11"',
+    'projects[drupal][version] = 7.41',
+    'projects[ctools][patch][] = "http://example.com/a.patch"',
+  ]))
+  projects = makefile.get_projects(info)
+  assert projects.keys() == ['token', 'views', 'drupal', 'ctools']
+  assert projects['views']['version'] == '3.11'
+  assert projects['ctools']['patch'].values() == ['http://example.com/a.patch']
+  assert makefile.full_version('views', '7.x', '3.11') == '7.x-3.11'
+  assert makefile.full_version('drupal', '7.x', '7.41') == '7.41'
+  assert makefile.parse_make_string(makefile.dump_make_string(info)) == info
+
+def test_sql_script():
+  from drubs import sqlscript
+  chunks = sqlscript.statement_chunks(['UPDATE a SET b = 1', "INSERT INTO c\nVALUES ('d');"])
+  assert chunks == [('statement 1', 'UPDATE a SET b = 1;'), ('statement 2', "INSERT INTO c\nVALUES ('d');")]
+  script, chunk_lines = sqlscript.build_script(chunks + [('fixes.sql', 'DELETE FROM e;\nDELETE FROM f;')])
+  assert script.splitlines() == [
+    'START TRANSACTION;',
+    'UPDATE a SET b = 1;',
+    'INSERT INTO c',
+    "VALUES ('d');",
+    'DELETE FROM e;',
+    'DELETE FROM f;',
+    'COMMIT;',
+  ]
+  assert [(start, label) for start, label, sql in chunk_lines] == [(2, 'statement 1'), (3, 'statement 2'), (5, 'fixes.sql')]
+  output = '\n'.join([
+    "ERROR 1146 (42S02) at line 4: Table 'db.c' doesn't exist",
+    "ERROR 1064 (42000) at line 6: You have an error in your SQL syntax",
+  ])
+  assert sqlscript.error_messages(output, chunk_lines) == [
+    "SQL error 1146 (42S02) in statement 2: Table 'db.c' doesn't exist\n  INSERT INTO c\nVALUES ('d');",
+    "SQL error 1064 (42000) in 'fixes.sql' at line 2: You have an error in your SQL syntax",
+  ]
+  assert sqlscript.error_messages('Access denied', chunk_lines) == []
+
+def test_package_cache():
+  import os
+  import shutil
+  import hashlib
+  import tempfile
+  import subprocess
+  from collections import OrderedDict
+  from fabric.api import hide
+  from drubs.cache import PackageCache
+  class ShellNode(object):
+    def drubs_run(self, command, **kwargs):
+      with open(os.devnull, 'w') as devnull:
+        return subprocess.check_output(command, shell=True, executable='/bin/bash', stderr=devnull).strip()
+  directory = tempfile.mkdtemp()
+  try:
+    cache_dir = os.path.join(directory, 'cache')
+    tarball = os.path.join(directory, 'views-7.x-3.10.tar.gz')
+    with open(tarball, 'wb') as stream:
+      stream.write('views release')
+    md5 = hashlib.md5('views release').hexdigest()
+    sha = hashlib.sha256('views release').hexdigest()
+    cache = PackageCache(ShellNode(), cache_dir, 1)
+    with hide('everything'):
+      assert cache.lookup(OrderedDict([('views', '7.x-3.10')])) == dict()
+      fetched = cache.fetch([('views', '7.x-3.10', 'module', 'file://' + tarball, md5)])
+      assert fetched == dict(views=(sha, 'module'))
+      assert os.path.isfile(cache.blob_path(sha))
+      assert cache.lookup(OrderedDict([('views', '7.x-3.10'), ('ctools', '7.x-1.9')])) == fetched
+      # A corrupt download is not cached.
+      try:
+        cache.fetch([('ctools', '7.x-1.9', 'module', 'file://' + tarball, '0' * 32)])
+        assert False
+      except subprocess.CalledProcessError:
+        pass
+      assert not os.path.exists(os.path.join(cache_dir, 'index', 'ctools'))
+      info = OrderedDict([('core', '7.x'), ('projects', OrderedDict([
+        ('views', OrderedDict([('version', '3.10'), ('subdir', 'contrib')])),
+        ('ctools', OrderedDict([('version', '1.x-dev')])),
+      ]))])
+      projects = cache.apply(info)['projects']
+      assert projects['views'] == OrderedDict([
+        ('subdir', 'contrib'),
+        ('type', 'module'),
+        ('download', OrderedDict([('type', 'file'), ('url', cache.blob_path(sha))])),
+      ])
+      assert projects['ctools'] == OrderedDict([('version', '1.x-dev')])
+      # Offline, unpinned and uncached projects fail the build.
+      offline = PackageCache(ShellNode(), cache_dir, 1, offline=True)
+      for version in ('1.x-dev', '1.9'):
+        info['projects']['ctools']['version'] = version
+        try:
+          offline.apply(info)
+          assert False
+        except SystemExit:
+          pass
+      del info['projects']['ctools']
+      assert offline.apply(info)['projects']['views']['download']['url'] == cache.blob_path(sha)
+  finally:
+    shutil.rmtree(directory)
+
+def test_resolve_release():
+  from drubs import makefile
+  def release(version, major, extra=''):
+    return dict(version=version, version_major=major, version_extra=extra, status='published', download_link='', mdhash='')
+  history = dict(type='module', recommended_major='3', releases=[
+    release('7.x-3.x-dev', '3', 'dev'),
+    release('7.x-3.12-rc1', '3', 'rc1'),
+    release('7.x-3.11', '3'),
+    release('7.x-2.0', '2'),
+  ])
+  assert makefile.resolve_release(history, 'views', '7.x', '3.x')['version'] == '7.x-3.11'
+  assert makefile.resolve_release(history, 'views', '7.x', '')['version'] == '7.x-3.11'
+  assert makefile.resolve_release(history, 'views', '7.x', '2.0')['version'] == '7.x-2.0'
+  assert makefile.resolve_release(history, 'views', '7.x', '4.x') is None
+
+def test_plan_coalesces_cache_clears():
+  from drubs.plan import Plan
+  noop = lambda: None
+  plan = Plan('update', noop)
+  plan.add('disable_apache_access', noop)
+  plan.add('check_and_create_backup', noop, clears_cache=True)
+  plan.add('make', noop, guarded=True, clears_cache=True)
+  plan.add('postconfigure', noop, guarded=True, clears_cache=True)
+  plan.add('updb', noop, guarded=True, clears_cache=True)
+  plan.add('remove_old_backups', noop)
+  plan.add('enable_apache_access', noop, needs_clean_cache=True)
+  steps = [(step.name, step.guarded) for step in plan.coalesced()]
+  assert steps == [
+    ('disable_apache_access', False),
+    ('check_and_create_backup', False),
+    ('clear_cache', False),
+    ('make', True),
+    ('postconfigure', True),
+    ('updb', True),
+    ('clear_cache', True),
+    ('remove_old_backups', False),
+    ('enable_apache_access', False),
+  ]
+
+def test_history():
+  import os
+  import sys
+  import shutil
+  import tempfile
+  import multiprocessing
+  from StringIO import StringIO
+  from drubs.history import History, history_file
+  from drubs.node import Node
+  from drubs.plan import Plan
+  directory = tempfile.mkdtemp()
+  try:
+    path = history_file(directory)
+    history = History(path)
+    assert history.estimate('dev', 'make') is None
+    for started, duration, success in ((1, 30, True), (2, 10, True), (3, 500, False), (4, 20, True)):
+      history.record('dev', 'install', 'make', started, duration, success)
+    history.record('prod', 'install', 'make', 5, 90, True)
+    history.record('dev', 'update', 'updb', 6, 5, True)
+    # The median of successful runs on the node.
+    assert history.estimate('dev', 'make') == 20
+    history.record('dev', 'update', 'make', 7, 40, True)
+    assert history.estimate('dev', 'make') == 25
+    for started in range(10, 10 + History.SAMPLE_SIZE):
+      history.record('dev', 'update', 'make', started, 60, True)
+    assert history.estimate('dev', 'make') == 60
+    # Runs recorded by other processes (see TaskGraph) are read back.
+    process = multiprocessing.Process(target=lambda: history.record('dev', 'install', 'site_install', 100, 3, False))
+    process.start()
+    process.join()
+    assert history.runs_since('dev', ['site_install', 'updb'], 6) == [('updb', 5, 1), ('site_install', 3, 0)]
+    assert history.runs_since('dev', ['site_install'], 101) == []
+    assert History(path).estimate('prod', 'make') == 90
+    # --plan estimates steps from the history, and lists those without any.
+    class Context(object):
+      node_name = 'dev'
+    node = object.__new__(Node)
+    node.context = Context()
+    node.history = history
+    plan = Plan('update', lambda: None)
+    plan.add('make', lambda: None)
+    plan.add('updb', lambda: None)
+    plan.add('warm_up', lambda: None)
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+      node.print_plan(plan)
+      output = sys.stdout.getvalue()
+    finally:
+      sys.stdout = stdout
+    assert 'est. 0h:01m:00s' in output and 'est. 0h:00m:05s' in output
+    assert 'Estimated total: 0h:01m:05s' in output
+    assert 'No history for step(s): warm_up' in output
+  finally:
+    shutil.rmtree(directory)
+
+def test_progress_status():
+  import time
+  from drubs.progress import Progress
+  progress = Progress([('make', 60), ('updb', None), ('clear_cache', 30)])
+  progress.started = time.time() - 30
+  progress.start_step('make')
+  progress.step_started = time.time() - 30
+  progress.add_bytes(3 * 1024 * 1024)
+  status = progress.status()
+  assert 'make (1/3)' in status
+  assert '33% of ~0h:01m:30s' in status
+  assert 'ETA 0h:01m:00s' in status or 'ETA 0h:00m:59s' in status
+  assert '3.0 MB transferred' in status
+
+def test_build_fingerprint():
+  from drubs import makefile
+  pinned = makefile.parse_make_string('\n'.join([
+    'core = 7.x',
+    'projects[views] = 3.11',
+    'libraries[ckeditor][download][type] = git',
+    'libraries[ckeditor][download][tag] = 4.5.4',
+  ]))
+  assert makefile.is_reproducible(pinned)
+  unpinned = makefile.parse_make_string('core = 7.x\nprojects[views] = 3.x')
+  assert not makefile.is_reproducible(unpinned)
+  options = '--working-copy --no-gitinfofile'
+  assert makefile.build_fingerprint(pinned, options) == makefile.build_fingerprint(pinned, options)
+  assert makefile.build_fingerprint(pinned, options) != makefile.build_fingerprint(unpinned, options)
+  assert makefile.build_fingerprint(pinned, options) != makefile.build_fingerprint(pinned, '')
+
+def test_incremental_changes():
+  from drubs import makefile
+  def parse(*lines):
+    return makefile.parse_make_string('\n'.join(('core = 7.x', 'projects[drupal] = 7.41') + lines))
+  built = parse('projects[views] = 3.11', 'projects[token] = 1.6', 'libraries[ckeditor][download][type] = git', 'libraries[ckeditor][download][tag] = 4.5.4')
+  info_files = './modules/contrib/views/views.info\n./modules/contrib/views/modules/views_ui.info\n./modules/contrib/token/token.info\n'
+  paths = makefile.project_paths(built, makefile.build_entries(built).keys(), info_files)
+  assert paths == {
+    'projects/views': 'modules/contrib/views',
+    'projects/token': 'modules/contrib/token',
+    'libraries/ckeditor': 'libraries/ckeditor',
+  }
+  manifest = makefile.build_manifest(built, '--no-cache', paths)
+  assert makefile.incremental_changes(manifest, built, '--no-cache') == ([], [])
+  changed = parse('projects[views] = 3.12', 'projects[ctools] = 1.x-dev', 'libraries[ckeditor][download][type] = git', 'libraries[ckeditor][download][tag] = 4.5.4')
+  assert makefile.incremental_changes(manifest, changed, '--no-cache') == (['projects/views', 'projects/ctools'], ['projects/token'])
+  subset = makefile.subset_info(changed, ['projects/ctools'])
+  assert subset['core'] == '7.x' and subset['projects'].keys() == ['ctools'] and not subset['libraries']
+  assert makefile.incremental_changes(manifest, built, '') is None
+  assert makefile.incremental_changes(manifest, parse('projects[views] = 3.11'), '--no-cache') == ([], ['projects/token', 'libraries/ckeditor'])
+  assert makefile.incremental_changes(None, built) is None
+
+def test_agent_options():
+  from fabric.state import env
+  from drubs.node import Node
+  for flag in ('verbose', 'debug', 'cache', 'no_backup', 'no_restore', 'yes', 'offline', 'full_make'):
+    env[flag] = False
+  env.progress_interval = 15
+  node = object.__new__(Node)
+  assert node.agent_options() == ['--progress-interval=15']
+  env.yes = env.full_make = True
+  assert node.agent_options() == ['-y', '--full-make', '--progress-interval=15']
+  env.yes = env.full_make = False
+
+def test_webclient_request_all():
+  import threading
+  from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+  from drubs import webclient
+  class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.headers.get('X-Drubs-Warmup') != 'secret':
+        self.send_error(503)
+        return
+      body = '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"><url><loc>http://example.com/node/1</loc></url></urlset>'
+      self.send_response(200 if self.path != '/missing' else 404)
+      self.end_headers()
+      self.wfile.write(body)
+    def log_message(self, *args):
+      pass
+  server = HTTPServer(('127.0.0.1', 0), Handler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  try:
+    address = '127.0.0.1:%d' % (server.server_address[1])
+    client = webclient.WebClient('http://example.com', address=address, headers={'X-Drubs-Warmup': 'secret'})
+    pages, sitemaps = webclient.parse_sitemap(client.get('sitemap.xml'))
+    assert pages == ['http://example.com/node/1'] and sitemaps == []
+    responses = client.request_all(pages + ['/', '/missing'], concurrency=2)
+    assert [response.status for response in responses] == [200, 200, 404]
+    stats = webclient.summarize(responses)
+    assert stats['count'] == 3 and stats['failed'] == 1
+    assert webclient.WebClient('http://' + address).request('/').status == 503
+  finally:
+    server.shutdown()
+  assert webclient.percentile([5, 1, 4, 2, 3], 50) == 3
+  assert webclient.percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 95) == 10
+
+def test_benchmark_regressions():
+  import time
+  import threading
+  from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+  from drubs import webclient
+  delay = dict(seconds=0.0)
+  class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      time.sleep(delay['seconds'])
+      self.send_response(200)
+      self.end_headers()
+      self.wfile.write('ok')
+    def log_message(self, *args):
+      pass
+  server = HTTPServer(('127.0.0.1', 0), Handler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  try:
+    client = webclient.WebClient('http://127.0.0.1:%d' % (server.server_address[1]))
+    before = webclient.summarize(webclient.benchmark(client, ['/', '/node'], repetitions=3))
+    assert before['count'] == 6 and before['failed'] == 0
+    assert webclient.regressions(before, before, 1.5, 0.05) == []
+    delay['seconds'] = 0.1
+    after = webclient.summarize(webclient.benchmark(client, ['/', '/node'], repetitions=3))
+    assert [stat for stat, b, a in webclient.regressions(before, after, 1.5, 0.05)] == ['p50', 'p95']
+    assert webclient.regressions(before, after, 1.5, 1.0) == []
+  finally:
+    server.shutdown()
+
+def test_rewrite_settings():
+  from drubs import snapshot
+  contents = '\n'.join([
+    "$databases = array (",
+    "  'default' => array (",
+    "    'default' => array (",
+    "      'database' => 'old_db',",
+    "      'username' => 'old_user',",
+    "      'password' => 'it\\'s old',",
+    "      'host' => 'localhost',",
+    "    ),",
+    "  ),",
+    ");",
+    "$drupal_hash_salt = 'old_salt';",
+  ])
+  database = dict(database='new_db', username='new_user', password="it's new", host='db.example.com')
+  rewritten = snapshot.rewrite_settings(contents, database, 'new_salt')
+  assert "'database' => 'new_db'," in rewritten
+  assert "'password' => 'it\\'s new'," in rewritten
+  assert "'host' => 'db.example.com'," in rewritten
+  assert "$drupal_hash_salt = 'new_salt';" in rewritten
+  assert 'old' not in rewritten
+  d6 = snapshot.rewrite_settings("$db_url = 'mysqli://a:b@c/d';", database, 'salt')
+  assert d6 == "$db_url = 'mysqli://new_user:it\\'s new@db.example.com/new_db';"
+
+def test_task_graph():
+  import os
+  import time
+  import shutil
+  import tempfile
+  import subprocess
+  from drubs.metrics import Metrics
+  from drubs.progress import Progress
+  from drubs.taskgraph import TaskGraph
+  directory = tempfile.mkdtemp()
+  def mark(name):
+    with open(os.path.join(directory, name), 'w') as stream:
+      stream.write(repr(time.time()))
+  def started(name):
+    with open(os.path.join(directory, name)) as stream:
+      return float(stream.read())
+  try:
+    graph = TaskGraph(workers=2)
+    @graph.task()
+    def a():
+      time.sleep(0.3)
+      mark('a')
+    @graph.task()
+    def b():
+      mark('b')
+    @graph.task(after=['a', 'b'])
+    def c():
+      mark('c')
+    assert graph.order() == ['a', 'b', 'c']
+    graph.run()
+    assert started('b') < started('a') < started('c')
+
+    failing = TaskGraph(workers=2)
+    failing.add('slow', lambda: (time.sleep(5), mark('slow')))
+    failing.add('broken', lambda: exit(1))
+    failing.add('later', lambda: mark('later'), after=['broken'])
+    try:
+      failing.run()
+      assert False
+    except SystemExit:
+      pass
+    assert not os.path.exists(os.path.join(directory, 'slow'))
+    assert not os.path.exists(os.path.join(directory, 'later'))
+
+    pid_file = os.path.join(directory, 'pid')
+    cancelled = TaskGraph(workers=2)
+    cancelled.add('shell', lambda: subprocess.call('sleep 30 & echo $! > %s; wait' % (pid_file), shell=True))
+    cancelled.add('broken', lambda: (time.sleep(0.5), exit(1)))
+    try:
+      cancelled.run()
+      assert False
+    except SystemExit:
+      pass
+    pid = int(open(pid_file).read())
+    for attempt in range(20):
+      if subprocess.call(['ps', '-p', str(pid)], stdout=open(os.devnull, 'w')) != 0:
+        break
+      time.sleep(0.1)
+    else:
+      assert False, 'command of cancelled task still running'
+
+    progress = Progress([('put_files', None), ('make', None)], interval=0)
+    metrics = Metrics('a', 'install')
+    shared_progress = progress.share()
+    shared_metrics = metrics.share()
+    def transfer():
+      shared_progress.add_bytes(1024)
+      shared_metrics.command(True)
+      shared_metrics.command(False)
+    counted = TaskGraph(workers=2)
+    counted.add('put_files', transfer)
+    counted.add('make', transfer)
+    counted.run()
+    progress.collect(shared_progress)
+    metrics.collect(shared_metrics)
+    assert progress.bytes == 2048 and not progress.shared
+    assert (metrics.commands, metrics.failed_commands) == (4, 2)
+
+    fleet = TaskGraph(workers=2, stagger=0.3)
+    fleet.add('broken', lambda: exit(1))
+    fleet.add('first', lambda: mark('first'))
+    fleet.add('second', lambda: mark('second'))
+    fleet.add('skipped', lambda: mark('skipped'), after=['broken'])
+    try:
+      fleet.run(keep_going=True)
+      assert False
+    except SystemExit:
+      pass
+    assert started('second') - started('first') >= 0.25
+
+    sequential = TaskGraph(workers=1, stagger=0.3)
+    sequential.add('third', lambda: mark('third'))
+    sequential.add('fourth', lambda: mark('fourth'))
+    sequential.run()
+    assert started('fourth') - started('third') >= 0.25
+    assert not os.path.exists(os.path.join(directory, 'skipped'))
+  finally:
+    shutil.rmtree(directory)
+
+def test_run_tasks_with_progress():
+  import os
+  import shutil
+  import tempfile
+  from fabric.state import env
+  from drubs.node import Node
+  from drubs.history import History
+  from drubs.metrics import Metrics
+  from drubs.plan import Step
+  from drubs.progress import Progress
+  from drubs.taskgraph import TaskGraph
+  class Context(object):
+    node_name = 'a'
+  directory = tempfile.mkdtemp()
+  try:
+    for workers in (1, 2):
+      node = object.__new__(Node)
+      node.context = Context()
+      node.action = 'install'
+      node.history = History(os.path.join(directory, '%d.sqlite' % (workers)))
+      node.metrics = metrics = Metrics('a', 'install')
+      node.progress = progress = Progress([('post', None), ('clear_cache', None)], interval=0)
+      env.plan_only = False
+      env.events = False
+      graph = TaskGraph(workers=workers)
+      # Tasks count a command each, in their own process if there are several
+      # workers.
+      graph.add('configure', lambda: node.metrics.command(True))
+      graph.add('clear_cache', lambda: node.metrics.command(False), after=['configure'])
+      node.run_step(Step('post', lambda: node.run_tasks(graph)))
+      assert [step for step, duration, success in node.history.runs_since('a', ['configure', 'clear_cache', 'post'], 0)] == ['post', 'configure', 'clear_cache']
+      assert node.metrics is metrics and node.progress is progress
+      assert (metrics.commands, metrics.failed_commands) == (2, 1)
+      assert list(metrics.phases) == ['configure', 'clear_cache', 'post']
+      assert node.progress.index == 0
+      node.run_step(Step('clear_cache', lambda: None))
+      assert node.progress.index == 1
+  finally:
+    shutil.rmtree(directory)
+
+def test_output_capture():
+  from StringIO import StringIO
+  from drubs.capture import OutputCapture
+  log = StringIO()
+  capture = OutputCapture(log, fields=dict(version=r'Drupal version\s*:\s*(\S+)', bootstrap='Successful'), limit=21)
+  for line in ['Drupal version : 7.41\n', 'Drupal bootstrap : Successful\n', 'line three\n', 'line four\n']:
+    capture.add(line)
+  assert capture.fields == dict(version='7.41', bootstrap='Successful')
+  assert capture.value() == 'line three\nline four\n'
+  assert capture.truncated
+  assert log.getvalue().startswith('Drupal version : 7.41\n')
+  assert log.getvalue().endswith('line four\n')
+
+def test_node_context():
+  import os
+  import shutil
+  import tempfile
+  import threading
+  from fabric.api import hide
+  from drubs.context import NodeContext
+  from drubs.capture import stream_local
+  directory = tempfile.mkdtemp()
+  try:
+    config = dict(nodes=dict())
+    for name in ('a', 'b'):
+      os.makedirs(os.path.join(directory, name, 'web'))
+      config['nodes'][name] = dict(site_root=os.path.join(directory, name))
+    seen = dict()
+    def drive(name):
+      context = NodeContext(name, 'root@%s:22' % (name), True, config, '/project')
+      with context.cd(context.node['site_root']):
+        with context.prefix('export NODE=%s' % (name)):
+          with context.cd('web'):
+            output = stream_local('echo $NODE; pwd', capture=True, cwd=context.cwd, prefixes=context.prefixes)
+            seen[name] = (context.cwd, output.splitlines())
+      assert context.prefixes == [] and context.cwd == ''
+    with hide('running'):
+      threads = [threading.Thread(target=drive, args=(name,)) for name in ('a', 'b')]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    for name in ('a', 'b'):
+      root = os.path.join(directory, name)
+      assert seen[name] == (root + '/web', [name, root + '/web'])
+  finally:
+    shutil.rmtree(directory)
+
+def test_node_context_env():
+  import os
+  import shutil
+  import tempfile
+  from fabric.api import settings
+  from fabric.state import env
+  from drubs.node import Node
+  from drubs.context import NodeContext, current_context
+  directory = tempfile.mkdtemp()
+  try:
+    with open(os.path.join(directory, 'site.py'), 'w') as stream:
+      stream.write('from fabric.state import env\nfrom drubs.node import Node\ninstance = Node(env)\n')
+    config = dict(nodes=dict(a=dict(site_root='/a', py_file='site.py'), b=dict(site_root='/b', py_file='site.py')))
+    contexts = [NodeContext(name, 'root@%s:22' % (name), True, config, directory) for name in ('a', 'b')]
+    with settings(config=config, config_dir=directory, command='status'):
+      nodes = [Node(context) for context in contexts]
+      assert 'node_name' not in env
+      # Each node loads the py_file for itself, and gets itself from Node(env).
+      assert [node.config_script.instance for node in nodes] == nodes
+      with contexts[0].activate():
+        # Real values, not stand-ins.
+        assert isinstance(env.node, dict) and env.node['site_root'] == '/a'
+        assert env.host_is_local is True
+        assert env.start_time - contexts[0].start_time == 0
+        with contexts[1].activate():
+          assert env.node_name == 'b' and current_context() is contexts[1]
+          assert Node(env) is nodes[1]
+        assert env.node_name == 'a' and Node(env) is nodes[0]
+      assert 'node_name' not in env
+  finally:
+    shutil.rmtree(directory)
+
+def test_node_index():
+  from fabric.state import env
+  from fabric.api import settings
+  from drubs.context import build_node_index, find_nodes
+  nodes = dict(
+    dev=dict(server_user='web', server_host='vm', server_port='22'),
+    test=dict(server_user='web', server_host='vm', server_port='22'),
+    prod=dict(server_user='web', server_host='prod', server_port='2222'),
+  )
+  index = build_node_index(nodes)
+  assert index[('web', 'vm', '22')] == ['dev', 'test']
+  with settings(node_index=index, requested_nodes=['test']):
+    assert find_nodes('web', 'vm', 22) == ['test']
+  with settings(node_index=index, requested_nodes=['prod', 'test', 'dev']):
+    assert find_nodes('web', 'vm', '22') == ['test', 'dev']
+    assert find_nodes('web', 'prod', '2222') == ['prod']
+
+def test_binlog_backups():
+  from datetime import datetime
+  from drubs import binlog
+  def name(kind, day):
+    return binlog.backup_name('p_n', kind, datetime(2016, 1, day, 12))
+  names = [name('incr', 1), name('base', 2), name('incr', 3), name('incr', 4), name('base', 10), name('incr', 11), 'p_n.restored', 'other']
+  backups = binlog.parse_backups(names, 'p_n')
+  assert [backup.name for backup in binlog.restore_chain(backups)] == [name('base', 10), name('incr', 11)]
+  assert [backup.name for backup in binlog.restore_chain(backups, name('incr', 3))] == [name('base', 2), name('incr', 3)]
+  now = datetime(2016, 2, 1)
+  assert [backup.name for backup in binlog.removable_backups(backups, 2, 14, now)] == [name('base', 2), name('incr', 3), name('incr', 4), name('incr', 1)]
+  assert [backup.name for backup in binlog.removable_backups(backups, 4, 14, now)] == [name('incr', 1)]
+  assert binlog.log_range('bin.000001\t100\nbin.000002\t200\nbin.000003\t300\n', 'bin.000002', 'bin.000003') == ['bin.000002', 'bin.000003']
+  assert binlog.log_range('bin.000002\t200\n', 'bin.000001', 'bin.000002') is None
+
+def test_replicate_file():
+  import os
+  import shutil
+  import tempfile
+  from drubs import replicate
+  directory = tempfile.mkdtemp()
+  try:
+    source = os.path.join(directory, 'backup.tar.gz')
+    with open(source, 'wb') as stream:
+      stream.write('aaaa' + 'bbbb' + 'aaaa' + 'cc')
+    store = replicate.ChunkStore(replicate.LocalPaths(), os.path.join(directory, 'store'))
+    checksums = replicate.file_checksums(source, 4)
+    assert len(checksums) == 4 and checksums[0] == checksums[2]
+    store.put_chunk(checksums[1], 'bbbb')
+    sent = replicate.replicate_file(replicate.LocalPaths(), source, checksums, store, 'n/backup.tar.gz', chunk_size=4, workers=2)
+    assert sent == 2
+    assert replicate.replicate_file(replicate.LocalPaths(), source, checksums, store, 'n/backup.tar.gz', chunk_size=4) == 0
+    replicate.assemble(store, 'n/backup.tar.gz', os.path.join(directory, 'copy'))
+    assert open(os.path.join(directory, 'copy'), 'rb').read() == 'aaaabbbbaaaacc'
+  finally:
+    shutil.rmtree(directory)
+
+def test_verify_backups():
+  import gzip
+  import shutil
+  import tempfile
+  import subprocess
+  from os.path import join
+  from drubs import verify
+  directory = tempfile.mkdtemp()
+  try:
+    good, truncated = join(directory, 'good.tar.gz'), join(directory, 'truncated.tar.gz')
+    for path in (good, truncated):
+      stream = gzip.open(path, 'wb')
+      stream.write('backup ' * 10000)
+      stream.close()
+    with open(truncated, 'r+b') as stream:
+      stream.truncate(100)
+    paths = [good, truncated, join(directory, 'missing.tar.gz')]
+    output = subprocess.Popen(verify.verify_command(paths, 2), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0]
+    results = verify.parse_results(output, paths)
+    assert [results[path][0] for path in paths] == [True, False, False]
+    record = dict()
+    assert verify.update_record(record, {'good.tar.gz': results[good]})['good.tar.gz'][0]
+    assert not verify.update_record(record, {'good.tar.gz': (True, 'changed')})['good.tar.gz'][0]
+    assert record['good.tar.gz']['sha256'] == results[good][1]
+  finally:
+    shutil.rmtree(directory)
+
+def test_move_to_trash():
+  import os
+  import shutil
+  import tempfile
+  from drubs.fileops import move_to_trash
+  directory = tempfile.mkdtemp()
+  try:
+    site_root = os.path.join(directory, 'site')
+    trash = os.path.join(directory, '.drubs-trash')
+    os.makedirs(os.path.join(site_root, 'sites', 'all'))
+    assert move_to_trash(os.path.join(site_root, 'sites'), trash)
+    assert move_to_trash(site_root, trash)
+    assert not move_to_trash(os.path.join(directory, 'missing'), trash)
+    assert not os.path.exists(site_root)
+    names = sorted(os.listdir(trash))
+    assert len(names) == 2 and names[0] != names[1]
+    assert sorted(name.rsplit('-', 1)[1] for name in names) == ['site', 'sites']
+  finally:
+    shutil.rmtree(directory)
+
+def test_local_files_match_shell():
+  import os
+  import stat
+  import shutil
+  import tempfile
+  import subprocess
+  from fabric.api import settings
+  from fabric import state
+  from drubs.fileops import LocalFiles, RemoteFiles
+  class ShellNode(object):
+    env = state.env
+    def drubs_run(self, command, **kwargs):
+      subprocess.check_call(command, shell=True, executable='/bin/bash')
+  def build(root):
+    os.makedirs(os.path.join(root, 'src', 'sub'))
+    for name, mode in (('a.txt', 0644), ('CHANGELOG.txt', 0644), ('robots.txt', 0644), ('notes_txt', 0600), ('README.md', 0644), ('.hidden.txt', 0644), ('sub/run', 0755)):
+      with open(os.path.join(root, 'src', name), 'w') as stream:
+        stream.write(name)
+      os.chmod(os.path.join(root, 'src', name), mode)
+    os.symlink('a.txt', os.path.join(root, 'src', 'link'))
+    os.symlink('sub', os.path.join(root, 'src', 'sublink'))
+    os.makedirs(os.path.join(root, 'kept'))
+    with open(os.path.join(root, 'kept', 'a.txt'), 'w') as stream:
+      stream.write('kept')
+  def tree(root):
+    found = dict()
+    for path, dirs, names in os.walk(root):
+      for name in dirs + names:
+        full = os.path.join(path, name)
+        mode = stat.S_IMODE(os.lstat(full).st_mode)
+        if os.path.islink(full):
+          found[full[len(root):]] = ('link', os.readlink(full))
+        elif os.path.isdir(full):
+          found[full[len(root):]] = ('dir', mode)
+        else:
+          found[full[len(root):]] = ('file', mode, open(full).read())
+    return found
+  def operate(files, root):
+    files.copy_tree(root + '/src', root + '/copy')
+    files.copy_tree(root + '/src', root + '/links', hardlink=True)
+    files.link_tree(root + '/src/sub', root + '/linked')
+    files.copy_tree(root + '/src', root + '/kept', overwrite=False)
+    files.chmod(root + '/copy/a.txt', '444')
+    files.chmod(root + '/copy/a.txt', 'u+w')
+    files.chmod(root + '/copy/sub', '700', recursive=True)
+    files.chmod(root + '/copy/notes_txt', '0664')
+    files.remove_matching(root + '/src', '.txt', 'robots.txt')
+  directory = tempfile.mkdtemp()
+  try:
+    shell, local = os.path.join(directory, 'shell'), os.path.join(directory, 'local')
+    for root in (shell, local):
+      build(root)
+    with settings(plan_only=False):
+      operate(RemoteFiles(ShellNode()), shell)
+      operate(LocalFiles(ShellNode()), local)
+    assert tree(shell) == tree(local)
+    assert sorted(os.listdir(os.path.join(local, 'src'))) == ['.hidden.txt', 'README.md', 'link', 'robots.txt', 'sub', 'sublink']
+    assert tree(local)['/copy/a.txt'] == ('file', 0644, 'a.txt')
+    assert tree(local)['/kept/a.txt'] == ('file', 0644, 'kept')
+    assert os.stat(os.path.join(local, 'links', 'README.md')).st_ino == os.stat(os.path.join(local, 'src', 'README.md')).st_ino
+  finally:
+    shutil.rmtree(directory)
+
+def test_remote_files_missing_path():
+  import os
+  import shutil
+  import tempfile
+  import subprocess
+  from drubs.fileops import RemoteFiles
+  class ShellNode(object):
+    def drubs_run(self, command, **kwargs):
+      subprocess.check_call(command, shell=True, executable='/bin/bash')
+  directory = tempfile.mkdtemp()
+  try:
+    files = RemoteFiles(ShellNode())
+    trash = os.path.join(directory, '.drubs-trash')
+    missing = os.path.join(directory, 'site', 'sites', 'all')
+    files.remove_children(missing)
+    files.discard_children(missing, trash)
+    files.discard(missing, trash)
+    os.makedirs(os.path.join(directory, 'site', 'sites', 'all', 'modules'))
+    files.discard_children(os.path.join(directory, 'site', 'sites'), trash, keep=['default'])
+    assert os.listdir(os.path.join(directory, 'site', 'sites')) == []
+  finally:
+    shutil.rmtree(directory)
+
+def test_remote_make():
+  import os
+  import shutil
+  import tempfile
+  from fabric.api import settings, hide
+  import drubs.node
+  from drubs.node import Node
+  from drubs.context import NodeContext
+  directory = tempfile.mkdtemp()
+  try:
+    with open(os.path.join(directory, 'dev.make'), 'w') as stream:
+      stream.write('core = 7.x\napi = 2\nprojects[] = drupal\n')
+    config = dict(
+      project_settings=dict(project_name='demo'),
+      nodes=dict(dev=dict(site_root='/var/www/demo', make_file='dev.make')),
+    )
+    class Files(object):
+      def __init__(self):
+        self.calls = list()
+      def __getattr__(self, name):
+        return lambda *args: self.calls.append((name,) + args)
+    uploads = list()
+    node = object.__new__(Node)
+    node.context = NodeContext('dev', 'root@vm:22', False, config, directory)
+    node.context.exists = lambda path: False
+    node.fs = Files()
+    node.directories = set()
+    node.find_build_paths = lambda info, keys: dict()
+    node.suggest_shared_build = lambda: None
+    node.drush = lambda cmd: node.fs.calls.append(('drush', cmd))
+    put_file = drubs.node.put_file
+    drubs.node.put_file = lambda host_string, source, path: uploads.append((host_string, source, path))
+    try:
+      with settings(hide('everything'), config=config, config_dir=directory, plan_only=False, cache=True, offline=False, full_make=True):
+        node.make()
+    finally:
+      drubs.node.put_file = put_file
+    assert uploads[0] == ('root@vm:22', os.path.join(directory, 'dev.make'), '/tmp/demo/dev.make')
+    assert ('mkdir', '/tmp/demo') in node.fs.calls
+    assert ('drush', 'make --working-copy --no-gitinfofile  /tmp/demo/dev.make') in node.fs.calls
+    assert node.fs.calls[-1] == ('remove', '/tmp/demo/dev.make')
+  finally:
+    shutil.rmtree(directory)
+
+def test_transfer_errors():
+  from StringIO import StringIO
+  from fabric.api import hide
+  import drubs.capture
+  from drubs.capture import put_file, get_file
+  class Sftp(object):
+    def put(self, source, path):
+      raise IOError(2, 'No such file')
+    putfo = get = put
+    def close(self):
+      pass
+  class Connection(object):
+    def open_sftp(self):
+      return Sftp()
+  connections = drubs.capture.connections
+  drubs.capture.connections = dict(host=Connection())
+  try:
+    for transfer in (lambda: put_file('host', '/tmp/a', '/tmp/b'), lambda: put_file('host', StringIO('a'), '/tmp/b'), lambda: get_file('host', '/tmp/b', '/tmp/a')):
+      try:
+        with hide('everything', 'aborts'):
+          transfer()
+        assert False
+      except SystemExit:
+        pass
+  finally:
+    drubs.capture.connections = connections
+
+def test_sync_relay():
+  import os
+  import shutil
+  import tempfile
+  from drubs import sync
+  directory = tempfile.mkdtemp()
+  try:
+    target = os.path.join(directory, 'loaded.sql')
+    source = sync.LocalCommand('printf "CREATE TABLE x;\\n" | gzip -1')
+    throughput = sync.Throughput('Database', interval=0)
+    sync.relay(source, sync.LocalCommand('gunzip -c > %s' % (target)), throughput, sync.gzip_member('UPDATE x;\n'))
+    assert open(target).read() == 'CREATE TABLE x;\nUPDATE x;\n'
+    assert throughput.bytes > 0
+    try:
+      sync.relay(sync.LocalCommand('exit 3'), sync.LocalCommand('cat > /dev/null'), sync.Throughput('Files', interval=0))
+      assert False
+    except SystemExit:
+      pass
+  finally:
+    shutil.rmtree(directory)
+
+def test_metrics():
+  import json
+  import shutil
+  import tempfile
+  from os.path import join
+  from drubs import metrics
+  directory = tempfile.mkdtemp()
+  try:
+    run = metrics.Metrics('prod', 'backup', started=100)
+    run.phase('create_backup', 2.5, True)
+    run.command(True)
+    run.command(False)
+    run.set('backup_bytes', 1000)
+    run.set('backup_compression_ratio', metrics.compression_ratio(1000, 4000))
+    metrics.write_metrics(directory, run.record(True, now=110))
+    failed = metrics.Metrics('prod', 'update', started=200)
+    failed.phase('updb', 1, False)
+    metrics.write_metrics(directory, failed.record(True, now=205))
+    records = [json.loads(line) for line in open(join(directory, metrics.JSON_LINES_FILE))]
+    assert [record['success'] for record in records] == [True, False]
+    assert records[0]['duration'] == 10 and records[0]['failed_commands'] == 1
+    prometheus = open(join(directory, metrics.PROMETHEUS_FILE)).read()
+    assert 'drubs_action_success{node="prod",action="update"} 0.0' in prometheus
+    assert 'drubs_backup_compression_ratio{node="prod",action="backup"} 4.0' in prometheus
+    assert 'drubs_phase_duration_seconds{node="prod",action="backup",phase="create_backup"} 2.5' in prometheus
+    assert metrics.compression_ratio(1000, 500) is None
+  finally:
+    shutil.rmtree(directory)